@@ -7,9 +7,12 @@ own and pull them into TileStache dynamically by class name.
 Built-in providers:
 - test
 - disk
+- bundle
 - multi
 - memcache
+- redis
 - s3
+- lmdb
 
 Example built-in cache, for JSON configuration file:
 
@@ -44,21 +47,91 @@ The save() method accepts an additional argument before the others:
 
 - body: raw content to save to the cache.
 
+A cache may also provide an optional save_many() method, accepting a list of
+(coord, body) tuples followed by layer and format, to save all the tiles
+of a metatile at once, and an optional close() method with no arguments to
+finish writing, called by tilestache-seed.py when it's done, and an optional
+abort() method with no arguments to throw away unfinished work, called by
+tilestache-seed.py before close() when seeding stops early, and an optional
+flush() method with no arguments to write tiles saved so far. An optional
+read_many() method accepts a list of coords followed by layer and format,
+and returns a list of bodies with None for missing tiles, and an optional
+list_tiles() method accepts a layer and generates (coord, format) tuples for
+every tile of the layer in the cache. An optional exists_many() method
+accepts the same arguments as read_many() and returns a list of booleans,
+true for each tile in the cache and not expired, without reading bodies;
+see tilesExist() for caches without it.
+
+Any cache configuration can include an "existence filter" dictionary to skip
+reads of tiles that were never saved, see ExistenceFilter below.
+
 TODO: add stale_lock_timeout and cache_lifespan to cache API in v2.
 """
 
 import os
 import sys
+import math
+import mmap
 import time
 import gzip
+import errno
+import socket
+import struct
+import logging
 
+from thread import get_ident as _thread_ident
+from threading import Thread, Lock, Condition
+from heapq import heappush, heappop
+from Queue import Queue, Empty, Full
+from multiprocessing.pool import ThreadPool
+from hashlib import md5
+from json import dumps, loads
+from collections import OrderedDict
 from tempfile import mkstemp
 from os.path import isdir, exists, dirname, basename, join as pathjoin
 
+from ModestMaps.Core import Coordinate
+
 from .Core import KnownUnknown
 from . import Memcache
 from . import Redis
 from . import S3
+from . import LMDB
+
+try:
+    import fcntl
+except ImportError:
+    # no POSIX locks on this platform, e.g. Windows
+    fcntl = None
+
+# bundle files start with this, followed by an unsigned int bundle size.
+_bundle_magic = 'TileStache bundle\n'
+
+# an index entry is an offset, length and save time.
+_bundle_entry = struct.Struct('<QII')
+
+# existence filter files start with this, their size in bits, number of hashes and count of tiles.
+_filter_magic = 'TileStache existence filter\n'
+_filter_header = struct.Struct('<%dsQIQ' % len(_filter_magic))
+
+# errors from flock() on filesystems that don't support it, e.g. some NFS mounts.
+_unsupported_lock_errors = set([getattr(errno, name) for name in ('ENOLCK', 'EOPNOTSUPP', 'ENOTSUP', 'EINVAL', 'ENOSYS') if hasattr(errno, name)])
+
+def tilesExist(cache, layer, coords, format):
+    """ Return a list of booleans, true for each tile in a cache and not expired.
+    
+        Uses the cache exists_many() method if it has one, otherwise
+        read_many() or read() for each tile.
+    """
+    if hasattr(cache, 'exists_many'):
+        return cache.exists_many(layer, coords, format)
+    
+    if hasattr(cache, 'read_many'):
+        bodies = cache.read_many(layer, coords, format)
+    else:
+        bodies = [cache.read(layer, coord, format) for coord in coords]
+    
+    return [body is not None for body in bodies]
 
 def getCacheByName(name):
     """ Retrieve a cache object by name.
@@ -71,6 +144,9 @@ def getCacheByName(name):
     elif name.lower() == 'disk':
         return Disk
 
+    elif name.lower() == 'bundle':
+        return Bundle
+
     elif name.lower() == 'multi':
         return Multi
 
@@ -83,6 +159,9 @@ def getCacheByName(name):
     elif name.lower() == 's3':
         return S3.Cache
 
+    elif name.lower() == 'lmdb':
+        return LMDB.Cache
+
     raise Exception('Unknown cache name: "%s"' % name)
 
 class Test:
@@ -178,16 +257,40 @@ class Disk:
         - gzip: optional list of file formats that should be stored in a
           compressed form. Defaults to "txt", "text", "json", and "xml".
           Provide an empty list in the configuration for no compression.
+        - noatime: optional boolean flag to read tiles without updating their
+          access times where the operating system allows it, saving a write
+          for every cache hit. Defaults to false.
+        - locking: optional string saying whether to lock tiles with "posix"
+          file locks, which waiting requests poll from 2ms up to 50ms apart
+          and which notice crashed processes on the same host, or with
+          "directory" locks that are polled every 200ms and only expire
+          after the layer stale lock timeout. Defaults to posix, with directory locks used
+          where the platform or filesystem doesn't support flock().
 
         If your configuration file is loaded from a remote location, e.g.
         "http://example.com/tilestache.cfg", the path *must* be an unambiguous
         filesystem path, e.g. "file:///tmp/cache"
     """
-    def __init__(self, path, umask=0022, dirs='safe', gzip='txt text json xml'.split()):
+    def __init__(self, path, umask=0022, dirs='safe', gzip='txt text json xml'.split(), noatime=False, locking='posix'):
         self.cachepath = path
         self.umask = int(umask)
         self.dirs = dirs
         self.gzip = [format.lower() for format in gzip]
+        
+        if locking not in ('posix', 'directory'):
+            raise KnownUnknown('Please provide a valid "locking" parameter to the Disk cache, either "posix" or "directory" but not "%s"' % locking)
+        
+        self.locking = (fcntl and locking == 'posix') and 'posix' or 'directory'
+        
+        # open lock file descriptors, by lock path and thread.
+        self.lock_fds = {}
+        
+        # O_NOATIME is Linux-only, and only allowed for the file owner.
+        self.read_flags = os.O_RDONLY
+        self.read_flags |= noatime and getattr(os, 'O_NOATIME', 0) or 0
+        
+        # directories known to exist, to skip os.makedirs() on most saves.
+        self.known_dirs = set()
 
     def _is_compressed(self, format):
         return format.lower() in self.gzip
@@ -249,14 +352,124 @@ class Disk:
         """
         return self._fullpath(layer, coord, format) + '.lock'
     
+    def _makedirs(self, dirpath):
+        """ Make sure that a directory exists, creating it if necessary.
+        
+            Directories created or found here are remembered, so that
+            subsequent calls for the same directory cost no system calls.
+        """
+        if dirpath in self.known_dirs:
+            return
+        
+        try:
+            umask_old = os.umask(self.umask)
+            os.makedirs(dirpath, 0777&~self.umask)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        finally:
+            os.umask(umask_old)
+        
+        if len(self.known_dirs) > 10000:
+            # don't let the memory footprint grow without limit.
+            self.known_dirs.clear()
+        
+        self.known_dirs.add(dirpath)
+    
     def lock(self, layer, coord, format):
         """ Acquire a cache lock for this tile.
         
             Returns nothing, but blocks until the lock has been acquired.
-            Lock is implemented as an empty directory next to the tile file.
+            
+            With POSIX locking, the lock is an flock() on a file next to the
+            tile file, and waiters poll it with non-blocking flock() calls from
+            2ms up to 50ms apart, see _flock_wait(). Otherwise the lock is
+            implemented as an empty directory next to the tile file.
+        """
+        lockpath = self._lockpath(layer, coord, format)
+        
+        if self.locking == 'posix':
+            try:
+                fd = self._lock_file(lockpath, layer.stale_lock_timeout)
+            except (IOError, OSError), e:
+                if e.errno == errno.EISDIR:
+                    # a directory lock left by an older or fallback process.
+                    pass
+                elif e.errno in _unsupported_lock_errors:
+                    logging.warning('TileStache.Caches.Disk.lock() falling back to directory locks in %s: %s', self.cachepath, e)
+                    self.locking = 'directory'
+                else:
+                    raise
+            else:
+                self.lock_fds[(lockpath, _thread_ident())] = fd
+                return
+        
+        self._lock_directory(lockpath, layer.stale_lock_timeout)
+    
+    def unlock(self, layer, coord, format):
+        """ Release a cache lock for this tile.
         """
         lockpath = self._lockpath(layer, coord, format)
-        due = time.time() + layer.stale_lock_timeout
+        fd = self.lock_fds.pop((lockpath, _thread_ident()), None)
+        
+        if fd is None:
+            # lock must have been a directory.
+            try:
+                os.rmdir(lockpath)
+            except OSError:
+                # Ok, someone else deleted it already
+                pass
+            return
+        
+        # unlink before closing so waiters on this file notice it's gone,
+        # unless our lock was broken as stale and the file is someone else's.
+        try:
+            if os.fstat(fd).st_ino == os.stat(lockpath).st_ino:
+                os.unlink(lockpath)
+        except OSError:
+            pass
+        
+        os.close(fd)
+    
+    def _lock_file(self, lockpath, timeout):
+        """ Acquire an flock() on a lock file, return its open file descriptor.
+        
+            A new lock file is written with the holder's host and pid and
+            locked before it's linked into place, so waiters never find one
+            without them. A lock held past the timeout, or by a dead process
+            on this host, is broken by removing its file. Waiters compare
+            inodes after locking to notice a file that was unlinked under them.
+        """
+        self._makedirs(dirname(lockpath))
+        due = time.time() + timeout
+        
+        while True:
+            fd = _create_lock_file(lockpath, 0666&~self.umask)
+            
+            if fd is not None:
+                return fd
+            
+            try:
+                fd = os.open(lockpath, os.O_RDWR)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                
+                # released meanwhile.
+                continue
+            
+            try:
+                status = _wait_for_flock(fd, lockpath, due)
+            finally:
+                os.close(fd)
+            
+            if status == 'broken':
+                due = time.time() + timeout
+    
+    def _lock_directory(self, lockpath, timeout):
+        """ Acquire a lock implemented as an empty directory, polling for it.
+        """
+        due = time.time() + timeout
         
         while True:
             # try to acquire a directory lock, repeating if necessary.
@@ -279,19 +492,6 @@ class Disk:
                 time.sleep(.2)
             finally:
                 os.umask(umask_old)
-    
-    def unlock(self, layer, coord, format):
-        """ Release a cache lock for this tile.
-
-            Lock is implemented as an empty directory next to the tile file.
-        """
-        lockpath = self._lockpath(layer, coord, format)
-
-        try:
-            os.rmdir(lockpath)
-        except OSError:
-            # Ok, someone else deleted it already
-            pass
         
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
@@ -307,37 +507,81 @@ class Disk:
         
     def read(self, layer, coord, format):
         """ Read a cached tile.
+        
+            The file is opened just once, with a missing file treated as
+            a cache miss and cache lifespan checked on the open file.
         """
         fullpath = self._fullpath(layer, coord, format)
         
-        if not exists(fullpath):
-            return None
-
-        age = time.time() - os.stat(fullpath).st_mtime
+        try:
+            fd = os.open(fullpath, self.read_flags)
+        except OSError, e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            
+            if e.errno == errno.EPERM and self.read_flags != os.O_RDONLY:
+                # Not our file, so O_NOATIME won't work here.
+                self.read_flags = os.O_RDONLY
+                return self.read(layer, coord, format)
+            
+            raise
         
-        if layer.cache_lifespan and age > layer.cache_lifespan:
-            return None
+        file = os.fdopen(fd, 'rb')
+        
+        try:
+            if layer.cache_lifespan:
+                age = time.time() - os.fstat(fd).st_mtime
+        
+                if age > layer.cache_lifespan:
+                    return None
     
-        elif self._is_compressed(format):
-            return gzip.open(fullpath, 'r').read()
+            if self._is_compressed(format):
+                return gzip.GzipFile(fileobj=file, mode='rb').read()
 
-        else:
-            body = open(fullpath, 'rb').read()
-            return body
+            else:
+                return file.read()
+        
+        finally:
+            file.close()
+    
+    def exists_many(self, layer, coords, format):
+        """ Return a list of booleans, true for each tile in the cache and not expired.
+        
+            Each directory is listed once instead of opening every file,
+            and files are only looked at to check the cache lifespan.
+        """
+        listings, found = dict(), []
+        
+        for coord in coords:
+            fullpath = self._fullpath(layer, coord, format)
+            dirpath = dirname(fullpath)
+            
+            if dirpath not in listings:
+                try:
+                    listings[dirpath] = set(os.listdir(dirpath))
+                except OSError, e:
+                    if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                        raise
+                    listings[dirpath] = set()
+            
+            exists = basename(fullpath) in listings[dirpath]
+            
+            if exists and layer.cache_lifespan:
+                try:
+                    exists = time.time() - os.stat(fullpath).st_mtime <= layer.cache_lifespan
+                except OSError:
+                    exists = False
+            
+            found.append(exists)
+        
+        return found
     
     def save(self, body, layer, coord, format):
         """ Save a cached tile.
         """
         fullpath = self._fullpath(layer, coord, format)
         
-        try:
-            umask_old = os.umask(self.umask)
-            os.makedirs(dirname(fullpath), 0777&~self.umask)
-        except OSError, e:
-            if e.errno != 17:
-                raise
-        finally:
-            os.umask(umask_old)
+        self._makedirs(dirname(fullpath))
 
         suffix = '.' + format.lower()
         suffix += self._is_compressed(format) and '.gz' or ''
@@ -355,12 +599,310 @@ class Disk:
         
         try:
             os.rename(tmp_path, fullpath)
-        except OSError:
-            os.unlink(fullpath)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                # Someone removed the directory since we last looked.
+                self.known_dirs.discard(dirname(fullpath))
+                self._makedirs(dirname(fullpath))
+            else:
+                os.unlink(fullpath)
+
             os.rename(tmp_path, fullpath)
 
         os.chmod(fullpath, 0666&~self.umask)
 
+class Bundle(Disk):
+    """ Caches blocks of tiles to bundle files on disk.
+        
+        Each block of N x N tiles is kept in a single file, a header with
+        the offset, length and save time of every tile followed by the tile
+        bodies. Bundles save inodes and make backups faster than one file
+        per tile. New tiles are appended, and a bundle is compacted once too
+        much of it is taken up by tiles that were replaced or removed.
+        
+        Recently opened bundles are kept mapped into memory, so a cache hit
+        reads its index entry and body without copying a whole file. Writers
+        take an exclusive flock() on the bundle, so POSIX locks are required.
+        
+        Example configuration:
+
+            "cache": {
+              "name": "Bundle",
+              "path": "/tmp/stache",
+              "size": 16
+            }
+
+        Extra parameters, in addition to "path", "umask", "dirs", "noatime"
+        and "locking" as for the Disk cache:
+        - size: optional number of rows and columns of tiles in each bundle.
+          A multiple of the layer metatile rows and columns keeps the tiles
+          of each metatile in one bundle, written at once. Defaults to 16.
+        - compact: optional fraction of a bundle that can be taken up by old
+          tiles before the bundle is compacted. Defaults to 0.5.
+        
+        Tiles are not compressed, unlike text formats in the Disk cache.
+    """
+    def __init__(self, path, umask=0022, dirs='safe', size=16, compact=.5, noatime=False, locking='posix'):
+        if fcntl is None:
+            raise KnownUnknown('The Bundle cache needs POSIX file locks, which this platform does not support')
+        
+        Disk.__init__(self, path, umask, dirs, gzip=[], noatime=noatime, locking=locking)
+        
+        self.size = int(size)
+        self.compact = float(compact)
+        
+        # header is a magic string, bundle size, and an index of
+        # offset, length and save time for each tile in the bundle.
+        self.header_length = len(_bundle_magic) + 4 + _bundle_entry.size * self.size * self.size
+        
+        # (inode, memory map) of the most recently opened bundles, by path.
+        self.bundles = OrderedDict()
+        self.bundles_lock = Lock()
+    
+    def _filepath(self, layer, coord, format):
+        """ Return the path of the bundle for a tile, relative to the cache.
+        """
+        block = Coordinate(coord.row // self.size, coord.column // self.size, coord.zoom)
+        return Disk._filepath(self, layer, block, format) + '.bundle'
+    
+    def _lockpath(self, layer, coord, format):
+        """ Return the path of a tile lock, next to its bundle.
+        """
+        row, column = coord.row % self.size, coord.column % self.size
+        return '%s-%d-%d.lock' % (self._fullpath(layer, coord, format), column, row)
+    
+    def _entry(self, coord):
+        """ Return the position of a tile in its bundle index.
+        """
+        return int(coord.row % self.size) * self.size + int(coord.column % self.size)
+    
+    def _bundle(self, fullpath):
+        """ Return a memory map of a bundle, or None if it's missing.
+        
+            Bundles are mapped again when they're replaced or appended to.
+            The index is read through the map, so it's always up to date.
+        """
+        try:
+            stat = os.stat(fullpath)
+        except OSError, e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise
+        
+        with self.bundles_lock:
+            ino, mapped = self.bundles.get(fullpath, (None, None))
+        
+        if ino == stat.st_ino and len(mapped) == stat.st_size:
+            return mapped
+        
+        if stat.st_size < self.header_length:
+            # just created, and the header isn't written yet.
+            return None
+        
+        try:
+            fd = os.open(fullpath, self.read_flags)
+        except OSError, e:
+            if e.errno == errno.EPERM and self.read_flags != os.O_RDONLY:
+                # Not our file, so O_NOATIME won't work here.
+                self.read_flags = os.O_RDONLY
+                return self._bundle(fullpath)
+            raise
+        
+        try:
+            stat = os.fstat(fd)
+            mapped = mmap.mmap(fd, stat.st_size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        
+        self._index(mapped[:self.header_length])
+        
+        with self.bundles_lock:
+            self.bundles[fullpath] = stat.st_ino, mapped
+            
+            if len(self.bundles) > 256:
+                # mappings are closed once nobody is reading them.
+                self.bundles.popitem(last=False)
+        
+        return mapped
+    
+    def _index(self, header):
+        """ Return a list of (offset, length, time) tuples from a bundle header.
+        """
+        if header[:len(_bundle_magic)] != _bundle_magic or len(header) != self.header_length:
+            raise KnownUnknown('Bundle file has a bad header, or a size other than %d' % self.size)
+        
+        start = len(_bundle_magic) + 4
+        count = self.size * self.size
+        
+        return [_bundle_entry.unpack_from(header, start + i * _bundle_entry.size) for i in range(count)]
+    
+    def remove(self, layer, coord, format):
+        """ Remove a cached tile.
+        """
+        fullpath = self._fullpath(layer, coord, format)
+        
+        if exists(fullpath):
+            self._update(fullpath, [(self._entry(coord), None)])
+    
+    def read(self, layer, coord, format):
+        """ Read a cached tile.
+        """
+        fullpath = self._fullpath(layer, coord, format)
+        mapped = self._bundle(fullpath)
+        
+        if mapped is None:
+            return None
+        
+        position = len(_bundle_magic) + 4 + self._entry(coord) * _bundle_entry.size
+        offset, length, saved = _bundle_entry.unpack_from(mapped, position)
+        
+        if length == 0 or offset + length > len(mapped):
+            return None
+        
+        if layer.cache_lifespan and time.time() - saved > layer.cache_lifespan:
+            return None
+        
+        return mapped[offset:offset + length]
+    
+    def exists_many(self, layer, coords, format):
+        """ Return a list of booleans, true for each tile in the cache and not expired.
+        
+            Only bundle indexes are read, not tile bodies.
+        """
+        found = []
+        
+        for coord in coords:
+            mapped = self._bundle(self._fullpath(layer, coord, format))
+            
+            if mapped is None:
+                found.append(False)
+                continue
+            
+            position = len(_bundle_magic) + 4 + self._entry(coord) * _bundle_entry.size
+            offset, length, saved = _bundle_entry.unpack_from(mapped, position)
+            
+            if length == 0 or offset + length > len(mapped):
+                found.append(False)
+            else:
+                found.append(not layer.cache_lifespan or time.time() - saved <= layer.cache_lifespan)
+        
+        return found
+    
+    def save(self, body, layer, coord, format):
+        """ Save a cached tile.
+        """
+        self.save_many([(coord, body)], layer, format)
+    
+    def save_many(self, tiles, layer, format):
+        """ Save a list of (coord, body) cached tiles, appending once to each bundle.
+        """
+        bundles = {}
+        
+        for (coord, body) in tiles:
+            fullpath = self._fullpath(layer, coord, format)
+            bundles.setdefault(fullpath, []).append((self._entry(coord), body))
+        
+        for (fullpath, changes) in bundles.items():
+            self._makedirs(dirname(fullpath))
+            self._update(fullpath, changes)
+    
+    def _update(self, fullpath, changes):
+        """ Append tile bodies to a bundle and update its index.
+        
+            Changes are a list of (entry, body) tuples, with None for
+            removed tiles. The bundle is compacted if needed.
+        """
+        fd = self._lock_bundle(fullpath)
+        
+        try:
+            header = _read_at(fd, 0, self.header_length)
+            
+            if len(header) == self.header_length:
+                index = self._index(header)
+            else:
+                # a new bundle, or one whose header was never finished.
+                index = [(0, 0, 0)] * (self.size * self.size)
+                header = _bundle_magic + struct.pack('<I', self.size) + _bundle_entry.pack(0, 0, 0) * len(index)
+                os.ftruncate(fd, 0)
+                _write_at(fd, 0, header)
+            
+            end = offset = os.lseek(fd, 0, os.SEEK_END)
+            bodies, now = [], int(time.time())
+            
+            for (entry, body) in changes:
+                if body is None:
+                    index[entry] = (0, 0, 0)
+                else:
+                    index[entry] = (offset, len(body), now)
+                    bodies.append(body)
+                    offset += len(body)
+            
+            # bodies first, so readers never find an entry pointing past them.
+            _write_at(fd, end, ''.join(bodies))
+            
+            start = len(_bundle_magic) + 4
+            
+            for entry in sorted(set([entry for (entry, body) in changes])):
+                _write_at(fd, start + entry * _bundle_entry.size, _bundle_entry.pack(*index[entry]))
+            
+            used = self.header_length + sum([length for (offset, length, saved) in index])
+            
+            if offset - used > self.compact * offset and offset > 65536:
+                self._compact(fd, fullpath, index)
+        
+        finally:
+            # closing the file releases the lock.
+            os.close(fd)
+    
+    def _lock_bundle(self, fullpath):
+        """ Open a bundle for writing and lock it, creating it if necessary.
+        
+            Return an open file descriptor. Bundles replaced by compaction
+            while waiting for the lock are opened again.
+        """
+        while True:
+            fd = os.open(fullpath, os.O_RDWR | os.O_CREAT, 0666 & ~self.umask)
+            _set_cloexec(fd)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            
+            try:
+                if os.fstat(fd).st_ino == os.stat(fullpath).st_ino:
+                    return fd
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    os.close(fd)
+                    raise
+            
+            os.close(fd)
+    
+    def _compact(self, fd, fullpath, index):
+        """ Replace a locked bundle with a copy of just its current tiles.
+        """
+        new_index, bodies = [], []
+        offset = self.header_length
+        
+        for (old_offset, length, saved) in index:
+            if length:
+                bodies.append(_read_at(fd, old_offset, length))
+                new_index.append((offset, length, saved))
+                offset += length
+            else:
+                new_index.append((0, 0, 0))
+        
+        header = _bundle_magic + struct.pack('<I', self.size)
+        header += ''.join([_bundle_entry.pack(*entry) for entry in new_index])
+        
+        handle, tmp_path = mkstemp(dir=dirname(fullpath), suffix='.bundle')
+        
+        try:
+            _write_at(handle, 0, header + ''.join(bodies))
+            os.fchmod(handle, 0666 & ~self.umask)
+        finally:
+            os.close(handle)
+        
+        os.rename(tmp_path, fullpath)
+        logging.debug('TileStache.Caches.Bundle._compact() compacted %s to %d bytes', fullpath, offset)
+
 class Multi:
     """ Caches tiles to multiple, ordered caches.
         
@@ -392,11 +934,41 @@ class Multi:
             Required list of cache configurations. The fastest, most local
             cache should be at the beginning of the list while the slowest or
             most remote cache should be at the end. Memcache and S3 together
-            make a great pair.
-
+            make a great pair. A tier with a "write behind" dictionary saves
+            tiles in the background, see WriteBehind below.
+        
+          hedge
+            Optional number of seconds to wait for a tier to answer before
+            also asking the next one, e.g. 0.05. Reads are then made from a
+            pool of threads, and the first tier to find the tile wins. A miss
+            moves on to the next tier right away. Default is to read tiers one
+            after another with no threads.
+        
+          threads
+            Optional number of reading threads when hedge is set, default 8.
+        
+          backfill
+            Optional size of the queue of tiles found in a later tier and
+            waiting to be saved to earlier tiers by a background thread.
+            Tiles are not backfilled while the queue is full. Default is 256;
+            use 0 to save to earlier tiers before read() returns.
+        
+        Hit counts for each tier are available from the stats() method.
     """
-    def __init__(self, tiers):
+    def __init__(self, tiers, hedge=None, threads=8, backfill=256):
         self.tiers = tiers
+        self.hedge = hedge and float(hedge)
+        self.threads = int(threads)
+        self.backfill = int(backfill)
+        
+        self.pid = None
+        self.pool = None
+        self.queue = None
+        
+        self.counts_lock = Lock()
+        self.reads = [0] * len(tiers)
+        self.hits = [0] * len(tiers)
+        self.backfilled, self.dropped = 0, 0
 
     def lock(self, layer, coord, format):
         """ Acquire a cache lock for this tile in the first tier.
@@ -423,22 +995,1093 @@ class Multi:
             is found. When found, save it back to the earlier tiers for faster
             access on future requests.
         """
-        for (index, cache) in enumerate(self.tiers):
-            body = cache.read(layer, coord, format)
+        if self.hedge is None or len(self.tiers) == 1:
+            for (index, cache) in enumerate(self.tiers):
+                body = cache.read(layer, coord, format)
+                self._count(index, body)
+                
+                if body:
+                    self._backfill(index, body, layer, coord, format)
+                    return body
+            
+            return None
+        
+        return self._hedged_read(layer, coord, format)
+    
+    def _hedged_read(self, layer, coord, format):
+        """ Read a cached tile from each tier in turn, without waiting long.
+        
+            A tier is asked after the one before it misses, or after it
+            has gone unanswered for the hedge delay. Errors are only raised
+            if no tier has the tile.
+        """
+        self._start()
+        
+        results, errors = Queue(), []
+        
+        def read(index):
+            try:
+                body = self.tiers[index].read(layer, coord, format)
+            except:
+                results.put((index, None, sys.exc_info()))
+            else:
+                results.put((index, body, None))
+        
+        self.pool.apply_async(read, (0, ))
+        started, pending = 1, 1
+        
+        while pending:
+            try:
+                if started < len(self.tiers):
+                    index, body, error = results.get(True, self.hedge)
+                else:
+                    index, body, error = results.get()
+            except Empty:
+                # no answer in time, ask the next tier too.
+                self.pool.apply_async(read, (started, ))
+                started, pending = started + 1, pending + 1
+                continue
+            
+            pending -= 1
+            self._count(index, body)
             
             if body:
-                # save the body in earlier tiers for speedier access
-                for cache in self.tiers[:index]:
-                    cache.save(body, layer, coord, format)
-                
+                self._backfill(index, body, layer, coord, format)
                 return body
+            
+            if error:
+                logging.warning('TileStache.Caches.Multi._hedged_read() failed to read from tier %d: %s', index, error[1])
+                errors.append(error)
+            
+            if started < len(self.tiers):
+                # a miss, so don't wait out the hedge delay to ask the next tier.
+                self.pool.apply_async(read, (started, ))
+                started, pending = started + 1, pending + 1
+        
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
         
         return None
     
-    def save(self, body, layer, coord, format):
-        """ Save a cached tile.
-        
-            Every tier gets a saved copy.
+    def _start(self):
+        """ Start reading threads and the backfill thread in this process.
         """
-        for (index, cache) in enumerate(self.tiers):
+        if self.pid == os.getpid():
+            return
+        
+        with self.counts_lock:
+            if self.pid == os.getpid():
+                return
+        
+            if self.hedge is not None:
+                self.pool = ThreadPool(self.threads)
+            
+            if self.backfill > 0:
+                self.queue = Queue(self.backfill)
+                backfiller = Thread(target=self._backfill_tiles, args=(self.queue, ))
+                backfiller.setDaemon(True)
+                backfiller.start()
+            
+            self.pid = os.getpid()
+    
+    def _count(self, index, body):
+        """ Count a read from a tier.
+        """
+        with self.counts_lock:
+            self.reads[index] += 1
+            self.hits[index] += bool(body)
+    
+    def _backfill(self, index, body, layer, coord, format):
+        """ Save a tile found in one tier to each earlier tier.
+        """
+        if index == 0:
+            return
+        
+        if self.backfill <= 0:
+            for cache in self.tiers[:index]:
+                cache.save(body, layer, coord, format)
+            return
+        
+        self._start()
+        
+        try:
+            self.queue.put_nowait((index, body, layer, coord, format))
+        except Full:
+            with self.counts_lock:
+                self.dropped += 1
+    
+    def _backfill_tiles(self, queue):
+        """ Save tiles from the backfill queue, forever.
+        """
+        while True:
+            index, body, layer, coord, format = queue.get()
+            
+            try:
+                for cache in self.tiers[:index]:
+                    cache.save(body, layer, coord, format)
+            except:
+                logging.exception('TileStache.Caches.Multi._backfill_tiles() failed to save %s', coord)
+            else:
+                with self.counts_lock:
+                    self.backfilled += 1
+            finally:
+                queue.task_done()
+    
+    def stats(self):
+        """ Return a dictionary of read counts and hit ratios for each tier.
+        
+            Tiers are described by the number of reads, hits, and hits
+            per read ("hit ratio"). Counts of tiles saved to earlier tiers
+            ("backfilled") and not saved because the queue was full
+            ("dropped") are also included.
+        """
+        with self.counts_lock:
+            tiers = [{'cache': cache.__class__.__name__, 'reads': reads, 'hits': hits,
+                      'hit ratio': reads and float(hits) / reads}
+                     for (cache, reads, hits) in zip(self.tiers, self.reads, self.hits)]
+            
+            return dict(tiers=tiers, backfilled=self.backfilled, dropped=self.dropped)
+    
+    def save(self, body, layer, coord, format):
+        """ Save a cached tile.
+        
+            Every tier gets a saved copy.
+        """
+        for (index, cache) in enumerate(self.tiers):
             cache.save(body, layer, coord, format)
+    
+    def save_many(self, tiles, layer, format):
+        """ Save a list of (coord, body) cached tiles.
+        
+            Every tier gets saved copies.
+        """
+        for cache in self.tiers:
+            if hasattr(cache, 'save_many'):
+                cache.save_many(tiles, layer, format)
+            else:
+                for (coord, body) in tiles:
+                    cache.save(body, layer, coord, format)
+    
+    def exists_many(self, layer, coords, format):
+        """ Return a list of booleans, true for each tile in any tier and not expired.
+        
+            Tiers are asked in turn about tiles not found in earlier ones.
+        """
+        found = [False] * len(coords)
+        
+        for cache in self.tiers:
+            missing = [index for (index, exists) in enumerate(found) if not exists]
+            
+            if not missing:
+                break
+            
+            for (index, exists) in zip(missing, tilesExist(cache, layer, [coords[i] for i in missing], format)):
+                found[index] = exists
+        
+        return found
+    
+    def flush(self):
+        """ Write tiles saved so far in every tier that needs it.
+        """
+        for cache in self.tiers:
+            if hasattr(cache, 'flush'):
+                cache.flush()
+    
+    def abort(self):
+        """ Throw away unfinished work in every tier that needs it.
+        """
+        for cache in self.tiers:
+            if hasattr(cache, 'abort'):
+                cache.abort()
+    
+    def close(self):
+        """ Finish backfilling, and close every tier that needs it.
+        """
+        if self.queue is not None and self.pid == os.getpid():
+            self.queue.join()
+        
+        for cache in self.tiers:
+            if hasattr(cache, 'close'):
+                cache.close()
+
+class WriteBehind:
+    """ Saves tiles to a slow cache in the background, through a local spool.
+        
+        Used for tiers of a Multi cache, where a tile already saved to a fast
+        tier doesn't need to wait for an upload to a slow one. Saved tiles
+        are written to a spool directory and uploaded by a pool of threads,
+        while reads, removals and locks go straight to the cache. A tile that
+        fails to save is tried again after a delay, doubling from a second
+        up to five minutes with each failure. Tiles left in the spool by a
+        process that stopped before uploading them are picked up again on
+        the next save.
+        
+        When the spool is full, tiles are saved synchronously instead.
+        
+        Example configuration of a Multi tier:
+        
+            {
+              "name": "S3",
+              "bucket": "example-bucket",
+              "write behind": {
+                "spool": "/var/spool/tilestache",
+                "threads": 4,
+                "spool size": 1000
+              }
+            }
+        
+        Write behind parameters:
+        
+          spool
+            Required local directory for tiles waiting to be saved.
+        
+          threads
+            Optional number of threads saving to the cache, default 4.
+        
+          spool size
+            Optional number of tiles that can wait in the spool at once,
+            default 1000.
+    """
+    def __init__(self, cache, spool, threads=4, spool_size=1000):
+        self.cache = cache
+        self.spool = spool
+        self.threads = int(threads)
+        self.spool_size = int(spool_size)
+        
+        self.pid = None
+        self.queue = None
+        self.layers = None
+        self.start_lock = Lock()
+        
+        # seconds to wait before trying a failed tile again, doubled each time.
+        self.retry_delay, self.retry_max = 1., 300.
+        
+        # heap of (due time, path, layer, attempts) for failed tiles.
+        self.retries = None
+        self.retry_cond = None
+
+    def lock(self, layer, coord, format):
+        """ Acquire a cache lock for this tile in the cache.
+        """
+        return self.cache.lock(layer, coord, format)
+    
+    def unlock(self, layer, coord, format):
+        """ Release a cache lock for this tile in the cache.
+        """
+        return self.cache.unlock(layer, coord, format)
+    
+    def remove(self, layer, coord, format):
+        """ Remove a cached tile from the cache.
+        """
+        return self.cache.remove(layer, coord, format)
+    
+    def read(self, layer, coord, format):
+        """ Read a cached tile from the cache.
+        """
+        return self.cache.read(layer, coord, format)
+    
+    def exists_many(self, layer, coords, format):
+        """ Return a list of booleans, true for each tile in the cache and not expired.
+        
+            Tiles still waiting in the spool aren't counted.
+        """
+        return tilesExist(self.cache, layer, coords, format)
+    
+    def save(self, body, layer, coord, format):
+        """ Spool a tile to be saved in the background.
+        
+            Save it right away if the spool is full.
+        """
+        self._start(layer)
+        
+        if self.queue.full():
+            logging.debug('TileStache.Caches.WriteBehind.save() spool is full, saving %s synchronously', coord)
+            return self.cache.save(body, layer, coord, format)
+        
+        header = dumps(dict(layer=layer.name(), zoom=coord.zoom, column=coord.column, row=coord.row, format=format))
+        
+        handle, tmp_path = mkstemp(dir=self.spool, suffix='.tmp')
+        os.write(handle, header + '\n')
+        os.write(handle, body)
+        os.close(handle)
+        
+        # named to sort in the order saved.
+        path = pathjoin(self.spool, '%.6f-%d-%s.tile' % (time.time(), os.getpid(), basename(tmp_path)[:-4]))
+        os.rename(tmp_path, path)
+        
+        try:
+            self.queue.put_nowait((path, layer, 0))
+        except Full:
+            os.unlink(path)
+            return self.cache.save(body, layer, coord, format)
+    
+    def close(self):
+        """ Finish saving spooled tiles, and close the cache if it needs it.
+        """
+        if self.queue is not None and self.pid == os.getpid():
+            self.queue.join()
+        
+        if hasattr(self.cache, 'close'):
+            self.cache.close()
+    
+    def _start(self, layer):
+        """ Start saving threads in this process, and pick up spooled tiles.
+        """
+        if self.pid == os.getpid():
+            return
+        
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            
+            try:
+                os.makedirs(self.spool)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            
+            self.layers = layer.config.layers
+            self.queue = Queue(self.spool_size)
+            self.retries, self.retry_cond = [], Condition()
+            
+            for i in range(self.threads):
+                saver = Thread(target=self._save_spooled, args=(self.queue, ))
+                saver.setDaemon(True)
+                saver.start()
+            
+            recoverer = Thread(target=self._recover, args=(self.queue, ))
+            recoverer.setDaemon(True)
+            recoverer.start()
+            
+            retrier = Thread(target=self._retry_spooled, args=(self.queue, self.retries, self.retry_cond))
+            retrier.setDaemon(True)
+            retrier.start()
+            
+            self.pid = os.getpid()
+    
+    def _recover(self, queue):
+        """ Queue up tiles left in the spool by processes no longer running.
+        
+            Spooled files are named "{time}-{pid}-{unique}.tile", with
+            "-{pid}" appended by the process saving them to the cache.
+        """
+        for filename in sorted(os.listdir(self.spool)):
+            name, ext = os.path.splitext(filename)
+            
+            try:
+                pids = [int(pid) for pid in (name.split('-')[1], ext[6:]) if pid]
+            except (IndexError, ValueError):
+                continue
+            
+            if not ext.startswith('.tile') or os.getpid() in pids:
+                continue
+            
+            if [pid for pid in pids if _process_is_alive(pid)]:
+                continue
+            
+            path = pathjoin(self.spool, name + '.tile')
+            
+            if filename != basename(path):
+                # claimed by a process that stopped while saving it.
+                os.rename(pathjoin(self.spool, filename), path)
+            
+            queue.put((path, None, 0))
+    
+    def _save_spooled(self, queue):
+        """ Save tiles from the spool queue, forever.
+        
+            Tiles that fail to save are handed to _retry_spooled().
+        """
+        while True:
+            path, layer, attempts = queue.get()
+            
+            try:
+                self._save_file(path, layer)
+            except:
+                logging.exception('TileStache.Caches.WriteBehind._save_spooled() failed to save %s', path)
+                
+                delay = min(self.retry_delay * 2 ** attempts, self.retry_max)
+                
+                with self.retry_cond:
+                    heappush(self.retries, (time.time() + delay, path, layer, attempts + 1))
+                    self.retry_cond.notify()
+            finally:
+                queue.task_done()
+    
+    def _retry_spooled(self, queue, retries, retry_cond):
+        """ Put tiles that failed to save back in the spool queue when they're due, forever.
+        """
+        while True:
+            with retry_cond:
+                while not retries or retries[0][0] > time.time():
+                    retry_cond.wait(retries and retries[0][0] - time.time() or None)
+                
+                due, path, layer, attempts = heappop(retries)
+            
+            logging.debug('TileStache.Caches.WriteBehind._retry_spooled() trying %s again, attempt %d', path, attempts + 1)
+            queue.put((path, layer, attempts))
+    
+    def _save_file(self, path, layer):
+        """ Save one spooled tile file to the cache, and remove it.
+        """
+        # claim the file, in case another process is recovering it too.
+        claimed = '%s-%d' % (path, os.getpid())
+        
+        try:
+            os.rename(path, claimed)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        
+        try:
+            file = open(claimed, 'rb')
+            tile, body = loads(file.readline()), file.read()
+            file.close()
+            
+            layer = layer or self.layers.get(tile['layer'])
+            
+            if layer is None:
+                raise KnownUnknown('Unknown layer "%(layer)s" for a spooled tile' % tile)
+            
+            coord = Coordinate(tile['row'], tile['column'], tile['zoom'])
+            self.cache.save(body, layer, coord, str(tile['format']))
+        
+        except:
+            # put it back for another try, here or by the next process.
+            os.rename(claimed, path)
+            raise
+        
+        os.unlink(claimed)
+
+class ExistenceFilter:
+    """ Answers definite misses for a slow cache from a local Bloom filter.
+        
+        For sparse layers most reads are misses, and each one costs a round
+        trip to a remote cache like S3 or Redis. This keeps a Bloom filter of
+        saved tiles for each layer in a memory-mapped file shared by every
+        process on the host, and only asks the cache about tiles that might
+        be in it. A small fraction of misses still reach the cache, but a
+        saved tile is never reported missing.
+        
+        The filter for a layer is built in the background on first use from
+        a listing of the cache, if it provides a list_tiles() method, and
+        reads go straight to the cache until it's done. Saved tiles are added
+        as they're saved; until there's a filter, every process appends them
+        to a log next to it, which is added in before the new filter is moved
+        into place. Removed and expired tiles are not taken out; delete the
+        filter file to have it built again.
+        
+        Example configuration:
+        
+            {
+              "name": "S3",
+              "bucket": "example-bucket",
+              "existence filter": {
+                "path": "/var/cache/tilestache-filters",
+                "capacity": 1000000,
+                "error rate": 0.01
+              }
+            }
+        
+        Existence filter parameters:
+        
+          path
+            Required local directory for filter files, one for each layer.
+        
+          capacity
+            Optional number of tiles in each layer that a filter is sized
+            for, default 1000000. Fuller filters let more misses through.
+        
+          error rate
+            Optional fraction of misses let through at full capacity,
+            default 0.01. About ten bits are used for each tile at 0.01.
+        
+        Counts of reads and of misses answered by filters are available from
+        the stats() method.
+    """
+    def __init__(self, cache, path, capacity=1000000, error_rate=.01):
+        if fcntl is None:
+            raise KnownUnknown('Existence filters need POSIX file locks, not available on this platform')
+        
+        self.cache = cache
+        self.path = path
+        self.capacity = int(capacity)
+        self.error_rate = float(error_rate)
+        
+        bits = -self.capacity * math.log(self.error_rate) / math.log(2) ** 2
+        self.bits = max(int(math.ceil(bits / 8)), 1) * 8
+        self.hashes = max(int(round(self.bits * math.log(2) / self.capacity)), 1)
+        
+        # open filters by layer name, layers being built in this process,
+        # and times of the last attempts to build.
+        self.filters = dict()
+        self.building = set()
+        self.attempted = dict()
+        self.filters_lock = Lock()
+        
+        self.counts_lock = Lock()
+        self.reads, self.filtered = 0, 0
+    
+    def lock(self, layer, coord, format):
+        """ Acquire a cache lock for this tile in the cache.
+        """
+        return self.cache.lock(layer, coord, format)
+    
+    def unlock(self, layer, coord, format):
+        """ Release a cache lock for this tile in the cache.
+        """
+        return self.cache.unlock(layer, coord, format)
+    
+    def remove(self, layer, coord, format):
+        """ Remove a cached tile from the cache.
+        
+            The filter keeps it, so later reads still go to the cache.
+        """
+        return self.cache.remove(layer, coord, format)
+    
+    def read(self, layer, coord, format):
+        """ Read a cached tile, unless the filter says it was never saved.
+        """
+        if not self._might_exist(layer, [coord], format)[0]:
+            return None
+        
+        return self.cache.read(layer, coord, format)
+    
+    def read_many(self, layer, coords, format):
+        """ Read a list of cached tiles, asking the cache only about those that might exist.
+        
+            Return a list of bodies, with None for each tile not found.
+        """
+        found = self._might_exist(layer, coords, format)
+        maybes = [coord for (coord, might) in zip(coords, found) if might]
+        
+        if not maybes:
+            bodies = []
+        elif hasattr(self.cache, 'read_many'):
+            bodies = self.cache.read_many(layer, maybes, format)
+        else:
+            bodies = [self.cache.read(layer, coord, format) for coord in maybes]
+        
+        bodies.reverse()
+        return [might and bodies.pop() or None for might in found]
+    
+    def exists_many(self, layer, coords, format):
+        """ Return a list of booleans, asking the cache only about tiles that might exist.
+        """
+        found = self._might_exist(layer, coords, format)
+        maybes = [coord for (coord, might) in zip(coords, found) if might]
+        exists = maybes and tilesExist(self.cache, layer, maybes, format) or []
+        
+        exists.reverse()
+        return [might and exists.pop() for might in found]
+    
+    def save(self, body, layer, coord, format):
+        """ Add a tile to the filter, then save it to the cache.
+        """
+        self._add(layer, [coord], format)
+        self.cache.save(body, layer, coord, format)
+    
+    def save_many(self, tiles, layer, format):
+        """ Add a list of (coord, body) tiles to the filter, then save them to the cache.
+        """
+        self._add(layer, [coord for (coord, body) in tiles], format)
+        
+        if hasattr(self.cache, 'save_many'):
+            self.cache.save_many(tiles, layer, format)
+        else:
+            for (coord, body) in tiles:
+                self.cache.save(body, layer, coord, format)
+    
+    def flush(self):
+        """ Write tiles saved so far in the cache, if it needs it.
+        """
+        if hasattr(self.cache, 'flush'):
+            self.cache.flush()
+    
+    def close(self):
+        """ Flush filters to disk, and close the cache if it needs it.
+        """
+        with self.filters_lock:
+            for filter in self.filters.values():
+                if filter['pid'] == os.getpid():
+                    filter['map'].flush()
+        
+        if hasattr(self.cache, 'close'):
+            self.cache.close()
+    
+    def stats(self):
+        """ Return a dictionary with counts of reads and misses answered by filters.
+        """
+        with self.counts_lock:
+            return dict(reads=self.reads, filtered=self.filtered)
+    
+    def _filepath(self, layer):
+        """ Return the path to the filter file of a layer.
+        """
+        return pathjoin(self.path, layer.name() + '.bloom')
+    
+    def _positions(self, bits, hashes, coord, format):
+        """ Return bit positions in a filter for a tile.
+        """
+        key = '%d/%d/%d.%s' % (coord.zoom, coord.column, coord.row, format.lower())
+        first, second = struct.unpack('<QQ', md5(key).digest())
+        
+        return [(first + index * second) % bits for index in range(hashes)]
+    
+    def _might_exist(self, layer, coords, format):
+        """ Return a list of booleans, false for tiles that were never saved.
+        
+            Every tile might exist while there's no filter for the layer.
+        """
+        filter = self._filter(layer)
+        found = []
+        
+        for coord in coords:
+            if filter is None:
+                found.append(True)
+                continue
+            
+            mapped, offset = filter['map'], _filter_header.size
+            
+            for position in self._positions(filter['bits'], filter['hashes'], coord, format):
+                if not ord(mapped[offset + position / 8]) & (1 << (position % 8)):
+                    found.append(False)
+                    break
+            else:
+                found.append(True)
+        
+        with self.counts_lock:
+            self.reads += len(coords)
+            self.filtered += found.count(False)
+        
+        return found
+    
+    def _add(self, layer, coords, format):
+        """ Set the bits of tiles in the filter for a layer, or log them for the next filter built.
+        """
+        filter = self._filter(layer)
+        
+        while filter is None:
+            if self._log_saves(layer, coords, format):
+                return
+            
+            # a filter was moved into place meanwhile.
+            filter = self._filter(layer)
+        
+        with self.filters_lock:
+            # other processes set bits in the same bytes.
+            fcntl.flock(filter['fd'], fcntl.LOCK_EX)
+            
+            try:
+                _set_filter_bits(filter['map'], filter['bits'], filter['hashes'],
+                                 [self._positions(filter['bits'], filter['hashes'], coord, format) for coord in coords])
+            finally:
+                fcntl.flock(filter['fd'], fcntl.LOCK_UN)
+            
+            count = _filter_count(filter['map'])
+        
+        if count > self.capacity and not filter['warned']:
+            logging.warning('TileStache.Caches.ExistenceFilter._add() filter for "%s" holds %d tiles, more than its capacity of %d; delete %s to build a bigger one',
+                            layer.name(), count, self.capacity, self._filepath(layer))
+            filter['warned'] = True
+    
+    def _log_saves(self, layer, coords, format):
+        """ Append tiles to the log of tiles saved while there's no filter for a layer.
+        
+            The log is shared by every process, and locked while a finished
+            filter is moved into place. Return false without logging if there
+            is a filter now, so the tiles can be added to it instead.
+        """
+        path = self._filepath(layer)
+        
+        try:
+            os.makedirs(self.path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        
+        fd = os.open(path + '.saves', os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+        _set_cloexec(fd)
+        
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            
+            if exists(path):
+                return False
+            
+            os.write(fd, ''.join(['%d/%d/%d %s\n' % (coord.zoom, coord.column, coord.row, format) for coord in coords]))
+            return True
+        
+        finally:
+            # closing releases the lock.
+            os.close(fd)
+    
+    def _filter(self, layer):
+        """ Return the open filter for a layer, or None if there isn't one yet.
+        
+            Files are checked once a second, to notice new or rebuilt filters.
+        """
+        name, now = layer.name(), time.time()
+        
+        with self.filters_lock:
+            filter = self.filters.get(name)
+            
+            if filter is not None and filter['pid'] == os.getpid() and now - filter['checked'] < 1:
+                return filter
+        
+        path = self._filepath(layer)
+        
+        try:
+            inode = os.stat(path).st_ino
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            
+            self._build(layer)
+            return None
+        
+        with self.filters_lock:
+            filter = self.filters.get(name)
+            
+            if filter is not None and filter['pid'] == os.getpid() and filter['inode'] == inode:
+                filter['checked'] = now
+                return filter
+            
+            fd = os.open(path, os.O_RDWR)
+            _set_cloexec(fd)
+            
+            mapped = mmap.mmap(fd, 0)
+            magic, bits, hashes, count = _filter_header.unpack(mapped[:_filter_header.size])
+            
+            if magic != _filter_magic:
+                raise KnownUnknown('"%s" is not a TileStache existence filter' % path)
+            
+            if filter is not None and filter['pid'] == os.getpid():
+                filter['map'].close()
+                os.close(filter['fd'])
+            
+            self.filters[name] = dict(pid=os.getpid(), fd=fd, map=mapped, inode=os.fstat(fd).st_ino,
+                                      bits=bits, hashes=hashes, checked=now, warned=False)
+            
+            return self.filters[name]
+    
+    def _build(self, layer):
+        """ Start building a filter for a layer in the background, unless it's underway.
+        
+            Attempts are made at most once a minute.
+        """
+        name, now = layer.name(), time.time()
+        
+        with self.filters_lock:
+            if name in self.building or now - self.attempted.get(name, 0) < 60:
+                return
+            
+            self.building.add(name)
+            self.attempted[name] = now
+        
+        builder = Thread(target=self._build_filter, args=(layer, ))
+        builder.setDaemon(True)
+        builder.start()
+    
+    def _build_filter(self, layer):
+        """ Build a filter for a layer from a listing of the cache, if there's none yet.
+        
+            Only one process builds a filter at a time, while the others read
+            without one. Tiles logged by every process while there was no
+            filter are added at the end, and the finished filter is moved into
+            place while the log is locked, so no saved tile is missed.
+        """
+        path = self._filepath(layer)
+        
+        try:
+            try:
+                os.makedirs(self.path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            
+            lock_fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0666)
+            _set_cloexec(lock_fd)
+            
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # another process is building it.
+                os.close(lock_fd)
+                return
+            
+            try:
+                if exists(path):
+                    return
+                
+                handle, tmp_path = mkstemp(dir=self.path, suffix='.bloom-tmp')
+                
+                try:
+                    os.write(handle, _filter_header.pack(_filter_magic, self.bits, self.hashes, 0))
+                    os.ftruncate(handle, _filter_header.size + self.bits / 8)
+                    mapped = mmap.mmap(handle, 0)
+                    
+                    if hasattr(self.cache, 'list_tiles'):
+                        tiles = []
+                        
+                        for (coord, format) in self.cache.list_tiles(layer):
+                            tiles.append(self._positions(self.bits, self.hashes, coord, format))
+                            
+                            if len(tiles) >= 1000:
+                                _set_filter_bits(mapped, self.bits, self.hashes, tiles)
+                                tiles = []
+                        
+                        _set_filter_bits(mapped, self.bits, self.hashes, tiles)
+                    
+                    saves_fd = os.open(path + '.saves', os.O_RDWR | os.O_CREAT, 0666)
+                    _set_cloexec(saves_fd)
+                    
+                    try:
+                        # saves wait while the log is added and the filter moved into place.
+                        fcntl.flock(saves_fd, fcntl.LOCK_EX)
+                        
+                        for line in _read_at(saves_fd, 0, os.fstat(saves_fd).st_size).splitlines():
+                            tile, format = line.split(' ')
+                            zoom, column, row = map(int, tile.split('/'))
+                            position = self._positions(self.bits, self.hashes, Coordinate(row, column, zoom), format)
+                            _set_filter_bits(mapped, self.bits, self.hashes, [position])
+                        
+                        mapped.close()
+                        os.close(handle)
+                        handle = None
+                        
+                        os.chmod(tmp_path, 0644)
+                        os.rename(tmp_path, path)
+                        os.unlink(path + '.saves')
+                    
+                    finally:
+                        os.close(saves_fd)
+                
+                except:
+                    if handle is not None:
+                        os.close(handle)
+                        os.unlink(tmp_path)
+                    raise
+                
+                logging.info('TileStache.Caches.ExistenceFilter._build_filter() built %s', path)
+            
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+                os.close(lock_fd)
+        
+        except:
+            logging.exception('TileStache.Caches.ExistenceFilter._build_filter() failed to build %s', path)
+        
+        finally:
+            with self.filters_lock:
+                self.building.discard(layer.name())
+
+def _set_filter_bits(mapped, bits, hashes, tiles):
+    """ Set bits for a list of tiles' positions in a mapped filter, and add to its count.
+    
+        Tiles with every bit already set are probably in the filter, and not counted again.
+    """
+    offset, added = _filter_header.size, 0
+    
+    for positions in tiles:
+        new = False
+        
+        for position in positions:
+            index, bit = offset + position / 8, 1 << (position % 8)
+            byte = ord(mapped[index])
+            
+            if not byte & bit:
+                mapped[index] = chr(byte | bit)
+                new = True
+        
+        added += new
+    
+    magic, bits, hashes, count = _filter_header.unpack(mapped[:offset])
+    mapped[:offset] = _filter_header.pack(magic, bits, hashes, count + added)
+
+def _filter_count(mapped):
+    """ Return the number of tiles added to a mapped filter.
+    """
+    return _filter_header.unpack(mapped[:_filter_header.size])[3]
+
+def _read_at(fd, offset, length):
+    """ Read up to length bytes from a file descriptor at an offset.
+    """
+    os.lseek(fd, offset, os.SEEK_SET)
+    chunks = []
+    
+    while length > 0:
+        chunk = os.read(fd, length)
+        
+        if not chunk:
+            break
+        
+        chunks.append(chunk)
+        length -= len(chunk)
+    
+    return ''.join(chunks)
+
+def _write_at(fd, offset, data):
+    """ Write all of some data to a file descriptor at an offset.
+    """
+    os.lseek(fd, offset, os.SEEK_SET)
+    
+    while data:
+        data = data[os.write(fd, data):]
+
+def _set_cloexec(fd):
+    """ Keep a file descriptor from leaking into executed child processes.
+    """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def _create_lock_file(lockpath, mode):
+    """ Create a lock file with this host and pid, lock it, and link it into place.
+    
+        Return its open file descriptor, or None if there's a lock file
+        already. Filesystems without hard links raise ENOTSUP, so callers
+        can fall back to another kind of lock.
+    """
+    tmp_path = '%s.%s-%d-%d.tmp' % (lockpath, socket.gethostname(), os.getpid(), _thread_ident())
+    fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, mode)
+    linked = False
+    
+    try:
+        _set_cloexec(fd)
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.write(fd, '%s %d\n' % (socket.gethostname(), os.getpid()))
+        
+        try:
+            # fails if there's a lock file already, whoever holds it.
+            os.link(tmp_path, lockpath)
+            linked = True
+        except OSError, e:
+            if e.errno == errno.EPERM:
+                raise OSError(errno.ENOTSUP, 'Hard links are not supported', lockpath)
+            elif e.errno != errno.EEXIST:
+                raise
+    
+    finally:
+        os.unlink(tmp_path)
+        
+        if not linked:
+            os.close(fd)
+    
+    if linked:
+        return fd
+
+def _wait_for_flock(fd, lockpath, due):
+    """ Wait on the exclusive flock() of an open lock file held by someone else until due.
+    
+        Return "moved" once the file at lockpath is no longer the one we
+        locked, or "broken" if the holder was found to be stale and its lock
+        file was removed. A file we get the lock on is left behind by a
+        process that died, and is removed too; try creating another after.
+    """
+    _set_cloexec(fd)
+    
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        
+        if not _holder_is_alive(fd) or not _flock_wait(fd, due - time.time()):
+            # someone left the door locked.
+            logging.warning('TileStache.Caches.Disk.lock() breaking stale lock %s held by "%s"', lockpath, _read_holder(fd))
+            _remove_lock_file(fd, lockpath)
+            return 'broken'
+    
+    # previous holder unlinked the file before releasing it, unless it died.
+    _remove_lock_file(fd, lockpath)
+    return 'moved'
+
+def _remove_lock_file(fd, lockpath):
+    """ Remove the file at lockpath, if it's still the one open as fd.
+    
+        The file is moved aside before its inode is compared, so a new lock
+        file that replaced it meanwhile is noticed and put back instead of
+        removed. This is best-effort: another lock file could be linked into
+        place while one is moved aside.
+    """
+    try:
+        if os.stat(lockpath).st_ino != os.fstat(fd).st_ino:
+            return
+    except OSError:
+        return
+    
+    aside = '%s.%s-%d-%d.broken' % (lockpath, socket.gethostname(), os.getpid(), _thread_ident())
+    
+    try:
+        os.rename(lockpath, aside)
+    except OSError:
+        # Oh - someone beat us to it.
+        return
+    
+    try:
+        if os.stat(aside).st_ino != os.fstat(fd).st_ino:
+            os.link(aside, lockpath)
+    except OSError, e:
+        logging.warning('TileStache.Caches.Disk.lock() could not put back lock %s: %s', lockpath, e)
+    
+    os.unlink(aside)
+
+def _flock_wait(fd, timeout):
+    """ Poll for an exclusive flock() for up to timeout seconds.
+    
+        Return true if the lock was acquired. Polls start a few milliseconds
+        apart and slow to twenty a second, so a released lock is noticed
+        quickly without keeping a thread blocked on it.
+    """
+    due, delay = time.time() + timeout, .002
+    
+    while True:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        
+        if time.time() >= due:
+            return False
+        
+        time.sleep(min(delay, max(due - time.time(), 0)))
+        delay = min(delay * 2, .05)
+
+def _read_holder(fd):
+    """ Return the "hostname pid" string written by the current lock holder.
+    """
+    try:
+        os.lseek(fd, 0, os.SEEK_SET)
+        return os.read(fd, 1024).strip()
+    except OSError:
+        return ''
+
+def _holder_is_alive(fd):
+    """ Check whether the process holding a lock might still be running.
+    
+        Only processes on this host can be checked, others are assumed alive.
+    """
+    try:
+        hostname, pid = _read_holder(fd).split()
+        pid = int(pid)
+    except ValueError:
+        # lock was just created, or written by something else.
+        return True
+    
+    if hostname != socket.gethostname() or pid == os.getpid():
+        return True
+    
+    return _process_is_alive(pid)
+
+def _process_is_alive(pid):
+    """ Check whether a process on this host might still be running.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    
+    return True
@@ -0,0 +1,182 @@
+""" Compact records of seeded tiles, so an interrupted seeding run can pick up where it left off.
+
+A completion file holds one bit for each tile in a range of rows and columns
+at each zoom level, set once the tile has been seeded. The bits are kept in
+a memory-mapped file, so a day-long run over millions of tiles needs only a
+few megabytes, and the coverage of a run can be counted without looking at
+the cache at all. Used by tilestache-seed.py for --resume.
+
+Seeded tiles are marked as they're done, and written to the file at each
+checkpoint. Whoever calls checkpoint() should first make sure the marked
+tiles are really saved, e.g. by flushing a cache that writes in batches.
+
+Example:
+
+    completion = Completion('osm.done', {12: (1582, 654, 1584, 656)}, dict(layer='osm'))
+    completion.mark(Coordinate(1583, 655, 12))
+    completion.checkpoint()
+    completion.done(Coordinate(1583, 655, 12)) # True
+    completion.coverage() # [(12, 1, 4)]
+    completion.close()
+"""
+from binascii import hexlify
+import json
+import mmap
+import time
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # no locks, but completion files still work.
+    fcntl = None
+
+_magic = 'TSDONE\x00\x01'
+
+class Completion:
+    """ One bit for each tile of ranges by zoom, in a memory-mapped file.
+
+        Ranges is a dictionary of (top, left, bottom, right) tuples by zoom,
+        with bottom and right excluded, and description a dictionary of
+        anything else that identifies the tiles, like layer name and format.
+        Totals is an optional dictionary of numbers of tiles to seed by zoom,
+        for ranges that aren't seeded whole, e.g. from a list of tiles.
+
+        A new file is created if there isn't one at the path. An existing
+        file must have been created with the same ranges and description,
+        or ValueError is raised. With no ranges, an existing file is opened
+        as it is to read, e.g. to report coverage while it's being written.
+    """
+    def __init__(self, path, ranges=None, description=None, totals=None):
+        self.path = path
+        self.pending = []
+        self.checkpointed = time.time()
+
+        if ranges is not None:
+            totals = totals or dict([(zoom, _count(ranges[zoom])) for zoom in ranges])
+            ranges = dict([(zoom, tuple(ranges[zoom]) + (totals[zoom], )) for zoom in ranges])
+            header = json.dumps(dict(ranges=sorted([(zoom, ) + ranges[zoom] for zoom in ranges]),
+                                     description=description or {}), sort_keys=True)
+
+        if ranges is not None and not os.path.exists(path):
+            size = len(_magic) + 8 + len(header) + sum([_bytes(ranges[zoom][:4]) for zoom in ranges])
+
+            file = open(path, 'w+b')
+            file.write('%s%08x%s' % (_magic, len(header), header))
+            file.truncate(size)
+            file.close()
+
+        # only one seeding run writes to a file, but anyone can read it.
+        self.writable = ranges is not None
+        self.file = open(path, self.writable and 'r+b' or 'rb')
+
+        if self.writable and fcntl is not None:
+            try:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                self.file.close()
+                raise ValueError('Completion file %s is in use by another seeding run' % path)
+
+        self.map = mmap.mmap(self.file.fileno(), 0, access=(self.writable and mmap.ACCESS_WRITE or mmap.ACCESS_READ))
+
+        if self.map[:len(_magic)] != _magic:
+            self.close()
+            raise ValueError('%s is not a completion file' % path)
+
+        length = int(self.map[len(_magic):len(_magic) + 8], 16)
+        offset = len(_magic) + 8 + length
+        found = json.loads(self.map[len(_magic) + 8:offset])
+
+        if ranges is not None and found != json.loads(header):
+            self.close()
+            raise ValueError('Completion file %s was written for another area, zoom levels, layer or format' % path)
+
+        self.description = found['description']
+        self.ranges = dict()
+
+        # zoom ranges of tiles, each with its total and the offset of its bits.
+        for (zoom, top, left, bottom, right, total) in found['ranges']:
+            self.ranges[zoom] = top, left, bottom, right, total, offset
+            offset += _bytes((top, left, bottom, right))
+
+    def done(self, coord):
+        """ Return true if a tile was marked at a checkpoint.
+        """
+        position = self._position(coord)
+
+        if position is None:
+            return False
+
+        return bool(ord(self.map[position / 8]) & (1 << (position % 8)))
+
+    def mark(self, coord):
+        """ Mark a tile as seeded, to be written at the next checkpoint.
+
+            Tiles outside the ranges are ignored.
+        """
+        self.pending.append(coord)
+
+    def checkpoint(self):
+        """ Write tiles marked since the last checkpoint, and flush the file to disk.
+        """
+        pending, self.pending = self.pending, []
+
+        for coord in pending:
+            position = self._position(coord)
+
+            if position is not None:
+                index = position / 8
+                self.map[index] = chr(ord(self.map[index]) | (1 << (position % 8)))
+
+        self.map.flush()
+        self.checkpointed = time.time()
+
+    def coverage(self):
+        """ Return a list of (zoom, done, total) tuples, counting tiles marked at checkpoints.
+        """
+        counts = []
+
+        for zoom in sorted(self.ranges.keys()):
+            top, left, bottom, right, total, offset = self.ranges[zoom]
+            data = self.map[offset:offset + _bytes((top, left, bottom, right))]
+            done = data and bin(int(hexlify(data), 16)).count('1') or 0
+
+            counts.append((zoom, done, total))
+
+        return counts
+
+    def close(self):
+        """ Write any tiles marked since the last checkpoint, and close the file.
+        """
+        if hasattr(self, 'map'):
+            if self.writable:
+                self.checkpoint()
+
+            self.map.close()
+
+        self.file.close()
+
+    def _position(self, coord):
+        """ Return the bit position of a tile in the file, or None if it's outside the ranges.
+        """
+        if coord.zoom not in self.ranges:
+            return None
+
+        top, left, bottom, right, total, offset = self.ranges[coord.zoom]
+        row, column = int(coord.row), int(coord.column)
+
+        if row < top or row >= bottom or column < left or column >= right:
+            return None
+
+        return offset * 8 + (row - top) * (right - left) + (column - left)
+
+def _count(extent):
+    """ Return the number of tiles in a (top, left, bottom, right) range.
+    """
+    top, left, bottom, right = extent
+    return max(bottom - top, 0) * max(right - left, 0)
+
+def _bytes(extent):
+    """ Return the number of bytes needed for one bit per tile of a (top, left, bottom, right) range.
+    """
+    return (_count(extent) + 7) / 8
@@ -295,26 +295,46 @@ def _parseConfigfileCache(cache_dict, dirpath):
             if 'umask' in cache_dict:
                 kwargs['umask'] = int(cache_dict['umask'], 8)
             
-            add_kwargs('dirs', 'gzip')
+            add_kwargs('dirs', 'gzip', 'noatime', 'locking')
+        
+        elif _class is Caches.Bundle:
+            kwargs['path'] = enforcedLocalPath(cache_dict['path'], dirpath, 'Bundle cache path')
+            
+            if 'umask' in cache_dict:
+                kwargs['umask'] = int(cache_dict['umask'], 8)
+            
+            add_kwargs('dirs', 'size', 'compact', 'noatime', 'locking')
         
         elif _class is Caches.Multi:
-            kwargs['tiers'] = [_parseConfigfileCache(tier_dict, dirpath)
+            kwargs['tiers'] = [_parseConfigfileTier(tier_dict, dirpath)
                                for tier_dict in cache_dict['tiers']]
+            
+            add_kwargs('hedge', 'threads', 'backfill')
     
         elif _class is Caches.Memcache.Cache:
             if 'key prefix' in cache_dict:
                 kwargs['key_prefix'] = cache_dict['key prefix']
         
-            add_kwargs('servers', 'lifespan', 'revision')
+            if 'compress threshold' in cache_dict:
+                kwargs['compress_threshold'] = int(cache_dict['compress threshold'])
+        
+            add_kwargs('servers', 'lifespan', 'revision', 'compress', 'persistent')
 
         elif _class is Caches.Redis.Cache:
             if 'key prefix' in cache_dict:
                 kwargs['key_prefix'] = cache_dict['key prefix']
 
+            if 'max connections' in cache_dict:
+                kwargs['max_connections'] = int(cache_dict['max connections'])
+
             add_kwargs('host', 'port', 'db')
     
         elif _class is Caches.S3.Cache:
-            add_kwargs('bucket', 'access', 'secret', 'use_locks', 'path', 'reduced_redundancy')
+            add_kwargs('bucket', 'access', 'secret', 'use_locks', 'path', 'reduced_redundancy', 'host', 'port', 'is_secure', 'threads')
+    
+        elif _class is Caches.LMDB.Cache:
+            kwargs['path'] = enforcedLocalPath(cache_dict['path'], dirpath, 'LMDB cache path')
+            add_kwargs('size')
     
         else:
             raise Exception('Unknown cache: %s' % cache_dict['name'])
@@ -328,7 +348,42 @@ def _parseConfigfileCache(cache_dict, dirpath):
         raise Exception('Missing required cache name or class: %s' % json_dumps(cache_dict))
 
     cache = _class(**kwargs)
+    
+    if 'existence filter' in cache_dict:
+        filter_dict = cache_dict['existence filter']
+        path = enforcedLocalPath(filter_dict['path'], dirpath, 'Existence filter path')
+        
+        kwargs = {}
+        
+        if 'capacity' in filter_dict:
+            kwargs['capacity'] = int(filter_dict['capacity'])
+        
+        if 'error rate' in filter_dict:
+            kwargs['error_rate'] = float(filter_dict['error rate'])
+        
+        cache = Caches.ExistenceFilter(cache, path, **kwargs)
+
+    return cache
 
+def _parseConfigfileTier(tier_dict, dirpath):
+    """ Used by _parseConfigfileCache() to parse one tier of a Multi cache.
+    """
+    cache = _parseConfigfileCache(tier_dict, dirpath)
+    
+    if 'write behind' in tier_dict:
+        behind_dict = tier_dict['write behind']
+        spool = enforcedLocalPath(behind_dict['spool'], dirpath, 'Write behind spool')
+        
+        kwargs = {}
+        
+        if 'threads' in behind_dict:
+            kwargs['threads'] = int(behind_dict['threads'])
+        
+        if 'spool size' in behind_dict:
+            kwargs['spool_size'] = int(behind_dict['spool size'])
+        
+        cache = Caches.WriteBehind(cache, spool, **kwargs)
+    
     return cache
 
 def _parseLayerBounds(bounds_dict, projection):
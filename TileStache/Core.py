@@ -454,6 +454,14 @@ class Layer:
         
         return status_code, headers, body
 
+    def recentTile(self, coord, format):
+        """ Return the body of a recently-rendered tile, or None if it's not there.
+        
+            Tiles of a metatile are kept for a few minutes after it's rendered,
+            so that the others can be used without rendering it again.
+        """
+        return _getRecentTile(self, coord, format)
+    
     def doMetatile(self):
         """ Return True if we have a real metatile and the provider is OK with it.
         """
@@ -521,7 +529,7 @@ class Layer:
         
         if self.doMetatile():
             # tile will be set again later
-            tile, surtile = None, tile
+            tile, surtile, saved = None, tile, []
             
             for (other, x, y) in subtiles:
                 buff = StringIO()
@@ -535,13 +543,21 @@ class Layer:
                 body = buff.getvalue()
 
                 if self.write_cache:
-                    self.config.cache.save(body, self, other, format)
+                    saved.append((other, body))
                 
                 if other == coord:
                     # the one that actually gets returned
                     tile = subtile
                 
                 _addRecentTile(self, other, format, body)
+            
+            if saved and hasattr(self.config.cache, 'save_many'):
+                # some caches can write a whole metatile in one go
+                self.config.cache.save_many(saved, self, format)
+            
+            else:
+                for (other, body) in saved:
+                    self.config.cache.save(body, self, other, format)
         
         return tile
     
@@ -0,0 +1,153 @@
+""" Tiles covering the polygons, lines or points of a GeoJSON file, for seeding and listing.
+
+Requires shapely:
+  https://pypi.python.org/pypi/Shapely
+
+  pip install shapely
+
+A bounding box around a country or along a coastline holds many more tiles
+than the area itself. Coverage answers whether ranges of tiles are outside
+an area, partly in it or entirely inside it, so TileStache.Curves can split
+them only along its edges and generate just the tiles that touch it: ranges
+well inside are taken whole, and ranges well outside are dropped whole.
+
+Example:
+
+    coverage = Coverage(read_geojson('country.geojson'), layer.projection)
+    ul, lr = coverage.corners()
+
+    ranges = tile_ranges(ul, lr, zooms, 0, 'hilbert', coverage.test)
+    tiles = walk_tiles('hilbert', ranges, zooms, within=coverage.test)
+
+Scripts with a bounding box and an optional --geometry get their corners
+and coverage from tile_area().
+"""
+import json
+
+from ModestMaps.Core import Coordinate
+from ModestMaps.Geo import Location
+
+from .Core import KnownUnknown
+from .Curves import inside
+
+try:
+    from shapely.geometry import shape, box
+    from shapely.ops import unary_union, transform
+    from shapely.prepared import prep
+except ImportError:
+    # at least we can build the documentation
+    pass
+
+# latitude where web mercator meets the edge of the world.
+_max_latitude = 85.0511287798
+
+def read_geojson(filename):
+    """ Return a shapely geometry in longitude and latitude from a GeoJSON file.
+
+        The file may hold a feature collection, a feature, or a geometry,
+        and the geometries of every feature are combined.
+    """
+    data = json.load(open(filename, 'r'))
+
+    if data.get('type') == 'FeatureCollection':
+        geometries = [feature['geometry'] for feature in data['features'] if feature.get('geometry')]
+    elif data.get('type') == 'Feature':
+        geometries = [data['geometry']]
+    else:
+        geometries = [data]
+
+    shapes = []
+
+    for geometry in map(shape, geometries):
+        # self-crossing polygons are common enough in the wild to fix up.
+        if geometry.geom_type in ('Polygon', 'MultiPolygon') and not geometry.is_valid:
+            geometry = geometry.buffer(0)
+
+        shapes.append(geometry)
+
+    return unary_union(shapes)
+
+def tile_area(projection, bbox, geometry=None, padding=0):
+    """ Return upper-left and lower-right coordinates, and a Coverage or None, for an area of tiles.
+
+        Bbox is a (lat1, lon1, lat2, lon2) tuple of two opposite corners,
+        and geometry an optional GeoJSON filename whose area is used instead.
+    """
+    if geometry:
+        try:
+            import shapely
+        except ImportError:
+            raise KnownUnknown('A --geometry needs shapely, try `pip install shapely`.')
+
+        coverage = Coverage(read_geojson(geometry), projection, padding)
+        ul, lr = coverage.corners()
+
+        return ul, lr, coverage
+
+    lat1, lon1, lat2, lon2 = bbox
+    south, west = min(lat1, lat2), min(lon1, lon2)
+    north, east = max(lat1, lat2), max(lon1, lon2)
+
+    ul = projection.locationCoordinate(Location(north, west))
+    lr = projection.locationCoordinate(Location(south, east))
+
+    return ul, lr, None
+
+class Coverage:
+    """ Answers whether ranges of tiles are in an area, for TileStache.Curves.
+
+        Geometry is a shapely geometry in longitude and latitude, e.g. from
+        read_geojson(), and projection the layer's projection. Padding is an
+        optional number of tiles at each zoom to add around the area.
+    """
+    def __init__(self, geometry, projection, padding=0):
+        self.projection = projection
+        self.padding = padding
+
+        # geometry in columns and rows of tiles at zoom zero.
+        self.geometry = transform(self._project, geometry)
+        self.prepared = prep(self.geometry)
+
+        # points and lines, which have no area to keep off the edges of tiles.
+        parts = getattr(self.geometry, 'geoms', [self.geometry])
+        lineal = [part for part in parts if part.geom_type not in ('Polygon', 'MultiPolygon')]
+        self.lineal = lineal and prep(unary_union(lineal)) or None
+
+    def corners(self):
+        """ Return upper-left and lower-right coordinates at zoom zero around the area.
+        """
+        left, top, right, bottom = self.geometry.bounds
+        return Coordinate(top, left, 0), Coordinate(bottom, right, 0)
+
+    def test(self, zoom, top, left, bottom, right):
+        """ Return false for a range of tiles outside the area, inside if entirely inside, or true otherwise.
+
+            Bottom and right are excluded. A range only sharing an edge or a
+            corner with a polygon is outside, but one with a point or a line
+            on its edge is in.
+        """
+        scale, padding = float(2 ** zoom), self.padding
+
+        if self.prepared.contains(box(left / scale, top / scale, right / scale, bottom / scale)):
+            return inside
+
+        padded = box((left - padding) / scale, (top - padding) / scale,
+                     (right + padding) / scale, (bottom + padding) / scale)
+
+        if not self.prepared.intersects(padded):
+            return False
+
+        return not self.prepared.touches(padded) or bool(self.lineal and self.lineal.intersects(padded))
+
+    def _project(self, xs, ys, zs=None):
+        """ Project lists of longitudes and latitudes to lists of columns and rows at zoom zero.
+        """
+        columns, rows = [], []
+
+        for (lon, lat) in zip(xs, ys):
+            lat = max(-_max_latitude, min(lat, _max_latitude))
+            coord = self.projection.locationCoordinate(Location(lat, lon)).zoomTo(0)
+            columns.append(coord.column)
+            rows.append(coord.row)
+
+        return columns, rows
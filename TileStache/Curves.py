@@ -0,0 +1,313 @@
+""" Orderings of tiles along space-filling curves, for seeding and listing.
+
+Row by row is the simplest way to walk an area of tiles, but tiles close
+together in that order can be far apart on the map: the end of one row is
+nowhere near the start of the next. Along a Hilbert or Z-order curve, tiles
+close together in order are close together on the map too, so the caches of
+a database, raster files or renderer keep hold of the data they need, and
+any run of tiles covers a compact area.
+
+Orders:
+
+  row
+    Row by row from the top, left to right.
+
+  zorder
+    Z-order or Morton curve: each quadrant in turn, top-left, top-right,
+    bottom-left and bottom-right, and the same within each. Quick to
+    compute, but with jumps between some quadrants.
+
+  hilbert
+    Hilbert curve: quadrants turned so each step is to a neighboring tile.
+    This is the order of tile IDs in PMTiles archives.
+
+Both curves walk a quadtree, so tiles can also be walked with parents before
+their children, see walk_quadtree().
+
+Tiles can be limited to an area with a function answering whether a range
+of tiles is outside it, partly in it or entirely inside it, see walk_tiles().
+Ranges are split in quarters, or in halves along rows, only where they're
+partly in the area, so tiles well inside or outside cost nothing to check.
+"""
+
+orders = ('row', 'zorder', 'hilbert')
+
+# answer of functions like the within argument to walk_tiles(), for ranges
+# of tiles entirely inside an area: false means outside, and true partly in.
+inside = 2
+
+# quadrants of each curve in order, as (column, row) offsets in halves.
+_quadrants = {
+    'zorder': [(0, 0), (1, 0), (0, 1), (1, 1)],
+    'hilbert': [(0, 0), (0, 1), (1, 1), (1, 0)]
+    }
+
+def walk_quadtree(order, levels, include):
+    """ Generate (level, row, column) tuples for quadtree tiles along a curve.
+
+        Tiles are walked from level zero to the given number of levels, each
+        tile before its four children. The include function is called with
+        the level, row and column of each tile, and the tile and everything
+        under it are skipped when it returns false.
+    """
+    if order not in _quadrants:
+        raise ValueError('Unknown curve order "%s", try one of %s' % (order, ', '.join(orders[1:])))
+
+    quadrants = _quadrants[order]
+
+    # a tile is an area of the deepest level, mapped from its own local
+    # columns and rows (a, b) as x = ox + xa * a + xb * b, y = oy + ya * a + yb * b.
+    stack = [(0, 1 << levels, 0, 0, 1, 0, 0, 1)]
+
+    while stack:
+        level, size, ox, oy, xa, xb, ya, yb = stack.pop()
+
+        # every mapping is a quarter turn or flip, so corners give the bounds.
+        left, top = min(ox, ox + (xa + xb) * (size - 1)), min(oy, oy + (ya + yb) * (size - 1))
+        row, column = top / size, left / size
+
+        if not include(level, row, column):
+            continue
+
+        yield level, row, column
+
+        if level == levels:
+            continue
+
+        half, children = size / 2, []
+
+        for (qa, qb) in quadrants:
+            # origin and axes of the quadrant in local columns and rows.
+            if order == 'zorder' or qb == 1:
+                ca, cb, aa, ab, ba, bb = qa * half, qb * half, 1, 0, 0, 1
+            elif qa == 0:
+                ca, cb, aa, ab, ba, bb = 0, 0, 0, 1, 1, 0
+            else:
+                ca, cb, aa, ab, ba, bb = 2 * half - 1, half - 1, 0, -1, -1, 0
+
+            children.append((level + 1, half, ox + xa * ca + xb * cb, oy + ya * ca + yb * cb,
+                             xa * aa + xb * ba, xa * ab + xb * bb, ya * aa + yb * ba, ya * ab + yb * bb))
+
+        children.reverse()
+        stack.extend(children)
+
+def walk_cells(order, top, left, bottom, right, within=None):
+    """ Generate (row, column) tuples for cells of a grid along a curve.
+
+        Cells are limited to rows from top up to but not including bottom,
+        and columns from left up to but not including right. Negative rows
+        and columns are skipped along curves.
+
+        Within is an optional function called with top, left, bottom and
+        right of a range of cells, returning false if it's outside an area,
+        inside if it's entirely inside, or true otherwise. Only cells in the
+        area are generated.
+    """
+    for (row, column, answer) in _walk_cells(order, top, left, bottom, right, within):
+        yield row, column
+
+def _walk_cells(order, top, left, bottom, right, within):
+    """ Generate (row, column, answer) tuples for walk_cells(), with the answer of within.
+    """
+    if order == 'row':
+        for row in xrange(top, bottom):
+            if within is None:
+                for column in xrange(left, right):
+                    yield row, column, True
+
+                continue
+
+            # spans of the row are split in half where they're partly in the area.
+            spans = [(left, right)]
+
+            while spans:
+                start, end = spans.pop()
+                answer = start < end and within(row, start, row + 1, end)
+
+                if answer == inside or (answer and end - start == 1):
+                    for column in xrange(start, end):
+                        yield row, column, answer
+
+                elif answer:
+                    middle = (start + end) / 2
+                    spans.extend([(middle, end), (start, middle)])
+
+        return
+
+    levels, answers = 0, dict()
+
+    while (1 << levels) < max(bottom, right):
+        levels += 1
+
+    def include(level, row, column):
+        size = 1 << (levels - level)
+        cells = max(row * size, top), max(column * size, left), min((row + 1) * size, bottom), min((column + 1) * size, right)
+
+        if cells[0] >= cells[2] or cells[1] >= cells[3]:
+            return False
+
+        # children come right after their parent, whose answer is kept.
+        if within is None or (level and answers[level - 1] == inside):
+            answers[level] = level and answers[level - 1] or True
+        else:
+            answers[level] = within(*cells)
+
+        return answers[level]
+
+    for (level, row, column) in walk_quadtree(order, levels, include):
+        if level == levels:
+            yield row, column, answers[level]
+
+def tile_ranges(ul, lr, zooms, padding=0, order='row', within=None):
+    """ Return a dictionary of (top, left, bottom, right) tile ranges by zoom for walk_tiles().
+
+        Ul and lr are upper-left and lower-right coordinates, e.g. from
+        ModestMaps, and padding a number of tiles to add around them at
+        each zoom. Bottom and right are excluded. Curves and areas only
+        cover the world, so ranges are clipped to it for an order other
+        than "row" or with a within function.
+    """
+    ranges = dict()
+
+    for zoom in zooms:
+        ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
+        lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
+
+        top, left, bottom, right = int(ul_.row), int(ul_.column), int(lr_.row + 1), int(lr_.column + 1)
+
+        if order != 'row' or within:
+            top, left = max(top, 0), max(left, 0)
+            bottom, right = min(bottom, 2**zoom), min(right, 2**zoom)
+
+        ranges[zoom] = top, left, bottom, right
+
+    return ranges
+
+def walk_tiles(order, ranges, zooms, rows=1, columns=1, interleave=False, within=None):
+    """ Generate (zoom, row, column) tuples for tiles at several zoom levels.
+
+        Ranges is a dictionary of (top, left, bottom, right) tuples by zoom,
+        with bottom and right excluded, and must cover every zoom up to the
+        highest of zooms when interleaving. Tiles are walked one metatile of
+        rows and columns at a time, row by row within each metatile.
+
+        Zooms are walked one after another, unless interleave is true: then
+        each metatile comes before the metatiles covering its area at higher
+        zooms, which needs a curve order and square metatiles with a power
+        of two size.
+
+        Within is an optional function called with a zoom and the top, left,
+        bottom and right of a range of tiles at that zoom, returning false if
+        it's outside an area, inside if it's entirely inside, or true if it's
+        partly in it. Only tiles in the area are generated. Ranges must then
+        be within the world.
+    """
+    def metatile_tiles(zoom, meta_row, meta_column, answer=True):
+        top, left, bottom, right = ranges[zoom]
+
+        for row in xrange(max(meta_row * rows, top), min((meta_row + 1) * rows, bottom)):
+            for column in xrange(max(meta_column * columns, left), min((meta_column + 1) * columns, right)):
+                # tiles of metatiles partly in the area are checked one by one.
+                if within is None or answer == inside or rows * columns == 1 or within(zoom, row, column, row + 1, column + 1):
+                    yield zoom, row, column
+
+    def metatile_within(zoom):
+        top, left, bottom, right = ranges[zoom]
+
+        def within_cells(meta_top, meta_left, meta_bottom, meta_right):
+            return within(zoom, max(meta_top * rows, top), max(meta_left * columns, left),
+                          min(meta_bottom * rows, bottom), min(meta_right * columns, right))
+
+        return within and within_cells or None
+
+    if not interleave:
+        for zoom in zooms:
+            top, left, bottom, right = ranges[zoom]
+            cells = _walk_cells(order, top / rows, left / columns, (bottom - 1) / rows + 1,
+                                (right - 1) / columns + 1, metatile_within(zoom))
+
+            for (meta_row, meta_column, answer) in cells:
+                for tile in metatile_tiles(zoom, meta_row, meta_column, answer):
+                    yield tile
+
+        return
+
+    if order == 'row':
+        raise ValueError('Zooms can only be interleaved along a curve')
+
+    if rows != columns or rows & (rows - 1):
+        raise ValueError('Zooms can only be interleaved with square metatiles of 1, 2, 4, 8... tiles')
+
+    zooms, shift = set(zooms), len(bin(rows)) - 3
+
+    # zooms with fewer tiles than a metatile fit in one, at the top.
+    for zoom in sorted(zooms):
+        if zoom < shift:
+            for tile in metatile_tiles(zoom, 0, 0, within is None or within(zoom, *ranges[zoom])):
+                yield tile
+
+    answers = dict()
+
+    def include(level, meta_row, meta_column):
+        top, left, bottom, right = ranges[level + shift]
+
+        if meta_row * rows >= bottom or (meta_row + 1) * rows <= top \
+        or meta_column * columns >= right or (meta_column + 1) * columns <= left:
+            return False
+
+        # metatiles come right after the one above them, whose answer is kept.
+        if within is None or (level and answers[level - 1] == inside):
+            answers[level] = level and answers[level - 1] or True
+        else:
+            answers[level] = metatile_within(level + shift)(meta_row, meta_column, meta_row + 1, meta_column + 1)
+
+        return answers[level]
+
+    if max(zooms) < shift:
+        return
+
+    for (level, meta_row, meta_column) in walk_quadtree(order, max(zooms) - shift, include):
+        if level + shift in zooms:
+            for tile in metatile_tiles(level + shift, meta_row, meta_column, answers[level]):
+                yield tile
+
+def count_tiles(ranges, zooms, within=None):
+    """ Return the number of tiles walk_tiles() would generate, without walking them all.
+
+        Ranges entirely inside the area of within are counted whole.
+    """
+    count = 0
+
+    for zoom in zooms:
+        top, left, bottom, right = ranges[zoom]
+
+        if within is None:
+            count += max(bottom - top, 0) * max(right - left, 0)
+            continue
+
+        counted, levels = [0], 0
+
+        while (1 << levels) < max(bottom, right):
+            levels += 1
+
+        def include(level, row, column):
+            size = 1 << (levels - level)
+            tiles = max(row * size, top), max(column * size, left), min((row + 1) * size, bottom), min((column + 1) * size, right)
+
+            if tiles[0] >= tiles[2] or tiles[1] >= tiles[3]:
+                return False
+
+            answer = within(zoom, *tiles)
+
+            if answer == inside or (answer and level == levels):
+                counted[0] += (tiles[2] - tiles[0]) * (tiles[3] - tiles[1])
+                return False
+
+            return answer
+
+        for tile in walk_quadtree('zorder', levels, include):
+            pass
+
+        count += counted[0]
+
+    return count
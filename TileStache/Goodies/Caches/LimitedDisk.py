@@ -14,14 +14,22 @@ Example TileStache cache configuration, with a 16MB limit:
         "limit": 16777216
     }
 }
+
+The total size is kept in memory, and new tiles and read times are written to
+the database in batches, every flush_size changes or flush_interval seconds.
+When the total goes over the limit, a background thread removes the least
+recently used tiles in bulk until the cache is back under nine tenths of it.
 """
 
 import os
-import sys
 import time
+import atexit
+import logging
 
 from math import ceil as _ceil
 from tempfile import mkstemp
+from threading import Thread, Lock, Event
+from weakref import ref
 from os.path import isdir, exists, dirname, basename, join as pathjoin
 from sqlite3 import connect, OperationalError, IntegrityError
 
@@ -44,20 +52,52 @@ _create_tables = """
     CREATE INDEX IF NOT EXISTS tiles_used ON tiles (used)
     """
 
+def _close(cache_ref):
+    """ Close a cache at exit if it still exists.
+    """
+    cache = cache_ref()
+    
+    if cache is not None:
+        cache.close()
+
 class Cache:
 
-    def __init__(self, path, limit, umask=0022):
+    def __init__(self, path, limit, umask=0022, flush_size=100, flush_interval=5):
         self.cachepath = path
         self.dbpath = pathjoin(self.cachepath, 'stache.db')
         self.umask = umask
         self.limit = limit
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
 
-        db = connect(self.dbpath).cursor()
+        # one shared connection, used only while holding self.db_lock.
+        self.db, self.db_pid, self.db_lock = None, None, Lock()
+        
+        db = self._db()
         
         for create_table in _create_tables:
             db.execute(create_table)
 
-        db.connection.close()
+        self.total = db.execute('SELECT SUM(size) FROM tiles').fetchone()[0] or 0
+        db.commit()
+        
+        # pending changes to the tiles table, by path.
+        self.saved, self.used = {}, {}
+        self.flushed = time.time()
+        
+        self.evictor, self.evicting = None, Event()
+        
+        # flush at exit, without keeping the cache alive just for that.
+        atexit.register(_close, ref(self))
+
+    def _db(self):
+        """ Return a database connection for this process.
+        """
+        if self.db_pid != os.getpid():
+            self.db = connect(self.dbpath, check_same_thread=False)
+            self.db_pid = os.getpid()
+        
+        return self.db
 
     def _filepath(self, layer, coord, format):
         """
@@ -82,14 +122,14 @@ class Cache:
             Returns nothing, but (TODO) blocks until the lock has been acquired.
             Lock is implemented as a row in the "locks" table.
         """
-        sys.stderr.write('lock %d/%d/%d, %s' % (coord.zoom, coord.column, coord.row, format))
+        logging.debug('TileStache.Goodies.Caches.LimitedDisk.lock() %d/%d/%d, %s', coord.zoom, coord.column, coord.row, format)
 
         due = time.time() + layer.stale_lock_timeout
         
         while True:
             if time.time() > due:
                 # someone left the door locked.
-                sys.stderr.write('...force %d/%d/%d, %s' % (coord.zoom, coord.column, coord.row, format))
+                logging.warning('TileStache.Goodies.Caches.LimitedDisk.lock() forcing %d/%d/%d, %s', coord.zoom, coord.column, coord.row, format)
                 self.unlock(layer, coord, format)
             
             # try to acquire a lock, repeating if necessary.
@@ -114,7 +154,7 @@ class Cache:
 
             Lock is implemented as a row in the "locks" table.
         """
-        sys.stderr.write('unlock %d/%d/%d, %s' % (coord.zoom, coord.column, coord.row, format))
+        logging.debug('TileStache.Goodies.Caches.LimitedDisk.unlock() %d/%d/%d, %s', coord.zoom, coord.column, coord.row, format)
 
         db = connect(self.dbpath, isolation_level='EXCLUSIVE').cursor()
         db.execute("""DELETE FROM locks
@@ -126,35 +166,30 @@ class Cache:
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
         """
-        # TODO: write me
-        raise NotImplementedError('LimitedDisk Cache does not yet implement the .remove() method.')
+        path = self._filepath(layer, coord, format)
+        
+        with self.db_lock:
+            self._flush()
+            row = self._db().execute('SELECT size FROM tiles WHERE path=?', (path, )).fetchone()
+            self._remove([(path, row and row[0] or 0)])
         
     def read(self, layer, coord, format):
         """ Read a cached tile.
         
-            If found, update the used column in the tiles table with current time.
+            If found, remember to update the used column in the tiles table with current time.
         """
-        sys.stderr.write('read %d/%d/%d, %s' % (coord.zoom, coord.column, coord.row, format))
-
         path = self._filepath(layer, coord, format)
         fullpath = pathjoin(self.cachepath, path)
         
-        if exists(fullpath):
+        try:
             body = open(fullpath, 'r').read()
+        except IOError:
+            logging.debug('TileStache.Goodies.Caches.LimitedDisk.read() miss %s', path)
+            return None
 
-            sys.stderr.write('...hit %s, set used=%d' % (path, time.time()))
-
-            db = connect(self.dbpath).cursor()
-            db.execute("""UPDATE tiles
-                          SET used=?
-                          WHERE path=?""",
-                       (int(time.time()), path))
-            db.connection.commit()
-            db.connection.close()
-        
-        else:
-            sys.stderr.write('...miss')
-            body = None
+        with self.db_lock:
+            self.used[path] = int(time.time())
+            self._flush_if_due()
 
         return body
 
@@ -186,7 +221,13 @@ class Cache:
 
         os.chmod(fullpath, 0666&~self.umask)
         
-        stat = os.stat(fullpath)
+        return self._size(os.stat(fullpath))
+
+    def _size(self, stat):
+        """ Return the size of a file from its stat result.
+        
+            If filesystem block size is known, try to return actual disk space used.
+        """
         size = stat.st_size
         
         if hasattr(stat, 'st_blksize'):
@@ -195,50 +236,125 @@ class Cache:
 
         return size
 
-    def _remove(self, path):
+    def _remove(self, tiles):
+        """ Remove (path, size) tiles from the cache directory and the tiles table.
+        
+            Call only with self.db_lock held and pending changes flushed.
         """
+        for (path, size) in tiles:
+            try:
+                os.unlink(pathjoin(self.cachepath, path))
+            except OSError:
+                # Ok, someone else deleted it already
+                pass
+            
+            self.total -= size
+        
+        self._db().executemany('DELETE FROM tiles WHERE path=?', [(path, ) for (path, size) in tiles])
+        self._db().commit()
+    
+    def _flush_if_due(self):
+        """ Flush pending changes if there are enough or they're old enough.
+        
+            Call only with self.db_lock held.
         """
-        fullpath = pathjoin(self.cachepath, path)
-
-        os.unlink(fullpath)
+        if len(self.saved) + len(self.used) >= self.flush_size:
+            self._flush()
+        
+        elif time.time() - self.flushed > self.flush_interval:
+            self._flush()
+    
+    def _flush(self):
+        """ Write pending new tiles and read times to the tiles table.
+        
+            Call only with self.db_lock held.
+        """
+        if not self.saved and not self.used:
+            return
+        
+        db = self._db()
+        
+        db.executemany('INSERT OR REPLACE INTO tiles (path, size, used) VALUES (?, ?, ?)',
+                       [(path, size, used) for (path, (size, used)) in self.saved.items()])
+        
+        db.executemany('UPDATE tiles SET used=? WHERE path=?',
+                       [(used, path) for (path, used) in self.used.items()])
+        
+        db.commit()
+        
+        self.saved, self.used = {}, {}
+        self.flushed = time.time()
+    
+    def _evict(self):
+        """ Remove least-recently used tiles in bulk until under the limit.
+        
+            Runs in a background thread whenever self.evicting is set,
+            releasing the lock between batches so requests can go on.
+        """
+        while True:
+            self.evicting.wait()
+            
+            try:
+                with self.db_lock:
+                    self._flush()
+                    
+                    # other processes may be writing to the same cache.
+                    self.total = self._db().execute('SELECT SUM(size) FROM tiles').fetchone()[0] or 0
+                
+                while self.total > int(self.limit * .9):
+                    with self.db_lock:
+                        self._flush()
+                        
+                        q = 'SELECT path, size FROM tiles ORDER BY used ASC LIMIT 1000'
+                        over, tiles = self.total - int(self.limit * .9), []
+                        
+                        for (path, size) in self._db().execute(q).fetchall():
+                            if over <= 0:
+                                break
+                            
+                            tiles.append((path, size))
+                            over -= size
+                        
+                        if not tiles:
+                            break
+                        
+                        self._remove(tiles)
+                        logging.debug('TileStache.Goodies.Caches.LimitedDisk evicted %d tiles', len(tiles))
+            
+            except Exception, e:
+                logging.error('TileStache.Goodies.Caches.LimitedDisk eviction failed: %s', e)
+            
+            self.evicting.clear()
     
     def save(self, body, layer, coord, format):
         """
         """
-        sys.stderr.write('save %d/%d/%d, %s' % (coord.zoom, coord.column, coord.row, format))
-        
         path = self._filepath(layer, coord, format)
-        size = self._write(body, path, format)
-
-        db = connect(self.dbpath).cursor()
         
         try:
-            db.execute("""INSERT INTO tiles
-                          (size, used, path)
-                          VALUES (?, ?, ?)""",
-                       (size, int(time.time()), path))
-        except IntegrityError:
-            db.execute("""UPDATE tiles
-                          SET size=?, used=?
-                          WHERE path=?""",
-                       (size, int(time.time()), path))
-        
-        row = db.execute('SELECT SUM(size) FROM tiles').fetchone()
-        
-        if row and (row[0] > self.limit):
-            over = row[0] - self.limit
+            # a tile being replaced no longer counts toward the total.
+            old_size = self._size(os.stat(pathjoin(self.cachepath, path)))
+        except OSError:
+            old_size = 0
+        
+        size = self._write(body, path, format)
+
+        with self.db_lock:
+            self.saved[path] = size, int(time.time())
+            self.used.pop(path, None)
+            self.total += size - old_size
+            self._flush_if_due()
             
-            while over > 0:
-                row = db.execute('SELECT path, size FROM tiles ORDER BY used ASC LIMIT 1').fetchone()
+            if self.total > self.limit and not self.evicting.is_set():
+                if self.evictor is None or not self.evictor.is_alive():
+                    self.evictor = Thread(target=self._evict, name='LimitedDisk eviction')
+                    self.evictor.daemon = True
+                    self.evictor.start()
                 
-                if row is None:
-                    break
-
-                path, size = row
-                db.execute('DELETE FROM tiles WHERE path=?', (path, ))
-                self._remove(path)
-                over -= size
-                sys.stderr.write('delete ' + path)
-        
-        db.connection.commit()
-        db.connection.close()
+                self.evicting.set()
+    
+    def close(self):
+        """ Write any pending changes to the tiles table.
+        """
+        with self.db_lock:
+            self._flush()
@@ -35,15 +35,13 @@ class Provider (ImageProvider):
         """ Initialize Cascadenik provider with layer and mapfile.
         """
         self.workdir = workdir or gettempdir()
-        self.mapnik = None
 
         ImageProvider.__init__(self, layer, mapfile, fonts)
 
-    def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
-        """ Mostly hand off functionality to Mapnik.ImageProvider.renderArea()
+    def loadMap(self):
+        """ Load a new mapnik.Map from the MML file for Mapnik.ImageProvider.renderArea()
         """
-        if self.mapnik is None:
-            self.mapnik = mapnik.Map(0, 0)
-            load_map(self.mapnik, str(self.mapfile), self.workdir, cache_dir=self.workdir)
+        mmap = mapnik.Map(0, 0)
+        load_map(mmap, str(self.mapfile), self.workdir, cache_dir=self.workdir)
         
-        return ImageProvider.renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom)
+        return mmap
@@ -0,0 +1,319 @@
+""" Caches tiles to an LMDB memory-mapped database shared by every process on a host.
+
+Requires py-lmdb
+  https://pypi.python.org/pypi/lmdb
+
+  pip install lmdb
+
+Example configuration:
+
+  "cache": {
+    "name": "LMDB",
+    "path": "/var/cache/tilestache",
+    "size": 4096
+  }
+
+LMDB cache parameters:
+
+  path
+    Required local directory for the database files, created if needed.
+
+  size
+    Optional maximum size of the database in megabytes, defaults to 1024.
+    The least recently used tiles are removed to make room when the
+    database is nine-tenths full, or when a save doesn't fit.
+
+Tiles are stored with the time they were saved, and expire after the layer
+"cache lifespan" if one is set. Reads use short read-only transactions that
+never wait on writers, while saves are serialized by LMDB across processes.
+Commits are not synced to disk, so a system crash may lose the latest tiles.
+The times of cache hits are collected in memory and written in batches, at
+most once a minute for each tile.
+
+Locks are stored in the same database with a random token so only their
+owner can release them, and expire after the layer "stale lock timeout".
+"""
+from __future__ import absolute_import
+from thread import get_ident as _thread_ident
+from threading import Lock
+from struct import pack, unpack
+from uuid import uuid4 as _uuid4
+import logging
+import time
+import os
+
+# We enabled absolute_import because case insensitive filesystems
+# cause this file to be loaded twice (the name of this file
+# conflicts with the name of the module we want to import).
+# Forcing absolute imports fixes the issue.
+
+try:
+    import lmdb
+except ImportError:
+    # at least we can build the documentation
+    pass
+
+# environments opened in this process, by path: LMDB must not open one twice.
+_environments = dict()
+_environments_lock = Lock()
+
+def tile_key(layer, coord, format):
+    """ Return a tile key string.
+    """
+    name = layer.name()
+    tile = '%(zoom)d/%(column)d/%(row)d' % coord.__dict__
+    key = str('%(name)s/%(tile)s.%(format)s' % locals())
+    return key
+
+class Cache:
+    """
+    """
+    def __init__(self, path, size=1024, flush_size=100, flush_interval=5):
+        self.path = path
+        self.map_size = int(float(size) * 1024 * 1024)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        self.pid = None
+        self.tokens = dict()
+
+        # times of cache hits, waiting to be written.
+        self.used = dict()
+        self.flushed = time.time()
+
+    def _env(self):
+        """ Return the database environment, opened once in each process.
+        """
+        if self.pid != os.getpid():
+            with _environments_lock:
+                key = os.path.realpath(self.path), os.getpid()
+
+                if key not in _environments:
+                    env = lmdb.open(self.path, map_size=self.map_size, max_dbs=4,
+                                    sync=False, readahead=False)
+
+                    # tiles holds save times and bodies, times holds the
+                    # last time of use of each tile, and lru is ordered by it.
+                    dbs = [env.open_db(name) for name in ('tiles', 'times', 'locks')]
+                    dbs.append(env.open_db('lru', dupsort=True))
+
+                    _environments[key] = [env] + dbs
+
+                self.env, self.tiles, self.times, self.locks, self.lru = _environments[key]
+                self.used = dict()
+                self.pid = os.getpid()
+
+        return self.env
+
+    def lock(self, layer, coord, format):
+        """ Acquire a cache lock for this tile.
+
+            Returns nothing, but blocks until the lock has been acquired.
+            Lock is stored with an expiry time of the layer stale lock timeout.
+        """
+        env, key = self._env(), tile_key(layer, coord, format)
+        token, delay = _uuid4().hex, .01
+
+        while True:
+            with env.begin(write=True, db=self.locks) as txn:
+                held, now = txn.get(key), time.time()
+
+                if held is None or unpack('<d', held[:8])[0] < now:
+                    txn.put(key, pack('<d', now + layer.stale_lock_timeout) + token)
+                    break
+
+            time.sleep(delay)
+            delay = min(delay * 2, .5)
+
+        self.tokens[(key, _thread_ident())] = token
+
+    def unlock(self, layer, coord, format):
+        """ Release a cache lock for this tile, if it's still ours.
+        """
+        env, key = self._env(), tile_key(layer, coord, format)
+        token = self.tokens.pop((key, _thread_ident()), None)
+
+        with env.begin(write=True, db=self.locks) as txn:
+            held = txn.get(key)
+
+            if held is not None and held[8:] == token:
+                txn.delete(key)
+
+    def remove(self, layer, coord, format):
+        """ Remove a cached tile.
+        """
+        env, key = self._env(), tile_key(layer, coord, format)
+        self.used.pop(key, None)
+
+        with env.begin(write=True) as txn:
+            self._delete(txn, key)
+
+    def read(self, layer, coord, format):
+        """ Read a cached tile.
+        """
+        return self.read_many(layer, [coord], format)[0]
+
+    def read_many(self, layer, coords, format):
+        """ Read a list of cached tiles in one transaction.
+
+            Return a list of bodies, with None for each tile not found.
+        """
+        env, bodies, now = self._env(), [], time.time()
+        keys = [tile_key(layer, coord, format) for coord in coords]
+        lifespan = getattr(layer, 'cache_lifespan', None)
+
+        with env.begin(db=self.tiles, buffers=True) as txn:
+            for key in keys:
+                value = txn.get(key)
+
+                if value is None:
+                    bodies.append(None)
+
+                elif lifespan and now - unpack('<I', value[:4])[0] > lifespan:
+                    bodies.append(None)
+
+                else:
+                    # copy out of the memory map before the transaction ends.
+                    bodies.append(value[4:])
+                    used = txn.get(key, db=self.times)
+
+                    # times of use only need to be roughly right.
+                    if used is None or now * 1000 - unpack('>Q', used)[0] > 60000:
+                        self.used[key] = int(now * 1000)
+
+        if len(self.used) >= self.flush_size or now - self.flushed > self.flush_interval:
+            self._flush()
+
+        return bodies
+
+    def exists_many(self, layer, coords, format):
+        """ Return a list of booleans, true for each tile in the cache and not expired.
+        
+            Only save times are read, and times of use are left alone.
+        """
+        env, found, now = self._env(), [], time.time()
+        lifespan = getattr(layer, 'cache_lifespan', None)
+        
+        with env.begin(db=self.tiles, buffers=True) as txn:
+            for coord in coords:
+                value = txn.get(tile_key(layer, coord, format))
+                
+                if value is None:
+                    found.append(False)
+                else:
+                    found.append(not lifespan or now - unpack('<I', value[:4])[0] <= lifespan)
+        
+        return found
+    
+    def save(self, body, layer, coord, format):
+        """ Save a cached tile.
+        """
+        self.save_many([(coord, body)], layer, format)
+
+    def save_many(self, tiles, layer, format):
+        """ Save a list of (coord, body) cached tiles in one transaction.
+        """
+        env, now = self._env(), time.time()
+        values = [(tile_key(layer, coord, format), pack('<I', int(now)) + body) for (coord, body) in tiles]
+
+        try:
+            self._put(values, now)
+
+        except lmdb.MapFullError:
+            # free pages may be too scattered for the new tiles, so
+            # make plenty of room and try once more.
+            self._evict(.5, self.map_size / 4)
+            self._put(values, now)
+
+        if self._usage() > self.map_size * .9:
+            self._evict(.8)
+
+    def close(self):
+        """ Write times of cache hits waiting in memory, and flush to disk.
+        """
+        if self.pid == os.getpid():
+            self._flush()
+            self.env.sync()
+
+    def _put(self, values, now):
+        """ Write a list of (key, value) tiles in one transaction.
+        """
+        with self.env.begin(write=True) as txn:
+            for (key, value) in values:
+                txn.put(key, value, db=self.tiles)
+                self._touch(txn, key, int(now * 1000))
+
+    def _touch(self, txn, key, used):
+        """ Set the last time of use for a tile in milliseconds, and its place in the lru.
+        """
+        old = txn.get(key, db=self.times)
+
+        if old is not None:
+            txn.delete(old, key, db=self.lru)
+
+        txn.put(key, pack('>Q', used), db=self.times)
+        txn.put(pack('>Q', used), key, db=self.lru)
+
+    def _delete(self, txn, key):
+        """ Delete a tile with its time of use.
+        """
+        used = txn.pop(key, db=self.times)
+
+        if used is not None:
+            txn.delete(used, key, db=self.lru)
+
+        txn.delete(key, db=self.tiles)
+
+    def _flush(self):
+        """ Write times of cache hits in one transaction.
+        """
+        used, self.used = self.used, dict()
+        self.flushed = time.time()
+
+        if not used:
+            return
+
+        with self.env.begin(write=True) as txn:
+            for (key, time_used) in used.items():
+                if txn.get(key, db=self.times) is not None:
+                    self._touch(txn, key, time_used)
+
+    def _usage(self):
+        """ Return the approximate number of bytes used by tiles and locks.
+        """
+        with self.env.begin() as txn:
+            stats = [txn.stat(db) for db in (self.tiles, self.times, self.lru, self.locks)]
+
+        pages = sum([stat['branch_pages'] + stat['leaf_pages'] + stat['overflow_pages'] for stat in stats])
+        return pages * stats[0]['psize']
+
+    def _evict(self, fraction, minimum=0):
+        """ Remove least recently used tiles until usage is under a fraction of the size.
+
+            Keep going until at least a minimum number of bytes of tiles are gone.
+        """
+        self._flush()
+        count, freed = 0, 0
+
+        while self._usage() > self.map_size * fraction or freed < minimum:
+            with self.env.begin(write=True) as txn:
+                keys = []
+
+                for (used, key) in txn.cursor(self.lru):
+                    keys.append(key)
+
+                    # small batches, since pages freed by the latest
+                    # transaction can't be reused by the next one.
+                    if len(keys) >= 50:
+                        break
+
+                if not keys:
+                    break
+
+                for key in keys:
+                    freed += len(txn.get(key, '', db=self.tiles))
+                    self._delete(txn, key)
+
+                count += len(keys)
+
+        logging.debug('TileStache.LMDB.Cache._evict() removed %d tiles from %s', count, self.path)
@@ -37,13 +37,147 @@ MBTiles provider parameters:
 """
 from urlparse import urlparse, urljoin
 from os.path import exists
+from threading import local as _local, Lock as _Lock
+from hashlib import md5
+from time import time
+import logging
+import os
 
 # Heroku is missing standard python's sqlite3 package, so this will ImportError.
-from sqlite3 import connect as _connect
+from sqlite3 import connect as _connect, OperationalError
 
 from ModestMaps.Core import Coordinate
 
-def create_tileset(filename, name, type, version, description, format, bounds=None):
+# Open connections and metadata by tileset filename, in each thread.
+_registry = _local()
+
+_mime_types = {'png': 'image/png', 'jpg': 'image/jpeg', 'json': 'application/json', None: None}
+
+def _tileset(filename):
+    """ Return a connection and metadata dictionary for a tileset file.
+    
+        Connections are kept open for each process and thread, and replaced
+        if the file at filename is replaced. SQLite connections must not
+        cross a fork() or be shared between threads.
+    """
+    pid = os.getpid()
+    
+    if getattr(_registry, 'pid', None) != pid:
+        _registry.pid, _registry.tilesets = pid, {}
+    
+    inode = _inode(filename)
+    
+    if filename in _registry.tilesets:
+        db, metadata, known_inode = _registry.tilesets[filename]
+        
+        if inode is not None and inode == known_inode:
+            return db, metadata
+        
+        db.close()
+    
+    db = _connect(filename)
+    db.text_factory = bytes
+    
+    # sqlite may have just created the file.
+    _registry.tilesets[filename] = db, {}, inode or _inode(filename)
+    
+    return db, _registry.tilesets[filename][1]
+
+def _forget_tileset(filename):
+    """ Close this thread's connection to a tileset, if it has one.
+    """
+    if getattr(_registry, 'pid', None) == os.getpid():
+        if filename in _registry.tilesets:
+            _registry.tilesets.pop(filename)[0].close()
+
+def _inode(filename):
+    """ Return a (device, inode) tuple identifying a file, or None.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    
+    return stat.st_dev, stat.st_ino
+
+def _tileset_format(filename):
+    """ Return the format of a tileset from its metadata, read once.
+    """
+    db, metadata = _tileset(filename)
+    
+    if 'format' not in metadata:
+        format = db.execute("SELECT value FROM metadata WHERE name='format'").fetchone()
+        metadata['format'] = format and format[0] or None
+    
+    return metadata['format']
+
+def _tileset_deduplicated(filename):
+    """ Return true if a tileset uses the map and images tables, checked once.
+    """
+    db, metadata = _tileset(filename)
+    
+    if 'deduplicated' not in metadata:
+        metadata['deduplicated'] = _is_deduplicated(db)
+    
+    return metadata['deduplicated']
+
+def _is_deduplicated(db):
+    """ Return true if a tileset stores tiles in map and images tables.
+    """
+    q = "SELECT type FROM sqlite_master WHERE name='tiles'"
+    return db.execute(q).fetchone() == ('view', )
+
+def _insert_tile(db, deduplicated, coord, content):
+    """ Write one tile row, without committing.
+    
+        Deduplicated tilesets store each distinct tile body once in images,
+        keyed by its MD5 hash, and point to it from map. Images no longer
+        used by any tile after a tile is replaced are deleted.
+    """
+    tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
+    
+    if deduplicated:
+        q = 'SELECT tile_id FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+        old_id = db.execute(q, (coord.zoom, coord.column, tile_row)).fetchone()
+        
+        tile_id = md5(content).hexdigest()
+        db.execute('INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (?, ?)', (buffer(content), tile_id))
+        q = 'REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)'
+        db.execute(q, (coord.zoom, coord.column, tile_row, tile_id))
+        
+        if old_id is not None and old_id[0] != tile_id:
+            # images may still be used by other tiles.
+            q = 'DELETE FROM images WHERE tile_id=? AND NOT EXISTS (SELECT 1 FROM map WHERE tile_id=?)'
+            db.execute(q, (old_id[0], old_id[0]))
+    
+    else:
+        q = 'REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)'
+        db.execute(q, (coord.zoom, coord.column, tile_row, buffer(content)))
+
+def _delete_tile(db, deduplicated, coord):
+    """ Delete one tile row, without committing.
+    """
+    tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
+    
+    if deduplicated:
+        q = 'SELECT tile_id FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+        tile_id = db.execute(q, (coord.zoom, coord.column, tile_row)).fetchone()
+        
+        if tile_id is None:
+            return
+        
+        q = 'DELETE FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+        db.execute(q, (coord.zoom, coord.column, tile_row))
+        
+        # images may still be used by other tiles.
+        q = 'DELETE FROM images WHERE tile_id=? AND NOT EXISTS (SELECT 1 FROM map WHERE tile_id=?)'
+        db.execute(q, (tile_id[0], tile_id[0]))
+    
+    else:
+        q = 'DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+        db.execute(q, (coord.zoom, coord.column, tile_row))
+
+def create_tileset(filename, name, type, version, description, format, bounds=None, deduplicate=False):
     """ Create a tileset 1.1 with the given filename and metadata.
     
         From the specification:
@@ -74,6 +208,10 @@ def create_tileset(filename, name, type, version, description, format, bounds=No
             WGS:84 - latitude and longitude values, in the OpenLayers Bounds
             format - left, bottom, right, top. Example of the full earth:
             -180.0,-85,180,85.
+        
+        If deduplicate is true, tiles are stored in the map and images tables
+        used by MBUtil and others, so that identical tiles such as empty ocean
+        are stored once. A tiles view keeps the tileset readable as usual.
     """
     if format not in ('png', 'jpg',' json'):
         raise Exception('Format must be one of "png" or "jpg" or "json", not "%s"' % format)
@@ -81,8 +219,19 @@ def create_tileset(filename, name, type, version, description, format, bounds=No
     db = _connect(filename)
     
     db.execute('CREATE TABLE metadata (name TEXT, value TEXT, PRIMARY KEY (name))')
-    db.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
-    db.execute('CREATE UNIQUE INDEX coord ON tiles (zoom_level, tile_column, tile_row)')
+    
+    if deduplicate:
+        db.execute('CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT)')
+        db.execute('CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, tile_row)')
+        db.execute('CREATE TABLE images (tile_data BLOB, tile_id TEXT)')
+        db.execute('CREATE UNIQUE INDEX images_id ON images (tile_id)')
+        db.execute("""CREATE VIEW tiles AS
+                      SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+                             map.tile_row AS tile_row, images.tile_data AS tile_data
+                      FROM map JOIN images ON images.tile_id = map.tile_id""")
+    else:
+        db.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+        db.execute('CREATE UNIQUE INDEX coord ON tiles (zoom_level, tile_column, tile_row)')
     
     db.execute('INSERT INTO metadata VALUES (?, ?)', ('name', name))
     db.execute('INSERT INTO metadata VALUES (?, ?)', ('type', type))
@@ -103,8 +252,7 @@ def tileset_exists(filename):
         return False
     
     # this always works
-    db = _connect(filename)
-    db.text_factory = bytes
+    db, metadata = _tileset(filename)
     
     try:
         db.execute('SELECT name, value FROM metadata LIMIT 1')
@@ -122,8 +270,7 @@ def tileset_info(filename):
     if not tileset_exists(filename):
         return None
     
-    db = _connect(filename)
-    db.text_factory = bytes
+    db, metadata = _tileset(filename)
     
     info = []
     
@@ -133,30 +280,81 @@ def tileset_info(filename):
     
     return info
 
-def list_tiles(filename):
-    """ Get a list of tile coordinates.
+def _tile_filters(zooms, extent):
+    """ Generate (where clause, arguments) pairs to select tiles by zoom and extent.
+    
+        Extent is an optional pair of upper-left and lower-right Coordinates,
+        converted to a range of columns and rows at each zoom level.
     """
-    db = _connect(filename)
-    db.text_factory = bytes
+    if extent is None:
+        if zooms is None:
+            yield '', ()
+        else:
+            for zoom in zooms:
+                yield 'WHERE zoom_level=?', (zoom, )
+        return
+    
+    ul, lr = extent
+    
+    for zoom in (zooms is None and range(0, 31) or zooms):
+        ul_, lr_ = ul.zoomTo(zoom).container(), lr.zoomTo(zoom).container()
+        
+        # tile_row counts from the bottom, hello again Paul Ramsey.
+        top, bottom = (2**zoom - 1) - int(ul_.row), (2**zoom - 1) - int(lr_.row)
+        
+        q = 'WHERE zoom_level=? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?'
+        yield q, (zoom, int(ul_.column), int(lr_.column), bottom, top)
+
+def iter_tiles(filename, zooms=None, extent=None, content=False):
+    """ Generate tile coordinates from a tileset, optionally with content.
+    
+        Tiles are streamed from the database rather than loaded all at
+        once. Optional zooms is a list of zoom levels and optional extent
+        a pair of upper-left and lower-right Coordinates to limit tiles to.
+        If content is true, generate (coordinate, raw content) pairs.
+    """
+    db, metadata = _tileset(filename)
+    
+    # deduplicated tilesets list tiles faster from map, without a join.
+    table = content and 'tiles' or (_tileset_deduplicated(filename) and 'map' or 'tiles')
+    columns = content and 'tile_row, tile_column, zoom_level, tile_data' or 'tile_row, tile_column, zoom_level'
+    
+    for (where, args) in _tile_filters(zooms, extent):
+        for row in db.execute('SELECT %s FROM %s %s' % (columns, table, where), args):
+            y, x, z = row[:3]
+            coord = Coordinate((2**z - 1) - y, x, z) # Hello, Paul Ramsey.
+            
+            if content:
+                yield coord, row[3]
+            else:
+                yield coord
+
+def count_tiles(filename, zooms=None, extent=None):
+    """ Count tiles in a tileset, with the same optional filters as iter_tiles().
+    """
+    db, metadata = _tileset(filename)
+    table = _tileset_deduplicated(filename) and 'map' or 'tiles'
+    count = 0
     
-    tiles = db.execute('SELECT tile_row, tile_column, zoom_level FROM tiles')
-    tiles = (((2**z - 1) - y, x, z) for (y, x, z) in tiles) # Hello, Paul Ramsey.
-    tiles = [Coordinate(row, column, zoom) for (row, column, zoom) in tiles]
+    for (where, args) in _tile_filters(zooms, extent):
+        count += db.execute('SELECT COUNT(*) FROM %s %s' % (table, where), args).fetchone()[0]
     
-    return tiles
+    return count
+
+def list_tiles(filename):
+    """ Get a list of tile coordinates.
+        
+        See iter_tiles() for a generator that can handle huge tilesets.
+    """
+    return list(iter_tiles(filename))
 
 def get_tile(filename, coord):
     """ Retrieve the mime-type and raw content of a tile by coordinate.
     
         If the tile does not exist, None is returned for the content.
     """
-    db = _connect(filename)
-    db.text_factory = bytes
-    
-    formats = {'png': 'image/png', 'jpg': 'image/jpeg', 'json': 'application/json', None: None}
-    format = db.execute("SELECT value FROM metadata WHERE name='format'").fetchone()
-    format = format and format[0] or None
-    mime_type = formats[format]
+    db, metadata = _tileset(filename)
+    mime_type = _mime_types[_tileset_format(filename)]
     
     tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
     q = 'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
@@ -168,25 +366,18 @@ def get_tile(filename, coord):
 def delete_tile(filename, coord):
     """ Delete a tile by coordinate.
     """
-    db = _connect(filename)
-    db.text_factory = bytes
+    db, metadata = _tileset(filename)
     
-    tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
-    q = 'DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
-    db.execute(q, (coord.zoom, coord.column, tile_row))
+    _delete_tile(db, _tileset_deduplicated(filename), coord)
+    db.commit()
 
 def put_tile(filename, coord, content):
     """
     """
-    db = _connect(filename)
-    db.text_factory = bytes
+    db, metadata = _tileset(filename)
     
-    tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
-    q = 'REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)'
-    db.execute(q, (coord.zoom, coord.column, tile_row, buffer(content)))
-
+    _insert_tile(db, _tileset_deduplicated(filename), coord, content)
     db.commit()
-    db.close()
 
 class Provider:
     """ MBTiles provider.
@@ -263,14 +454,34 @@ class Cache:
         Instead, this cache provider is provided for use with the script
         tilestache-seed.py, which can be called with --to-mbtiles option
         to write cached tiles to a new tileset.
+        
+        Tiles are written in large transactions to a database in WAL mode,
+        committed every batch_size tiles or flush_interval seconds and when
+        the cache is closed. Close it when done to be sure every tile lands.
+        New tilesets store identical tiles just once, see create_tileset().
     """
-    def __init__(self, filename, format, name):
+    def __init__(self, filename, format, name, deduplicate=True, batch_size=1000, flush_interval=10):
         """
         """
         self.filename = filename
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
         
         if not tileset_exists(filename):
-            create_tileset(filename, name, 'baselayer', '0', '', format.lower())
+            create_tileset(filename, name, 'baselayer', '0', '', format.lower(), deduplicate=deduplicate)
+        
+        # a connection of our own, to hold a transaction open between saves.
+        self.db = _connect(filename, check_same_thread=False)
+        self.db.text_factory = bytes
+        self.write_lock = _Lock()
+        
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute('PRAGMA cache_size = -65536') # 64MB
+        self.db.execute('PRAGMA temp_store = MEMORY')
+        
+        self.deduplicated = _is_deduplicated(self.db)
+        self.pending, self.flushed = 0, time()
     
     def lock(self, layer, coord, format):
         return
@@ -281,14 +492,98 @@ class Cache:
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
         """
-        delete_tile(self.filename, coord)
+        with self.write_lock:
+            _delete_tile(self.db, self.deduplicated, coord)
+            self._written(1)
         
     def read(self, layer, coord, format):
         """ Return raw tile content from tileset.
+        
+            Tiles saved but not yet committed are included.
         """
-        return get_tile(self.filename, coord)[1]
+        tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
+        q = 'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+        
+        with self.write_lock:
+            content = self.db.execute(q, (coord.zoom, coord.column, tile_row)).fetchone()
+        
+        return content and content[0] or None
+    
+    def exists_many(self, layer, coords, format):
+        """ Return a list of booleans, true for each tile in the tileset.
+        
+            Rows are looked up a column at a time in the tile index, without
+            reading tile data. Tiles saved but not yet committed are included.
+        """
+        q = 'SELECT tile_row FROM %s WHERE zoom_level=? AND tile_column=? AND tile_row BETWEEN ? AND ?'
+        q %= self.deduplicated and 'map' or 'tiles'
+        
+        columns, found = dict(), set()
+        
+        for coord in coords:
+            tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
+            columns.setdefault((coord.zoom, coord.column), []).append(tile_row)
+        
+        with self.write_lock:
+            for ((zoom, column), rows) in columns.items():
+                for (tile_row, ) in self.db.execute(q, (zoom, column, min(rows), max(rows))):
+                    found.add((zoom, column, tile_row))
+        
+        return [(coord.zoom, coord.column, (2**coord.zoom - 1) - coord.row) in found for coord in coords]
     
     def save(self, body, layer, coord, format):
         """ Write raw tile content to tileset.
         """
-        put_tile(self.filename, coord, body)
+        with self.write_lock:
+            _insert_tile(self.db, self.deduplicated, coord, body)
+            self._written(1)
+    
+    def save_many(self, tiles, layer, format):
+        """ Write a list of (coord, body) tiles to tileset.
+        """
+        with self.write_lock:
+            for (coord, body) in tiles:
+                _insert_tile(self.db, self.deduplicated, coord, body)
+            
+            self._written(len(tiles))
+    
+    def _written(self, count):
+        """ Count written tiles, committing if the batch is big or old enough.
+        """
+        self.pending += count
+        
+        if self.pending >= self.batch_size or time() - self.flushed > self.flush_interval:
+            self._commit()
+    
+    def _commit(self):
+        self.db.commit()
+        self.pending, self.flushed = 0, time()
+    
+    def flush(self):
+        """ Commit any tiles saved so far.
+        """
+        with self.write_lock:
+            self._commit()
+    
+    def close(self):
+        """ Commit remaining tiles and close the tileset.
+        
+            The tileset is switched out of WAL mode, leaving a single
+            self-contained file that can be copied or read anywhere.
+        """
+        with self.write_lock:
+            if self.db is None:
+                return
+            
+            self._commit()
+            
+            # leaving WAL mode needs the only connection to the database.
+            _forget_tileset(self.filename)
+            
+            try:
+                self.db.execute('PRAGMA journal_mode = DELETE')
+            except OperationalError, e:
+                logging.warning('TileStache.MBTiles.Cache.close() left %s in WAL mode: %s', self.filename, e)
+            
+            self.db.close()
+            self.db = None
@@ -3,11 +3,43 @@
 ImageProvider is known as "mapnik" in TileStache config, GridProvider is
 known as "mapnik grid". Both require Mapnik to be installed; Grid requires
 Mapnik 2.0.0 and above.
+
+By default, all Mapnik rendering in a process happens one map at a time behind
+a single global lock, because Mapnik can behave strangely when run in threads.
+Both providers accept optional "processes" and "timeout" arguments to render
+in a pool of long-lived worker subprocesses instead, each with its own loaded
+mapnik.Map, so that a threaded server can render on more than one core.
+Workers are started along with the provider; a daemonic process, like one of
+the seeding processes of tilestache-seed.py --jobs, can't start processes of
+its own and renders in-process instead:
+
+  "provider":
+  {
+    "name": "mapnik",
+    "mapfile": "style.xml",
+    "processes": 4,
+    "timeout": 30
+  }
+
+Alternatively, both providers accept an optional "threads" argument to keep a
+pool of that many maps in-process, one for each server thread. The maps are
+loaded when the configuration is read, which for servers that load their
+configuration before forking means only once. With Mapnik 2.0 and above,
+renders using separate maps are not serialized behind the global lock:
+
+  "provider":
+  {
+    "name": "mapnik",
+    "mapfile": "style.xml",
+    "threads": 8
+  }
 """
 from __future__ import absolute_import
 from time import time
 from os.path import exists
 from thread import allocate_lock
+from multiprocessing import Process, Pipe, current_process
+from Queue import Queue
 from urlparse import urlparse, urljoin
 from itertools import count
 from glob import glob
@@ -29,6 +61,12 @@ except ImportError:
     # can still build documentation
     pass
 
+try:
+    import numpy
+except ImportError:
+    # UTF Grids are merged and cropped as strings instead
+    numpy = None
+
 from TileStache.Core import KnownUnknown
 from TileStache.Geography import getProjectionByName
 
@@ -61,13 +99,25 @@ class ImageProvider:
         - fonts (optional)
             Local directory path to *.ttf font files.
     
+        - processes (optional)
+            Number of worker subprocesses to render with, see RenderPool.
+            Defaults to none, rendering in-process behind a global lock.
+    
+        - timeout (optional)
+            Number of seconds a pooled render may take before its worker
+            is killed and replaced. Defaults to no timeout.
+    
+        - threads (optional)
+            Number of preloaded maps to keep for concurrent rendering in
+            threads, see MapPool. Defaults to one map, loaded when needed.
+    
         More information on Mapnik and Mapnik XML:
         - http://mapnik.org
         - http://trac.mapnik.org/wiki/XMLGettingStarted
         - http://trac.mapnik.org/wiki/XMLConfigReference
     """
     
-    def __init__(self, layer, mapfile, fonts=None):
+    def __init__(self, layer, mapfile, fonts=None, processes=None, timeout=None, threads=None):
         """ Initialize Mapnik provider with layer and mapfile.
             
             XML mapfile keyword arg comes from TileStache config,
@@ -82,7 +132,6 @@ class ImageProvider:
             self.mapfile = maphref
         
         self.layer = layer
-        self.mapnik = None
         
         engine = mapnik.FontEngine.instance()
         
@@ -96,42 +145,67 @@ class ImageProvider:
             for font in glob(path.rstrip('/') + '/*.ttf'):
                 engine.register_font(str(font))
 
+        # Worker processes are forked after fonts have been registered above.
+        self.pool = render_pool(self.mapfile, processes, timeout)
+        
+        self.concurrent = bool(threads) and _version >= 20000
+        self.maps = MapPool(self.loadMap, threads or 1, preload=bool(threads) and self.pool is None)
+
     @staticmethod
     def prepareKeywordArgs(config_dict):
         """ Convert configured parameters to keyword args for __init__().
         """
         kwargs = {'mapfile': config_dict['mapfile']}
 
-        if 'fonts' in config_dict:
-            kwargs['fonts'] = config_dict['fonts']
+        for key in ('fonts', 'processes', 'timeout', 'threads'):
+            if key in config_dict:
+                kwargs[key] = config_dict[key]
         
         return kwargs
     
+    def loadMap(self):
+        """ Load and return a new mapnik.Map instance for this provider.
+        """
+        start_time = time()
+        mmap = get_mapnikMap(self.mapfile)
+        
+        logging.debug('TileStache.Mapnik.ImageProvider.loadMap() %.3f to load %s', time() - start_time, self.mapfile)
+        
+        return mmap
+    
     def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
         """
         """
         start_time = time()
         
+        if self.pool is not None:
+            img = self.pool.renderImage(width, height, (xmin, ymin, xmax, ymax))
+
+            logging.debug('TileStache.Mapnik.ImageProvider.renderArea() %dx%d in %.3f from %s via render pool', width, height, time() - start_time, self.mapfile)
+
+            return img
+        
         #
-        # Mapnik can behave strangely when run in threads, so place a lock on the instance.
+        # Mapnik can behave strangely when run in threads, so place a lock
+        # on rendering unless every thread can have a map of its own.
         #
-        if global_mapnik_lock.acquire():
-            try:
-                if self.mapnik is None:
-                    self.mapnik = get_mapnikMap(self.mapfile)
-                    logging.debug('TileStache.Mapnik.ImageProvider.renderArea() %.3f to load %s', time() - start_time, self.mapfile)
-
-                self.mapnik.width = width
-                self.mapnik.height = height
-                self.mapnik.zoom_to_box(Box2d(xmin, ymin, xmax, ymax))
+        if not self.concurrent:
+            global_mapnik_lock.acquire()
+        
+        try:
+            mmap = self.maps.get()
             
-                img = mapnik.Image(width, height)
-                mapnik.render(self.mapnik, img) 
+            try:
+                img = render_image(mmap, width, height, (xmin, ymin, xmax, ymax))
             except:
-                self.mapnik = None
+                self.maps.discard()
                 raise
-            finally:
-                # always release the lock
+            
+            self.maps.put(mmap)
+        
+        finally:
+            # always release the lock
+            if not self.concurrent:
                 global_mapnik_lock.release()
 
         img = Image.fromstring('RGBA', (width, height), img.tostring())
@@ -198,17 +272,28 @@ class GridProvider:
           layer name added, keyed by this value. Useful for distingushing
           between data items.
         
+        - processes (optional)
+          Number of worker subprocesses to render with, see RenderPool.
+          Defaults to none, rendering in-process behind a global lock.
+        
+        - timeout (optional)
+          Number of seconds a pooled render may take before its worker
+          is killed and replaced. Defaults to no timeout.
+        
+        - threads (optional)
+          Number of preloaded maps to keep for concurrent rendering in
+          threads, see MapPool. Defaults to one map, loaded when needed.
+        
         Information and examples for UTF Grid:
         - https://github.com/mapbox/utfgrid-spec/blob/master/1.2/utfgrid.md
         - http://mapbox.github.com/wax/interaction-leaf.html
     """
-    def __init__(self, layer, mapfile, fields=None, layers=None, layer_index=0, scale=4, layer_id_key=None):
+    def __init__(self, layer, mapfile, fields=None, layers=None, layer_index=0, scale=4, layer_id_key=None, processes=None, timeout=None, threads=None):
         """ Initialize Mapnik grid provider with layer and mapfile.
             
             XML mapfile keyword arg comes from TileStache config,
             and is an absolute path by the time it gets here.
         """
-        self.mapnik = None
         self.layer = layer
 
         maphref = urljoin(layer.config.dirpath, mapfile)
@@ -227,68 +312,66 @@ class GridProvider:
         else:
             self.layers = [[layer_index or 0, fields]]
 
+        self.pool = render_pool(self.mapfile, processes, timeout)
+        
+        self.concurrent = bool(threads) and _version >= 20000
+        self.maps = MapPool(self.loadMap, threads or 1, preload=bool(threads) and self.pool is None)
+
     @staticmethod
     def prepareKeywordArgs(config_dict):
         """ Convert configured parameters to keyword args for __init__().
         """
         kwargs = {'mapfile': config_dict['mapfile']}
 
-        for key in ('fields', 'layers', 'layer_index', 'scale', 'layer_id_key'):
+        for key in ('fields', 'layers', 'layer_index', 'scale', 'layer_id_key', 'processes', 'timeout', 'threads'):
             if key in config_dict:
                 kwargs[key] = config_dict[key]
         
         return kwargs
     
+    def loadMap(self):
+        """ Load and return a new mapnik.Map instance for this provider.
+        """
+        start_time = time()
+        mmap = get_mapnikMap(self.mapfile)
+        
+        logging.debug('TileStache.Mapnik.GridProvider.loadMap() %.3f to load %s', time() - start_time, self.mapfile)
+        
+        return mmap
+    
     def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
         """
         """
         start_time = time()
+        bbox = xmin, ymin, xmax, ymax
+        
+        if self.pool is not None:
+            outgrid = self.pool.renderGrid(width, height, bbox, self.layers, self.scale, self.layer_id_key)
+
+            logging.debug('TileStache.Mapnik.GridProvider.renderArea() %dx%d at %d in %.3f from %s via render pool', width, height, self.scale, time() - start_time, self.mapfile)
+
+            return SaveableResponse(outgrid, self.scale)
         
         #
-        # Mapnik can behave strangely when run in threads, so place a lock on the instance.
+        # Mapnik can behave strangely when run in threads, so place a lock
+        # on rendering unless every thread can have a map of its own.
         #
-        if global_mapnik_lock.acquire():
-            try:
-                if self.mapnik is None:
-                    self.mapnik = get_mapnikMap(self.mapfile)
-                    logging.debug('TileStache.Mapnik.GridProvider.renderArea() %.3f to load %s', time() - start_time, self.mapfile)
-
-                self.mapnik.width = width
-                self.mapnik.height = height
-                self.mapnik.zoom_to_box(Box2d(xmin, ymin, xmax, ymax))
-            
-                if self.layer_id_key is not None:
-                    grids = []
-    
-                    for (index, fields) in self.layers:
-                        datasource = self.mapnik.layers[index].datasource
-                        fields = (type(fields) is list) and map(str, fields) or datasource.fields()
-                    
-                        grid = mapnik.render_grid(self.mapnik, index, resolution=self.scale, fields=fields)
-    
-                        for key in grid['data']:
-                            grid['data'][key][self.layer_id_key] = self.mapnik.layers[index].name
-    
-                        grids.append(grid)
+        if not self.concurrent:
+            global_mapnik_lock.acquire()
         
-                    # global_mapnik_lock.release()
-                    outgrid = reduce(merge_grids, grids)
-           
-                else:
-                    grid = mapnik.Grid(width, height)
-    
-                    for (index, fields) in self.layers:
-                        datasource = self.mapnik.layers[index].datasource
-                        fields = (type(fields) is list) and map(str, fields) or datasource.fields()
-    
-                        mapnik.render_layer(self.mapnik, grid, layer=index, fields=fields)
-    
-                    # global_mapnik_lock.release()
-                    outgrid = grid.encode('utf', resolution=self.scale, features=True)
+        try:
+            mmap = self.maps.get()
+            
+            try:
+                outgrid = render_grid(mmap, width, height, bbox, self.layers, self.scale, self.layer_id_key)
             except:
-                self.mapnik = None
+                self.maps.discard()
                 raise
-            finally:
+            
+            self.maps.put(mmap)
+        
+        finally:
+            if not self.concurrent:
                 global_mapnik_lock.release()
 
         logging.debug('TileStache.Mapnik.GridProvider.renderArea() %dx%d at %d in %.3f from %s', width, height, self.scale, time() - start_time, self.mapfile)
@@ -309,14 +392,26 @@ class SaveableResponse:
     """ Wrapper class for JSON response that makes it behave like a PIL.Image object.
 
         TileStache.getTile() expects to be able to save one of these to a buffer.
+        
+        When numpy is available, the grid is kept as an array of key indexes
+        and only encoded to UTF Grid strings when saved, see decode_grid().
     """
     def __init__(self, content, scale):
         self.content = content
         self.scale = scale
+        
+        if numpy is not None:
+            self.grid = grid_array(content['grid'])
+        else:
+            self.grid = content['grid']
 
     def save(self, out, format):
         if format != 'JSON':
             raise KnownUnknown('MapnikGrid only saves .json tiles, not "%s"' % format)
+        
+        if numpy is not None:
+            # replaced in place, a copied dictionary might reorder its keys
+            self.content['grid'] = encode_grid(self.grid)
 
         bytes = json.dumps(self.content, ensure_ascii=False).encode('utf-8')
         out.write(bytes)
@@ -327,11 +422,296 @@ class SaveableResponse:
         minchar, minrow, maxchar, maxrow = [v/self.scale for v in bbox]
 
         keys, data = self.content['keys'], self.content.get('data', None)
-        grid = [row[minchar:maxchar] for row in self.content['grid'][minrow:maxrow]]
+        
+        if numpy is not None:
+            grid = self.grid[minrow:maxrow, minchar:maxchar]
+        else:
+            grid = [row[minchar:maxchar] for row in self.grid[minrow:maxrow]]
         
         cropped = dict(keys=keys, data=data, grid=grid)
         return SaveableResponse(cropped, self.scale)
 
+class MapPool:
+    """ Pool of loaded mapnik.Map instances belonging to a single provider.
+    
+        A render checks a map out with get() and hands it back with put(),
+        so that no map is ever used by two threads at once. A render that
+        fails calls discard() instead, dropping only its own map; the empty
+        slot is filled with a newly-loaded map when next checked out.
+        
+        Maps are loaded with the given load function, all at once when the
+        pool is created if preload is true or one at a time as needed.
+    """
+    def __init__(self, load, size, preload=False):
+        self.load = load
+        self.maps = Queue()
+        
+        for i in range(int(size)):
+            self.maps.put(preload and load() or None)
+    
+    def get(self):
+        """ Check out a map, blocking until one is available.
+        """
+        mmap = self.maps.get()
+        
+        if mmap is None:
+            try:
+                mmap = self.load()
+            except:
+                self.maps.put(None)
+                raise
+        
+        return mmap
+    
+    def put(self, mmap):
+        """ Check a map back in after a successful render.
+        """
+        self.maps.put(mmap)
+    
+    def discard(self):
+        """ Give up a checked-out map after a failed render.
+        """
+        self.maps.put(None)
+
+# Image responses are sent in pieces of at most this many bytes,
+# so that a stalled worker can't hold up a receive past its timeout.
+_chunk_size = 1024 * 1024
+
+def render_pool(mapfile, processes, timeout=None):
+    """ Return a RenderPool of a number of processes, or None to render in-process.
+    
+        Daemonic processes can't have children, so they render in-process.
+    """
+    if not processes:
+        return None
+    
+    if current_process().daemon:
+        logging.info('TileStache.Mapnik.render_pool() rendering %s in-process, because daemonic process %s can\'t start workers', mapfile, current_process().name)
+        return None
+    
+    return RenderPool(mapfile, processes, timeout)
+
+class RenderPool:
+    """ Pool of long-lived worker subprocesses rendering a single mapfile.
+    
+        Each worker loads its own mapnik.Map on its first render and keeps it
+        for the rest of its life, so renders in separate workers happen at
+        the same time instead of waiting on global_mapnik_lock. Workers are
+        started when the pool is created, before a server has started any
+        threads. A pool carried into a forked process starts a new set of
+        workers there on first use, instead of sharing the parent's pipes.
+        
+        Render requests go to an idle worker over a pipe. Image responses
+        come back as raw RGBA bytes received directly into the buffer that
+        backs the returned PIL image, grid responses as a pickled dictionary.
+        
+        A render taking longer than timeout seconds, counting every message
+        received from its worker, kills that worker, which is replaced on a
+        later request; a failed render makes its worker discard and reload
+        its map.
+    """
+    def __init__(self, mapfile, processes, timeout=None):
+        self.mapfile = mapfile
+        self.timeout = timeout
+        self.processes = int(processes)
+        self.lock = allocate_lock()
+        self._start()
+    
+    def _start(self):
+        """ Start a full set of workers for the current process.
+        """
+        self.pid = os.getpid()
+        self.workers = Queue()
+        
+        for i in range(self.processes):
+            self.workers.put(self._spawn())
+    
+    def _spawn(self):
+        """ Start a new worker process, return it with its end of a pipe.
+        """
+        conn, child_conn = Pipe()
+
+        process = Process(target=_render_worker, args=(self.mapfile, child_conn))
+        process.daemon = True
+        process.start()
+        
+        child_conn.close()
+        
+        logging.debug('TileStache.Mapnik.RenderPool._spawn() started process %d for %s', process.pid, self.mapfile)
+        
+        return process, conn
+    
+    def _receive(self, worker, due, receive):
+        """ Call a receive function once the worker has sent something.
+        
+            Kills the worker and raises KnownUnknown if nothing comes by
+            the due time, or None to wait forever.
+        """
+        process, conn = worker
+        
+        if not conn.poll(None if due is None else max(due - time(), 0)):
+            logging.warning('TileStache.Mapnik.RenderPool._receive() killing process %d after %s seconds', process.pid, self.timeout)
+            
+            process.terminate()
+            process.join()
+            conn.close()
+            
+            raise KnownUnknown('Mapnik render of %s did not finish in %s seconds' % (self.mapfile, self.timeout))
+        
+        return receive()
+    
+    def _request(self, request):
+        """ Send a request to an idle worker and return its first response.
+        
+            The worker and the due time are returned too, so that following
+            messages can be received from it before it's handed back with
+            _release().
+        """
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    # Pipes inherited from the parent belong to its workers.
+                    while not self.workers.empty():
+                        worker = self.workers.get()
+                        if worker is not None:
+                            worker[1].close()
+                    
+                    self._start()
+        
+        worker = self.workers.get()
+        due = self.timeout and time() + self.timeout or None
+        
+        try:
+            if worker is None or not worker[0].is_alive():
+                worker = self._spawn()
+        
+            worker[1].send(request)
+            response = self._receive(worker, due, worker[1].recv)
+        
+        except:
+            self.workers.put(None)
+            raise
+        
+        if response[0] == 'error':
+            self.workers.put(worker)
+            raise Exception('Mapnik render of %s failed: %s' % (self.mapfile, response[1]))
+        
+        return worker, due, response
+    
+    def _release(self, worker):
+        """ Return a worker to the pool of idle workers.
+        """
+        self.workers.put(worker)
+    
+    def renderImage(self, width, height, bbox):
+        """ Render an RGBA PIL.Image of the given size and projected bounding box.
+        """
+        worker, due, response = self._request(('image', width, height, bbox))
+        
+        try:
+            buff = bytearray(width * height * 4)
+            
+            for offset in range(0, len(buff), _chunk_size):
+                self._receive(worker, due, lambda: worker[1].recv_bytes_into(buff, offset))
+        except:
+            self.workers.put(None)
+            raise
+        
+        self._release(worker)
+        
+        return Image.frombuffer('RGBA', (width, height), buff, 'raw', 'RGBA', 0, 1)
+    
+    def renderGrid(self, width, height, bbox, layers, scale, layer_id_key):
+        """ Render a UTF Grid dictionary, see render_grid().
+        """
+        worker, due, response = self._request(('grid', width, height, bbox, layers, scale, layer_id_key))
+        self._release(worker)
+        
+        return response[1]
+
+def _render_worker(mapfile, conn):
+    """ Main loop for a RenderPool worker process.
+    
+        Reads render requests from a pipe until it's closed,
+        and sends back a response for each one.
+    """
+    mmap = None
+    
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        
+        try:
+            if mmap is None:
+                mmap = get_mapnikMap(mapfile)
+
+            if request[0] == 'image':
+                width, height, bbox = request[1:]
+                data = render_image(mmap, width, height, bbox).tostring()
+                
+                conn.send(('image', ))
+                
+                for offset in range(0, len(data), _chunk_size):
+                    conn.send_bytes(data, offset, min(_chunk_size, len(data) - offset))
+            
+            elif request[0] == 'grid':
+                outgrid = render_grid(mmap, *request[1:])
+                conn.send(('grid', outgrid))
+        
+        except Exception, e:
+            mmap = None
+            conn.send(('error', '%s: %s' % (e.__class__.__name__, e)))
+
+def render_image(mmap, width, height, bbox):
+    """ Render a mapnik.Image of the given size and projected bounding box.
+    """
+    mmap.width = width
+    mmap.height = height
+    mmap.zoom_to_box(Box2d(*bbox))
+
+    img = mapnik.Image(width, height)
+    mapnik.render(mmap, img) 
+    
+    return img
+
+def render_grid(mmap, width, height, bbox, layers, scale, layer_id_key):
+    """ Render a UTF Grid dictionary of the given size and projected bounding box.
+    
+        Layers is a list of (layer index, fields) pairs, see GridProvider.
+    """
+    mmap.width = width
+    mmap.height = height
+    mmap.zoom_to_box(Box2d(*bbox))
+
+    if layer_id_key is not None:
+        grids = []
+
+        for (index, fields) in layers:
+            datasource = mmap.layers[index].datasource
+            fields = (type(fields) is list) and map(str, fields) or datasource.fields()
+        
+            grid = mapnik.render_grid(mmap, index, resolution=scale, fields=fields)
+
+            for key in grid['data']:
+                grid['data'][key][layer_id_key] = mmap.layers[index].name
+
+            grids.append(grid)
+
+        return reduce(merge_grids, grids)
+
+    else:
+        grid = mapnik.Grid(width, height)
+
+        for (index, fields) in layers:
+            datasource = mmap.layers[index].datasource
+            fields = (type(fields) is list) and map(str, fields) or datasource.fields()
+
+            mapnik.render_layer(mmap, grid, layer=index, fields=fields)
+
+        return grid.encode('utf', resolution=scale, features=True)
+
 def merge_grids(grid1, grid2):
     """ Merge two UTF Grid objects.
     """
@@ -357,7 +737,22 @@ def merge_grids(grid1, grid2):
     # Merge the two grids, one on top of the other.
     #
     
-    offset, outgrid = len(grid1['keys']), []
+    offset = len(grid1['keys'])
+    
+    if numpy is not None:
+        ids1, ids2 = grid_array(grid1['grid']), grid_array(grid2['grid'])
+        
+        # same as zip() below, for grids of different sizes
+        rows, cols = min(ids1.shape[0], ids2.shape[0]), min(ids1.shape[1], ids2.shape[1])
+        ids1, ids2 = ids1[:rows, :cols], ids2[:rows, :cols]
+        
+        # transparent pixels use the bottom id, opaque pixels the top one
+        transparent = numpy.array([key == '' for key in grid2['keys']], dtype=bool)
+        outgrid = numpy.where(transparent[ids2], ids1, ids2 + offset)
+        
+        return dict(keys=outkeys, data=outdata, grid=outgrid)
+    
+    outgrid = []
     
     def newchar(char1, char2):
         """ Return a new encoded character based on two inputs.
@@ -396,6 +791,50 @@ def decode_char(char):
         id = id - 1
     return id - 32
 
+def grid_array(grid):
+    """ Return a numpy array of key indexes for a grid, decoding it if needed.
+    """
+    if isinstance(grid, numpy.ndarray):
+        return grid
+    
+    return decode_grid(grid)
+
+def decode_grid(rows):
+    """ Decode a list of UTF Grid strings to a 2D numpy array of key indexes.
+    
+        Vectorized equivalent of decode_char() for every character.
+    """
+    if not rows:
+        return numpy.zeros((0, 0), numpy.int32)
+    
+    chars = u''.join(rows).encode('utf-32-le')
+    codes = numpy.fromstring(chars, numpy.uint32).astype(numpy.int32)
+    codes = codes.reshape(len(rows), -1)
+    
+    return codes - 32 - (codes >= 35) - (codes >= 93)
+
+def encode_grid(ids):
+    """ Encode a 2D numpy array of key indexes to a list of UTF Grid strings.
+    
+        Vectorized equivalent of encode_id() for every character.
+    """
+    codes = ids.astype(numpy.int32) + 32
+    codes += (codes >= 34)
+    codes += (codes >= 92)
+    
+    rows, cols = codes.shape
+    
+    if not cols:
+        return [''] * rows
+    
+    chars = codes.astype(numpy.uint32).tostring().decode('utf-32-le')
+    
+    if codes.max() <= 127:
+        # plain strings, as from encode_id()
+        chars = chars.encode('ascii')
+    
+    return [chars[i:i + cols] for i in range(0, rows * cols, cols)]
+
 def get_mapnikMap(mapfile):
     """ Get a new mapnik.Map instance for a mapfile
     """
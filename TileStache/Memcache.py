@@ -28,11 +28,29 @@ Memcache cache parameters:
     that share the same Memcache instance to avoid key
     collisions. The key prefix will be prepended to the
     key name. Defaults to "".
-    
+
+  compress
+    Optional list of formats whose tiles are zlib-compressed when they
+    are larger than the compress threshold, decompressed again on read.
+    Defaults to "txt", "text", "json", and "xml". Provide an empty list
+    for no compression, e.g. when other clients read tiles straight
+    from Memcache.
+
+  compress threshold
+    Optional size in bytes above which tiles are compressed.
+    Defaults to 1024.
+
+  persistent
+    Optional boolean flag to keep a pool of open connections, one set
+    per thread, instead of connecting for every request. Defaults to true.
 
 """
 from __future__ import absolute_import
 from time import time as _time, sleep as _sleep
+from random import uniform as _uniform
+from uuid import uuid4 as _uuid4
+from math import ceil as _ceil
+from thread import get_ident as _thread_ident
 
 # We enabled absolute_import because case insensitive filesystems
 # cause this file to be loaded twice (the name of this file
@@ -45,6 +63,9 @@ except ImportError:
     # at least we can build the documentation
     pass
 
+# value left in a lock key when it's released, see Cache.unlock().
+_released = 'released'
+
 def tile_key(layer, coord, format, rev, key_prefix):
     """ Return a tile key string.
     """
@@ -55,67 +76,140 @@ def tile_key(layer, coord, format, rev, key_prefix):
 class Cache:
     """
     """
-    def __init__(self, servers=['127.0.0.1:11211'], revision=0, key_prefix=''):
+    def __init__(self, servers=['127.0.0.1:11211'], revision=0, key_prefix='',
+                 compress='txt text json xml'.split(), compress_threshold=1024, persistent=True):
         self.servers = servers
         self.revision = revision
         self.key_prefix = key_prefix
+        self.compress = [format.lower() for format in compress]
+        self.compress_threshold = int(compress_threshold)
+        self.persistent = persistent
+        
+        # memcache.Client is a threading.local, so each thread has its own sockets.
+        self.mem = persistent and Client(self.servers, cache_cas=True) or None
+        
+        # tokens of locks held by this cache, by lock key and thread.
+        self.lock_tokens = {}
+    
+    def _client(self):
+        """ Return a Memcache client, to be passed to _done() afterwards.
+        """
+        return self.mem or Client(self.servers, cache_cas=True)
+    
+    def _done(self, mem):
+        """ Disconnect a client, unless it's kept in the pool.
+        """
+        if mem is not self.mem:
+            mem.disconnect_all()
+    
+    def _min_compress_len(self, format):
+        """ Return a python-memcached min_compress_len for a format.
+        """
+        return format.lower() in self.compress and self.compress_threshold or 0
 
     def lock(self, layer, coord, format):
         """ Acquire a cache lock for this tile.
         
             Returns nothing, but blocks until the lock has been acquired.
+            Waits between attempts grow exponentially, with random jitter
+            to keep competing processes from retrying in lockstep. A lock
+            that was just released is taken over with a check-and-set.
         """
-        mem = Client(self.servers)
-        key = tile_key(layer, coord, format, self.revision, self.key_prefix)
+        mem = self._client()
+        key = tile_key(layer, coord, format, self.revision, self.key_prefix) + '-lock'
+        token = _uuid4().hex
+        timeout = int(_ceil(layer.stale_lock_timeout))
         due = _time() + layer.stale_lock_timeout
+        delay = .005
         
         try:
             while _time() < due:
-                if mem.add(key+'-lock', 'locked.', layer.stale_lock_timeout):
-                    return
+                if mem.add(key, token, timeout):
+                    break
                 
-                _sleep(.2)
+                if mem.gets(key) == _released and mem.cas(key, token, timeout):
+                    break
+                
+                _sleep(_uniform(0, max(0, min(delay, due - _time()))))
+                delay = min(delay * 2, .5)
+            
+            else:
+                # someone left the door locked.
+                mem.set(key, token, timeout)
             
-            mem.set(key+'-lock', 'locked.', layer.stale_lock_timeout)
-            return
+            self.lock_tokens[(key, _thread_ident())] = token
 
         finally:
-            mem.disconnect_all()
+            mem.reset_cas()
+            self._done(mem)
         
     def unlock(self, layer, coord, format):
         """ Release a cache lock for this tile.
+        
+            Locks that were forced by someone else are left alone. Memcache
+            can't delete a key only if it's unchanged, so instead the lock
+            is replaced with a short-lived "released" value with gets() and
+            cas(), which fails if the lock was forced in the meantime.
         """
-        mem = Client(self.servers)
-        key = tile_key(layer, coord, format, self.revision, self.key_prefix)
+        mem = self._client()
+        key = tile_key(layer, coord, format, self.revision, self.key_prefix) + '-lock'
+        token = self.lock_tokens.pop((key, _thread_ident()), None)
         
-        mem.delete(key+'-lock')
-        mem.disconnect_all()
+        try:
+            if token is not None and mem.gets(key) == token:
+                mem.cas(key, _released, 1)
+        finally:
+            mem.reset_cas()
+            self._done(mem)
         
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
         """
-        mem = Client(self.servers)
+        mem = self._client()
         key = tile_key(layer, coord, format, self.revision, self.key_prefix)
         
         mem.delete(key)
-        mem.disconnect_all()
+        self._done(mem)
         
     def read(self, layer, coord, format):
         """ Read a cached tile.
         """
-        mem = Client(self.servers)
+        mem = self._client()
         key = tile_key(layer, coord, format, self.revision, self.key_prefix)
         
         value = mem.get(key)
-        mem.disconnect_all()
+        self._done(mem)
         
         return value
         
+    def read_many(self, layer, coords, format):
+        """ Read a list of cached tiles with a single get_multi().
+        
+            Returns a list of tile bodies, with None for missing tiles.
+        """
+        mem = self._client()
+        keys = [tile_key(layer, coord, format, self.revision, self.key_prefix) for coord in coords]
+        
+        values = mem.get_multi(keys)
+        self._done(mem)
+        
+        return [values.get(key) for key in keys]
+        
     def save(self, body, layer, coord, format):
         """ Save a cached tile.
         """
-        mem = Client(self.servers)
+        mem = self._client()
         key = tile_key(layer, coord, format, self.revision, self.key_prefix)
         
-        mem.set(key, body, layer.cache_lifespan or 0)
-        mem.disconnect_all()
+        mem.set(key, body, layer.cache_lifespan or 0, self._min_compress_len(format))
+        self._done(mem)
+        
+    def save_many(self, tiles, layer, format):
+        """ Save a list of (coord, body) tiles with a single set_multi().
+        """
+        mem = self._client()
+        mapping = dict([(tile_key(layer, coord, format, self.revision, self.key_prefix), body)
+                        for (coord, body) in tiles])
+        
+        mem.set_multi(mapping, layer.cache_lifespan or 0, min_compress_len=self._min_compress_len(format))
+        self._done(mem)
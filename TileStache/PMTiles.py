@@ -0,0 +1,585 @@
+""" Support for PMTiles single-file archives, version 3.
+
+PMTiles (https://github.com/protomaps/PMTiles) is a format for read-only
+tilesets in one file, designed to be served with HTTP range requests from
+plain file storage. Tiles are addressed by a single ID along a Hilbert
+curve at each zoom level, and found through a directory of runs of IDs
+with the offset and length of their content. Identical tiles are stored
+once, so large areas of ocean or empty land cost almost nothing.
+
+Read the spec:
+    https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md
+
+Example configuration:
+
+  {
+    "cache": { ... }.
+    "layers":
+    {
+      "roads":
+      {
+        "provider":
+        {
+          "name": "pmtiles",
+          "tileset": "collection.pmtiles"
+        }
+      }
+    }
+  }
+
+PMTiles provider parameters:
+
+  tileset:
+    Required local file path to a PMTiles archive.
+
+Archives are mapped into memory, and their directories are decoded once and
+binary-searched, so a tile lookup reads nothing but the tile itself.
+
+Archives are written with the write-only Cache below, which appends tiles
+to a temporary file as they arrive and builds the archive in Hilbert order
+when it's closed. See tilestache-seed.py --to-pmtiles.
+"""
+from bisect import bisect_right
+from urlparse import urlparse, urljoin
+from tempfile import mkstemp
+from threading import Lock
+from hashlib import md5
+from array import array
+from math import atan, sinh, pi, degrees
+from struct import Struct
+import logging
+import json
+import mmap
+import zlib
+import os
+
+from .Core import KnownUnknown
+from .MBTiles import TileResponse
+
+# magic string with spec version number 3.
+_magic = 'PMTiles\x03'
+
+# offsets and lengths of the root directory, metadata, leaf directories and
+# tile data, counts of tiles, entries and contents, clustered flag, internal
+# and tile compression, tile type, zoom range, bounds, and center.
+_header = Struct('<8s11Q6B4iB2i')
+
+# compression and tile type codes.
+_none, _gzip = 1, 2
+_tile_types = {'mvt': 1, 'pbf': 1, 'png': 2, 'jpg': 3, 'jpeg': 3, 'webp': 4}
+
+_mime_types = {1: ('application/vnd.mapbox-vector-tile', 'MVT'), 2: ('image/png', 'PNG'),
+               3: ('image/jpeg', 'JPEG'), 4: ('image/webp', 'WEBP')}
+
+# header and root directory must fit in the first 16KB of an archive.
+_root_limit = 16384 - _header.size
+
+# 64-bit unsigned integers for large lists of tile IDs and offsets.
+_uint64 = array('L').itemsize >= 8 and 'L' or 'd'
+
+def zxy_to_tileid(zoom, column, row):
+    """ Return the ID of a tile, counting along a Hilbert curve at each zoom.
+    """
+    if column < 0 or row < 0 or column >= 1 << zoom or row >= 1 << zoom:
+        raise ValueError('Tile %d/%d/%d is outside its zoom level' % (zoom, column, row))
+
+    # IDs of all tiles at lower zoom levels come first.
+    tileid = ((1 << (zoom * 2)) - 1) // 3
+    size, x, y = 1 << zoom, column, row
+    step = size >> 1
+
+    while step > 0:
+        rx, ry = int(x & step > 0), int(y & step > 0)
+        tileid += step * step * ((3 * rx) ^ ry)
+
+        if ry == 0:
+            if rx == 1:
+                x, y = size - 1 - x, size - 1 - y
+            x, y = y, x
+
+        step >>= 1
+
+    return tileid
+
+def tileid_to_zxy(tileid):
+    """ Return the (zoom, column, row) of a tile ID.
+    """
+    zoom, first = 0, 0
+
+    while first + (1 << (zoom * 2)) <= tileid:
+        first += 1 << (zoom * 2)
+        zoom += 1
+
+    position, x, y, step = tileid - first, 0, 0, 1
+
+    while step < 1 << zoom:
+        rx = 1 & (position // 2)
+        ry = 1 & (position ^ rx)
+
+        if ry == 0:
+            if rx == 1:
+                x, y = step - 1 - x, step - 1 - y
+            x, y = y, x
+
+        x, y = x + step * rx, y + step * ry
+        position //= 4
+        step <<= 1
+
+    return zoom, x, y
+
+def _write_varint(out, value):
+    """ Append an unsigned integer to a list of bytes in little-endian base 128.
+    """
+    value = int(value)
+
+    while value >= 0x80:
+        out.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+
+    out.append(chr(value))
+
+def _read_varints(data):
+    """ Generate unsigned integers from a string of little-endian base 128 bytes.
+    """
+    value, shift = 0, 0
+
+    for char in data:
+        byte = ord(char)
+        value |= (byte & 0x7f) << shift
+
+        if byte & 0x80:
+            shift += 7
+        else:
+            yield value
+            value, shift = 0, 0
+
+def _compress(data, compression):
+    """ Compress data for an archive.
+    """
+    if compression == _gzip:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    return data
+
+def _decompress(data, compression):
+    """ Decompress data from an archive.
+    """
+    if compression == _gzip:
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+    elif compression in (0, _none):
+        return data
+
+    raise KnownUnknown('PMTiles compression type %d is not supported' % compression)
+
+def _serialize_directory(entries, compression):
+    """ Encode a list of (tile ID, offset, length, run length) directory entries.
+
+        Offsets that follow on from the previous entry are written as zero.
+    """
+    out = []
+    _write_varint(out, len(entries))
+
+    last_id = 0
+    for (tileid, offset, length, run_length) in entries:
+        _write_varint(out, tileid - last_id)
+        last_id = tileid
+
+    for (tileid, offset, length, run_length) in entries:
+        _write_varint(out, run_length)
+
+    for (tileid, offset, length, run_length) in entries:
+        _write_varint(out, length)
+
+    last = None
+    for (tileid, offset, length, run_length) in entries:
+        if last is not None and offset == last[1] + last[2]:
+            _write_varint(out, 0)
+        else:
+            _write_varint(out, offset + 1)
+        last = tileid, offset, length
+
+    return _compress(''.join(out), compression)
+
+def _deserialize_directory(data, compression):
+    """ Decode a directory into lists of tile IDs, offsets, lengths and run lengths.
+    """
+    values = _read_varints(_decompress(data, compression))
+    count = values.next()
+
+    tileids, offsets, lengths, run_lengths = [], [], [], []
+
+    tileid = 0
+    for i in range(count):
+        tileid += values.next()
+        tileids.append(tileid)
+
+    run_lengths = [values.next() for i in range(count)]
+    lengths = [values.next() for i in range(count)]
+
+    for i in range(count):
+        value = values.next()
+
+        if value == 0 and i > 0:
+            offsets.append(offsets[i - 1] + lengths[i - 1])
+        else:
+            offsets.append(value - 1)
+
+    return tileids, offsets, lengths, run_lengths
+
+def _build_directories(entries, compression):
+    """ Return root and leaf directories for a sorted list of entries.
+
+        A single root directory is used if it fits, otherwise entries are
+        split into leaf directories, doubling their size until the root
+        directory of pointers to them fits.
+    """
+    root = _serialize_directory(entries, compression)
+
+    if len(root) <= _root_limit:
+        return root, ''
+
+    leaf_size = 4096
+
+    while True:
+        pointers, leaves, length = [], [], 0
+
+        for start in range(0, len(entries), leaf_size):
+            leaf = _serialize_directory(entries[start:start + leaf_size], compression)
+            pointers.append((entries[start][0], length, len(leaf), 0))
+            leaves.append(leaf)
+            length += len(leaf)
+
+        root = _serialize_directory(pointers, compression)
+
+        if len(root) <= _root_limit:
+            return root, ''.join(leaves)
+
+        leaf_size *= 2
+
+class Archive:
+    """ Read-only PMTiles archive, mapped into memory.
+    """
+    def __init__(self, filename):
+        file = open(filename, 'rb')
+
+        try:
+            self.mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            file.close()
+
+        if self.mapped[:len(_magic)] != _magic:
+            raise KnownUnknown('"%s" is not a PMTiles version 3 archive' % filename)
+
+        header = _header.unpack(self.mapped[:_header.size])
+
+        self.root_offset, self.root_length = header[1:3]
+        self.metadata_offset, self.metadata_length = header[3:5]
+        self.leaves_offset, self.data_offset = header[5], header[7]
+        self.internal_compression, self.tile_compression, self.tile_type = header[13:16]
+        self.min_zoom, self.max_zoom = header[16:18]
+
+        self.root = self._directory(self.root_offset, self.root_length)
+
+        # decoded leaf directories, by offset.
+        self.leaves = dict()
+        self.leaves_lock = Lock()
+
+    def _directory(self, offset, length):
+        """ Decode a directory at an offset in the archive.
+        """
+        return _deserialize_directory(self.mapped[offset:offset + length], self.internal_compression)
+
+    def _leaf(self, offset, length):
+        """ Return a leaf directory, decoding it if it's not in memory already.
+        """
+        with self.leaves_lock:
+            leaf = self.leaves.get(offset)
+
+        if leaf is None:
+            leaf = self._directory(self.leaves_offset + offset, length)
+
+            with self.leaves_lock:
+                if len(self.leaves) >= 256:
+                    # don't let the memory footprint grow without limit.
+                    self.leaves.clear()
+
+                self.leaves[offset] = leaf
+
+        return leaf
+
+    def metadata(self):
+        """ Return the metadata dictionary of the archive.
+        """
+        start, end = self.metadata_offset, self.metadata_offset + self.metadata_length
+        return json.loads(_decompress(self.mapped[start:end], self.internal_compression) or '{}')
+
+    def find(self, tileid):
+        """ Return the offset and length of a tile's content, or None.
+        """
+        tileids, offsets, lengths, run_lengths = self.root
+
+        # the spec allows at most three levels of leaf directories.
+        for depth in range(4):
+            index = bisect_right(tileids, tileid) - 1
+
+            if index < 0:
+                return None
+
+            if run_lengths[index] == 0:
+                tileids, offsets, lengths, run_lengths = self._leaf(offsets[index], lengths[index])
+                continue
+
+            if tileid < tileids[index] + run_lengths[index]:
+                return self.data_offset + offsets[index], lengths[index]
+
+            return None
+
+        return None
+
+    def get_tile(self, coord):
+        """ Return the content of a tile, decompressed if needed, or None.
+        """
+        if coord.zoom < self.min_zoom or coord.zoom > self.max_zoom:
+            return None
+
+        try:
+            found = self.find(zxy_to_tileid(coord.zoom, coord.column, coord.row))
+        except ValueError:
+            return None
+
+        if found is None:
+            return None
+
+        offset, length = found
+        return _decompress(self.mapped[offset:offset + length], self.tile_compression)
+
+class Provider:
+    """ PMTiles provider.
+
+        See module documentation for explanation of constructor arguments.
+    """
+    def __init__(self, layer, tileset):
+        """
+        """
+        sethref = urljoin(layer.config.dirpath, tileset)
+        scheme, h, path, q, p, f = urlparse(sethref)
+
+        if scheme not in ('file', ''):
+            raise Exception('Bad scheme in PMTiles provider, must be local file: "%s"' % scheme)
+
+        self.archive = Archive(path)
+        self.layer = layer
+
+    @staticmethod
+    def prepareKeywordArgs(config_dict):
+        """ Convert configured parameters to keyword args for __init__().
+        """
+        return {'tileset': config_dict['tileset']}
+
+    def renderTile(self, width, height, srs, coord):
+        """ Retrieve a single tile, return a TileResponse instance.
+        """
+        mime_type, format = _mime_types.get(self.archive.tile_type, (None, None))
+        return TileResponse(format, self.archive.get_tile(coord))
+
+    def getTypeByExtension(self, extension):
+        """ Get mime-type and format by file extension.
+
+            This only accepts the tile type of the archive.
+        """
+        tile_type = _tile_types.get(extension.lower())
+
+        if tile_type is None or tile_type != self.archive.tile_type:
+            raise KnownUnknown('PMTiles archive doesn\'t have "%s" tiles' % extension)
+
+        return _mime_types[tile_type]
+
+class Cache:
+    """ Write-only cache that builds a PMTiles archive, used by tilestache-seed.py.
+
+        Tiles are appended to a temporary file next to the archive as they
+        are saved, with identical tiles stored once. When the cache is closed
+        the archive is written with tiles in Hilbert order, runs of identical
+        neighboring tiles merged, and directories split into leaves if needed.
+        An aborted cache removes the temporary file and leaves any existing
+        archive alone.
+
+        Reads always miss. Constructor arguments are the archive filename,
+        the tile format, e.g. "png", and a name for the tileset metadata.
+    """
+    def __init__(self, filename, format, name):
+        self.filename = filename
+        self.format = format
+        self.name = name
+
+        handle, self.tmp_path = mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.pmtiles-tmp')
+        self.tmp_file = os.fdopen(handle, 'w+b')
+        self.length = 0
+
+        # tile IDs with offsets and lengths of their content in the temporary file.
+        self.tileids, self.offsets, self.lengths = array(_uint64), array(_uint64), array('L')
+
+        # offsets of tile contents by hash, to store identical tiles once.
+        self.contents = dict()
+
+        # zoom range and bounds in tile units of the world, from 0 to 1.
+        self.zooms = None
+        self.extent = None
+
+        self.write_lock = Lock()
+
+    def lock(self, layer, coord, format):
+        pass
+
+    def unlock(self, layer, coord, format):
+        pass
+
+    def remove(self, layer, coord, format):
+        pass
+
+    def read(self, layer, coord, format):
+        return None
+
+    def save(self, body, layer, coord, format):
+        """ Append a tile to the temporary file, unless it's there already.
+        """
+        tileid = zxy_to_tileid(coord.zoom, coord.column, coord.row)
+        digest = md5(body).digest()
+
+        with self.write_lock:
+            if digest not in self.contents:
+                self.tmp_file.write(body)
+                self.contents[digest] = self.length
+                self.length += len(body)
+
+            self.tileids.append(tileid)
+            self.offsets.append(self.contents[digest])
+            self.lengths.append(len(body))
+
+            size = float(1 << coord.zoom)
+            west, north = coord.column / size, coord.row / size
+            east, south = (coord.column + 1) / size, (coord.row + 1) / size
+
+            if self.extent is None:
+                self.zooms = [coord.zoom, coord.zoom]
+                self.extent = [west, north, east, south]
+            else:
+                self.zooms = [min(self.zooms[0], coord.zoom), max(self.zooms[1], coord.zoom)]
+                self.extent = [min(self.extent[0], west), min(self.extent[1], north),
+                               max(self.extent[2], east), max(self.extent[3], south)]
+
+    def save_many(self, tiles, layer, format):
+        """ Append a list of (coord, body) tiles to the temporary file.
+        """
+        for (coord, body) in tiles:
+            self.save(body, layer, coord, format)
+
+    def close(self):
+        """ Write the archive and remove the temporary file.
+        """
+        with self.write_lock:
+            if self.tmp_file.closed:
+                return
+
+            try:
+                self._write_archive()
+            finally:
+                self.tmp_file.close()
+                os.unlink(self.tmp_path)
+
+    def abort(self):
+        """ Remove the temporary file without writing the archive.
+        """
+        with self.write_lock:
+            if self.tmp_file.closed:
+                return
+
+            self.tmp_file.close()
+            os.unlink(self.tmp_path)
+
+    def _write_archive(self):
+        """ Write tiles from the temporary file to an archive in Hilbert order.
+        """
+        # the last save of each tile wins.
+        order = sorted(range(len(self.tileids)), key=lambda index: (self.tileids[index], index))
+        order = [index for (position, index) in enumerate(order)
+                 if position + 1 == len(order) or self.tileids[order[position + 1]] != self.tileids[index]]
+
+        # new offsets for contents in order of first use, and run-length entries.
+        moved, copies, entries, length = dict(), [], [], 0
+
+        for index in order:
+            tileid, old_offset, tile_length = int(self.tileids[index]), int(self.offsets[index]), int(self.lengths[index])
+
+            if old_offset not in moved:
+                moved[old_offset] = length
+                copies.append((old_offset, tile_length))
+                length += tile_length
+
+            offset = moved[old_offset]
+
+            if entries and entries[-1][1] == offset and entries[-1][0] + entries[-1][3] == tileid:
+                entries[-1][3] += 1
+            else:
+                entries.append([tileid, offset, tile_length, 1])
+
+        root, leaves = _build_directories(entries, _gzip)
+        metadata = _compress(json.dumps(dict(name=self.name, format=self.format, type='baselayer')), _gzip)
+
+        west, north, east, south = self.extent or (0, 0, 1, 1)
+        min_zoom, max_zoom = self.zooms or (0, 0)
+        lon1, lat1, lon2, lat2 = _lon(west), _lat(south), _lon(east), _lat(north)
+
+        root_offset = _header.size
+        metadata_offset = root_offset + len(root)
+        leaves_offset = metadata_offset + len(metadata)
+        data_offset = leaves_offset + len(leaves)
+
+        header = _header.pack(_magic, root_offset, len(root), metadata_offset, len(metadata),
+                              leaves_offset, len(leaves), data_offset, length,
+                              len(order), len(entries), len(copies), 1, _gzip, _none,
+                              _tile_types.get(self.format.lower(), 0), min_zoom, max_zoom,
+                              int(lon1 * 1e7), int(lat1 * 1e7), int(lon2 * 1e7), int(lat2 * 1e7),
+                              min_zoom, int((lon1 + lon2) * 5e6), int((lat1 + lat2) * 5e6))
+
+        handle, out_path = mkstemp(dir=os.path.dirname(self.tmp_path), suffix='.pmtiles-tmp')
+        out = os.fdopen(handle, 'wb')
+
+        try:
+            out.write(header + root + metadata + leaves)
+            self.tmp_file.flush()
+
+            for (old_offset, tile_length) in copies:
+                self.tmp_file.seek(old_offset)
+                out.write(self.tmp_file.read(tile_length))
+
+            out.close()
+            os.chmod(out_path, 0666 & ~_umask())
+            os.rename(out_path, self.filename)
+
+        except:
+            out.close()
+            os.unlink(out_path)
+            raise
+
+        logging.info('TileStache.PMTiles.Cache._write_archive() wrote %d tiles with %d distinct contents to %s',
+                     len(order), len(copies), self.filename)
+
+def _lon(x):
+    """ Return the longitude of a position in tile units of the world.
+    """
+    return x * 360. - 180.
+
+def _lat(y):
+    """ Return the latitude of a position in tile units of the world.
+    """
+    return degrees(atan(sinh(pi * (1 - 2 * y))))
+
+def _umask():
+    """ Return the current process umask.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
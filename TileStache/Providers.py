@@ -10,6 +10,7 @@ Built-in providers:
 - vector (TileStache.Vector.Provider)
 - url template (UrlTemplate)
 - mbtiles (TileStache.MBTiles.Provider)
+- pmtiles (TileStache.PMTiles.Provider)
 - mapnik grid (Mapnik.GridProvider)
 
 Example built-in provider, for JSON configuration file:
@@ -126,6 +127,10 @@ def getProviderByName(name):
         from . import MBTiles
         return MBTiles.Provider
 
+    elif name.lower() == 'pmtiles':
+        from . import PMTiles
+        return PMTiles.Provider
+
     elif name.lower() == 'mapnik grid':
         from . import Mapnik
         return Mapnik.GridProvider
@@ -36,11 +36,23 @@ Redis cache parameters:
     collisions (though the prefered solution is to use a different
     db number). The key prefix will be prepended to the
     key name. Defaults to "".
-    
 
+  max connections
+    Optional integer limit on connections in the pool shared by
+    all threads using this cache. Defaults to no limit.
+
+Tiles expire after the layer "cache lifespan" if one is set.
+
+Locks are stored under the tile key with "-lock" appended, holding a random
+token so only their owner can release them, and expire on their own after
+the layer "stale lock timeout". Releasing a lock publishes a message on a
+channel named after the lock key, so waiting processes wake up right away.
 """
 from __future__ import absolute_import
-from time import time as _time, sleep as _sleep
+from thread import get_ident as _thread_ident
+from uuid import uuid4 as _uuid4
+
+from ModestMaps.Core import Coordinate
 
 # We enabled absolute_import because case insensitive filesystems
 # cause this file to be loaded twice (the name of this file
@@ -53,6 +65,15 @@ except ImportError:
     # at least we can build the documentation
     pass
 
+# Delete a lock only if it still holds our token, then wake up any waiters.
+_unlock_script = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('del', KEYS[1])
+    redis.call('publish', KEYS[1], 'unlocked')
+    return 1
+end
+return 0
+"""
 
 def tile_key(layer, coord, format, key_prefix):
     """ Return a tile key string.
@@ -62,39 +83,88 @@ def tile_key(layer, coord, format, key_prefix):
     key = str('%(key_prefix)s/%(name)s/%(tile)s.%(format)s' % locals())
     return key
 
+def _escape_pattern(key):
+    """ Escape glob-style special characters in a key for SCAN MATCH.
+    """
+    for char in '\\*?[]':
+        key = key.replace(char, '\\' + char)
+    
+    return key
+
+def _parse_tile_key(name):
+    """ Return a (coord, format) tuple for a "zoom/column/row.format" key name, or None.
+    """
+    try:
+        zoom, column, filename = name.split('/')
+        row, format = filename.split('.')
+        
+        if format.endswith('-lock'):
+            return None
+        
+        return Coordinate(int(row), int(column), int(zoom)), format
+    
+    except ValueError:
+        return None
 
 class Cache:
     """
     """
-    def __init__(self, host="localhost", port=6379, db=0, key_prefix=''):
+    def __init__(self, host="localhost", port=6379, db=0, key_prefix='', max_connections=None):
         self.host = host
         self.port = port
         self.db = db
-        self.conn = redis.Redis(host=self.host, port=self.port, db=self.db)
+        self.pool = redis.ConnectionPool(host=self.host, port=self.port, db=self.db, max_connections=max_connections)
+        self.conn = redis.StrictRedis(connection_pool=self.pool)
         self.key_prefix = key_prefix
+        self.unlock_script = self.conn.register_script(_unlock_script)
+        
+        # tokens of locks held by this cache, by lock key and thread.
+        self.lock_tokens = {}
 
 
     def lock(self, layer, coord, format):
         """ Acquire a cache lock for this tile.
             Returns nothing, but blocks until the lock has been acquired.
         """
-        key = tile_key(layer, coord, format, self.key_prefix) + "-lock" 
-        due = _time() + layer.stale_lock_timeout
-
-        while _time() < due:
-            if self.conn.setnx(key, 'locked.'):
-                return
-
-            _sleep(.2)
-
-        self.conn.set(key, 'locked.')
-        return
+        key = tile_key(layer, coord, format, self.key_prefix) + "-lock"
+        token = _uuid4().hex
+        timeout = max(1, int(layer.stale_lock_timeout * 1000))
+        pubsub = None
+        
+        try:
+            while not self.conn.set(key, token, nx=True, px=timeout):
+                if pubsub is None:
+                    # subscribe before trying again, so a release can't be missed.
+                    pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(key)
+                    continue
+                
+                remaining = self.conn.pttl(key)
+                
+                if remaining == -1:
+                    # a lock from an older TileStache, without expiration.
+                    self.conn.pexpire(key, timeout)
+                    remaining = timeout
+                
+                if remaining > 0:
+                    # wait for a release message, or for the lock to expire.
+                    pubsub.get_message(timeout=remaining / 1000.)
+        finally:
+            if pubsub is not None:
+                pubsub.close()
+        
+        self.lock_tokens[(key, _thread_ident())] = token
         
     def unlock(self, layer, coord, format):
         """ Release a cache lock for this tile.
+        
+            Locks that expired and were taken over by someone else are left alone.
         """
-        key = tile_key(layer, coord, format, self.key_prefix)
-        self.conn.delete(key+'-lock')
+        key = tile_key(layer, coord, format, self.key_prefix) + "-lock"
+        token = self.lock_tokens.pop((key, _thread_ident()), None)
+        
+        if token is not None:
+            self.unlock_script(keys=[key], args=[token])
         
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
@@ -109,8 +179,60 @@ class Cache:
         value = self.conn.get(key)
         return value
         
+    def read_many(self, layer, coords, format):
+        """ Read a list of cached tiles in one round trip.
+        
+            Returns a list of tile bodies, with None for missing tiles.
+        """
+        keys = [tile_key(layer, coord, format, self.key_prefix) for coord in coords]
+        return keys and self.conn.mget(keys) or []
+        
+    def exists_many(self, layer, coords, format):
+        """ Return a list of booleans for tiles in the cache, in one round trip.
+        
+            Tiles expire on their own, so those found haven't.
+        """
+        pipe = self.conn.pipeline(transaction=False)
+        
+        for coord in coords:
+            pipe.exists(tile_key(layer, coord, format, self.key_prefix))
+        
+        return [bool(exists) for exists in pipe.execute()]
+        
+    def list_tiles(self, layer):
+        """ Generate (coord, format) tuples for every tile of a layer in the cache.
+        
+            Keys are scanned a thousand at a time, and locks are skipped.
+        """
+        prefix = '%s/%s/' % (self.key_prefix, layer.name())
+        
+        for key in self.conn.scan_iter(match=_escape_pattern(prefix) + '*', count=1000):
+            tile = _parse_tile_key(key[len(prefix):])
+            
+            if tile is not None:
+                yield tile
+        
     def save(self, body, layer, coord, format):
         """ Save a cached tile.
         """
         key = tile_key(layer, coord, format, self.key_prefix)
-        self.conn.set(key, body)
+        
+        if layer.cache_lifespan:
+            self.conn.setex(key, int(layer.cache_lifespan), body)
+        else:
+            self.conn.set(key, body)
+        
+    def save_many(self, tiles, layer, format):
+        """ Save a list of (coord, body) tiles in one round trip.
+        """
+        pipe = self.conn.pipeline(transaction=False)
+        
+        for (coord, body) in tiles:
+            key = tile_key(layer, coord, format, self.key_prefix)
+            
+            if layer.cache_lifespan:
+                pipe.setex(key, int(layer.cache_lifespan), body)
+            else:
+                pipe.set(key, body)
+        
+        pipe.execute()
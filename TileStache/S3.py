@@ -25,8 +25,13 @@ S3 cache parameters:
 
   use_locks
     Optional boolean flag for whether to use the locking feature on S3.
-    True by default. A good reason to set this to false would be the
-    additional price and time required for each lock set in S3.
+    False by default, because each lock costs extra S3 requests and two
+    processes rendering the same tile at once only waste a little work.
+    Locks are written with a conditional PUT, so only one can succeed,
+    and deleted with a conditional DELETE that only matches the lock's
+    own ETag, so a holder can't release a lock taken over by another.
+    This is still best-effort: services that ignore If-Match on DELETE
+    leave a short window between checking a lock and deleting it.
     
   path
     Optional path under bucket to use as the cache dir. ex. 'cache' will 
@@ -36,6 +41,20 @@ S3 cache parameters:
     If set to true, use S3's Reduced Redundancy Storage feature. Storage is
     cheaper but has lower redundancy on Amazon's servers. Defaults to false.
 
+  host
+    Optional hostname of an S3-compatible service to use instead of Amazon,
+    e.g. a local stand-in for testing. Buckets are then addressed by path.
+
+  port
+    Optional port number for host.
+
+  is_secure
+    Optional boolean flag for whether to connect with HTTPS. Defaults to true.
+
+  threads
+    Optional number of threads used to upload the tiles of a metatile
+    in parallel. Defaults to 8.
+
 Access and secret keys are under "Security Credentials" at your AWS account page:
   http://aws.amazon.com/account/
   
@@ -47,10 +66,18 @@ from time import time as _time, sleep as _sleep
 from mimetypes import guess_type
 from time import strptime, time
 from calendar import timegm
+from email.utils import formatdate
+from multiprocessing.pool import ThreadPool
+from thread import get_ident as _thread_ident
+from uuid import uuid4 as _uuid4
+import threading
+
+from ModestMaps.Core import Coordinate
 
 try:
     from boto.s3.bucket import Bucket as S3Bucket
-    from boto.s3.connection import S3Connection
+    from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+    from boto.exception import S3ResponseError
 except ImportError:
     # at least we can build the documentation
     pass
@@ -65,72 +92,247 @@ def tile_key(layer, coord, format, path = ''):
 
     return str('%(path)s/%(name)s/%(tile)s.%(ext)s' % locals())
 
+def _parse_tile_key(name):
+    """ Return a (coord, format) tuple for a "zoom/column/row.format" key name, or None.
+    """
+    try:
+        zoom, column, filename = name.split('/')
+        row, format = filename.split('.')
+        
+        if format.endswith('-lock'):
+            return None
+        
+        return Coordinate(int(row), int(column), int(zoom)), format
+    
+    except ValueError:
+        return None
+
 class Cache:
     """
     """
-    def __init__(self, bucket, access=None, secret=None, use_locks=True, path='', reduced_redundancy=False):
-        self.bucket = S3Bucket(S3Connection(access, secret), bucket)
+    def __init__(self, bucket, access=None, secret=None, use_locks=False, path='', reduced_redundancy=False, host=None, port=None, is_secure=True, threads=8):
+        self.bucket_name = bucket
+        self.access = access
+        self.secret = secret
         self.use_locks = bool(use_locks)
         self.path = path
         self.reduced_redundancy = reduced_redundancy
+        self.host = host
+        self.port = port
+        self.is_secure = bool(is_secure)
+        self.threads = int(threads)
+        
+        # boto connections aren't thread-safe, so each thread gets its own.
+        self.local = threading.local()
+        self.pool, self.pool_lock = None, threading.Lock()
+        
+        # ETags of locks held by this cache, by lock key name and thread.
+        self.lock_etags = {}
+        
+        # no request is made here, but boto looks for credentials right away.
+        self._bucket()
+    
+    def _bucket(self):
+        """ Return a Bucket with a kept-alive connection for this thread.
+        """
+        if not hasattr(self.local, 'bucket'):
+            if self.host:
+                conn = S3Connection(self.access, self.secret, host=self.host, port=self.port,
+                                    is_secure=self.is_secure, calling_format=OrdinaryCallingFormat())
+            else:
+                conn = S3Connection(self.access, self.secret, port=self.port, is_secure=self.is_secure)
+            
+            self.local.bucket = S3Bucket(conn, self.bucket_name)
+        
+        return self.local.bucket
 
     def lock(self, layer, coord, format):
         """ Acquire a cache lock for this tile.
         
             Returns nothing, but blocks until the lock has been acquired.
             Does nothing and returns immediately if `use_locks` is false.
+            
+            Each attempt is a single PUT that fails unless the lock is
+            absent, with waits between attempts growing up to a second.
+            Each lock has a unique body, and so a unique ETag. A lock is
+            only broken as stale if its ETag stays the same for the whole
+            stale lock timeout.
         """
         if not self.use_locks:
             return
         
-        key_name = tile_key(layer, coord, format, self.path)
+        key_name = tile_key(layer, coord, format, self.path) + '-lock'
+        headers = {'Content-Type': 'text/plain', 'If-None-Match': '*'}
         due = _time() + layer.stale_lock_timeout
+        delay, seen = .05, None
         
-        while _time() < due:
-            if not self.bucket.get_key(key_name+'-lock'):
-                break
+        while True:
+            key = self._bucket().new_key(key_name)
             
-            _sleep(.2)
-        
-        key = self.bucket.new_key(key_name+'-lock')
-        key.set_contents_from_string('locked.', {'Content-Type': 'text/plain'}, reduced_redundancy=self.reduced_redundancy)
+            try:
+                key.set_contents_from_string('locked %s.' % _uuid4().hex, headers, reduced_redundancy=self.reduced_redundancy)
+                self.lock_etags[(key_name, _thread_ident())] = key.etag
+                return
+            except S3ResponseError, e:
+                if e.status not in (409, 412):
+                    raise
+            
+            if seen is None:
+                seen = self._lock_etag(key_name)
+            
+            if _time() > due:
+                etag = self._lock_etag(key_name)
+                
+                if etag is not None and etag == seen:
+                    # someone left the door locked.
+                    self._delete_lock(key_name, etag)
+                
+                due, seen = _time() + layer.stale_lock_timeout, etag
+                continue
+            
+            _sleep(delay)
+            delay = min(delay * 2, 1.)
         
     def unlock(self, layer, coord, format):
         """ Release a cache lock for this tile.
+        
+            Locks that were broken and taken by someone else are left alone,
+            on a best-effort basis described under use_locks above.
         """
-        key_name = tile_key(layer, coord, format, self.path)
-        self.bucket.delete_key(key_name+'-lock')
+        if not self.use_locks:
+            return
+        
+        key_name = tile_key(layer, coord, format, self.path) + '-lock'
+        etag = self.lock_etags.pop((key_name, _thread_ident()), None)
+        
+        if etag is not None and self._lock_etag(key_name) == etag:
+            self._delete_lock(key_name, etag)
+    
+    def _lock_etag(self, key_name):
+        """ Return the ETag of a lock, or None if there is no lock.
+        """
+        key = self._bucket().get_key(key_name)
+        return key and key.etag
+    
+    def _delete_lock(self, key_name, etag):
+        """ Delete a lock, but only if it still has the given ETag.
+        """
+        try:
+            self._bucket().delete_key(key_name, headers={'If-Match': etag})
+        except S3ResponseError, e:
+            if e.status not in (404, 412):
+                raise
         
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
         """
         key_name = tile_key(layer, coord, format, self.path)
-        self.bucket.delete_key(key_name)
+        self._bucket().delete_key(key_name)
         
     def read(self, layer, coord, format):
         """ Read a cached tile.
+        
+            Makes a single GET request. With a layer cache lifespan, the
+            request is conditional so expired tiles aren't downloaded.
         """
         key_name = tile_key(layer, coord, format, self.path)
-        key = self.bucket.get_key(key_name)
-
-        if key is None:
-            return None
+        key = self._bucket().new_key(key_name)
+        headers = {}
         
         if layer.cache_lifespan:
+            headers['If-Modified-Since'] = formatdate(time() - layer.cache_lifespan, usegmt=True)
+        
+        try:
+            body = key.get_contents_as_string(headers)
+        except S3ResponseError, e:
+            if e.status in (304, 404):
+                # expired or missing.
+                return None
+            raise
+        
+        if layer.cache_lifespan and key.last_modified:
+            # in case If-Modified-Since was ignored.
             t = timegm(strptime(key.last_modified, '%a, %d %b %Y %H:%M:%S %Z'))
 
             if (time() - t) > layer.cache_lifespan:
                 return None
         
-        return key.get_contents_as_string()
+        return body
+        
+    def exists_many(self, layer, coords, format):
+        """ Return a list of booleans, true for each tile in the cache and not expired.
+        
+            Instead of a request for every tile, keys are listed a page at
+            a time for each column of tiles, from the first row asked about
+            to the last. Without a path, keys are listed both with and
+            without their leading slash, as in list_tiles().
+        """
+        columns, found = dict(), set()
+        
+        for coord in coords:
+            column, filename = tile_key(layer, coord, format, self.path).rsplit('/', 1)
+            columns.setdefault(column + '/', set()).add(filename)
+        
+        for (column, filenames) in columns.items():
+            first, last = min(filenames), max(filenames)
+            
+            for prefix in sorted(set([column, column.lstrip('/')])):
+                # the marker sorts just before the first key.
+                for key in self._bucket().list(prefix, marker=prefix + first.split('.')[0]):
+                    filename = key.name[len(prefix):]
+                    
+                    if filename > last:
+                        break
+                    
+                    if filename not in filenames:
+                        continue
+                    
+                    if layer.cache_lifespan and key.last_modified:
+                        t = timegm(strptime(key.last_modified[:19], '%Y-%m-%dT%H:%M:%S'))
+                        
+                        if (time() - t) > layer.cache_lifespan:
+                            continue
+                    
+                    found.add(column + filename)
+        
+        return [tile_key(layer, coord, format, self.path) in found for coord in coords]
+        
+    def list_tiles(self, layer):
+        """ Generate (coord, format) tuples for every tile of a layer in the cache.
+        
+            Keys are listed a thousand at a time, and locks are skipped.
+            Without a path, tile keys start with a slash that some services
+            drop, so keys are listed both with and without it.
+        """
+        prefix = '%s/%s/' % (self.path.strip('/'), layer.name())
+        
+        for prefix in sorted(set([prefix, prefix.lstrip('/')])):
+            for key in self._bucket().list(prefix):
+                tile = _parse_tile_key(key.name[len(prefix):])
+                
+                if tile is not None:
+                    yield tile
         
     def save(self, body, layer, coord, format):
         """ Save a cached tile.
         """
         key_name = tile_key(layer, coord, format, self.path)
-        key = self.bucket.new_key(key_name)
+        key = self._bucket().new_key(key_name)
         
         content_type, encoding = guess_type('example.'+format)
         headers = content_type and {'Content-Type': content_type} or {}
         
         key.set_contents_from_string(body, headers, policy='public-read', reduced_redundancy=self.reduced_redundancy)
+        
+    def save_many(self, tiles, layer, format):
+        """ Save a list of (coord, body) tiles, uploading them in parallel.
+        """
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.threads)
+        
+        def save(tile):
+            coord, body = tile
+            self.save(body, layer, coord, format)
+        
+        self.pool.map(save, tiles)
@@ -0,0 +1,227 @@
+""" Throughput statistics for long seeding runs, and a log of events for other programs to watch.
+
+Throughput counts tiles as they're seeded, by zoom level and by where each
+came from: rendered, read from the cache, cut from a metatile rendered for
+an earlier tile, copied from a tileset, skipped because it was already
+there, or failed. Rates are
+taken over the last minute so they follow a run that slows down, latency is
+a moving average for each zoom, and time left is projected from the rates.
+
+TimedCache wraps a cache to count the time spent in it and the tiles found,
+which tells time in the cache apart from time spent rendering. EventLog
+writes events as newline-delimited JSON, one object to a line, so another
+program can follow a run and see when it slows down.
+
+Used by tilestache-seed.py for --stats and --event-log.
+
+Example:
+
+    throughput = Throughput(1000, EventLog('seed.ndjson'))
+    throughput.add(Coordinate(1582, 656, 12), 'render', 24012, .35, .02)
+    throughput.skip(100)
+
+    print throughput.report()
+    # 101 of 1000 tiles (10.1%), 1.0 tiles/s, 23KB/s, 0% from cache, ...
+"""
+from collections import deque
+import json
+import time
+
+# where a tile came from, see Throughput.add().
+sources = ('render', 'cache', 'metatile', 'copied', 'skipped', 'failed')
+
+class Throughput:
+    """ Counts, rates and latencies of seeded tiles, and the projected time left.
+
+        Total is the number of tiles to seed, and events an optional EventLog
+        for a "tile" event for each tile and a "skipped" event for tiles left
+        out. Rates are taken over a window of recent seconds, and latency by
+        zoom is a moving average giving each new tile a weight of alpha.
+    """
+    def __init__(self, total, events=None, window=60, alpha=.05):
+        self.total = total
+        self.events = events
+        self.window = window
+        self.alpha = alpha
+
+        self.started = time.time()
+        self.reported = self.started
+        self.counts = dict([(source, 0) for source in sources])
+        self.bytes = 0
+        self.zooms = dict()
+
+        # [second, tiles, bytes] counted in each recent second.
+        self.recent = deque()
+
+    def add(self, coord, source, bytes=0, seconds=0, cache_seconds=0):
+        """ Count one tile from a source, with its size and seconds taken.
+
+            Source is one of "render", "cache", "metatile", "copied" or "failed", and
+            cache_seconds is the part of seconds spent in the cache.
+        """
+        zoom = coord.zoom
+        self.counts[source] += 1
+        self.bytes += bytes
+
+        if zoom not in self.zooms:
+            self.zooms[zoom] = {'tiles': 0, 'bytes': 0, 'latency': seconds,
+                                'cache seconds': 0., 'render seconds': 0.}
+
+        stats = self.zooms[zoom]
+        stats['tiles'] += 1
+        stats['bytes'] += bytes
+        stats['latency'] += self.alpha * (seconds - stats['latency'])
+        stats['cache seconds'] += cache_seconds
+        stats['render seconds'] += max(seconds - cache_seconds, 0)
+
+        second = int(time.time())
+
+        if self.recent and self.recent[-1][0] == second:
+            self.recent[-1][1] += 1
+            self.recent[-1][2] += bytes
+        else:
+            self.recent.append([second, 1, bytes])
+
+        if self.events:
+            self.events.write('tile', zoom=zoom, column=coord.column, row=coord.row, source=source,
+                              bytes=bytes, seconds=round(seconds, 6), cache_seconds=round(cache_seconds, 6))
+
+    def skip(self, count):
+        """ Count tiles left out without seeding them, e.g. already in the cache.
+        """
+        self.counts['skipped'] += count
+
+        if self.events:
+            self.events.write('skipped', tiles=count)
+
+    def stats(self):
+        """ Return a dictionary of counts, rates, and latencies by zoom.
+
+            Rates are in tiles and bytes per second over the recent window,
+            the hit ratio is the share of tiles seeded that were read from
+            the cache, and "eta" is the projected number of seconds left, or
+            None before there's a rate to go by. The time of the call is
+            kept as reported, to help report stats at intervals.
+        """
+        now = self.reported = time.time()
+
+        while self.recent and self.recent[0][0] <= now - self.window:
+            self.recent.popleft()
+
+        span = float(max(min(now - self.started, self.window), 1))
+        tile_rate = sum([tiles for (second, tiles, bytes) in self.recent]) / span
+        byte_rate = sum([bytes for (second, tiles, bytes) in self.recent]) / span
+
+        done = sum(self.counts.values())
+        seeded = sum([self.counts[source] for source in ('render', 'cache', 'metatile', 'copied')])
+
+        zooms = dict([(str(zoom), dict(self.zooms[zoom])) for zoom in self.zooms])
+        eta = None
+
+        if tile_rate:
+            eta = max(self.total - done, 0) / tile_rate
+
+        return {'tiles': done, 'total': self.total, 'bytes': self.bytes,
+                'elapsed': now - self.started, 'counts': dict(self.counts),
+                'tiles per second': tile_rate, 'bytes per second': byte_rate,
+                'hit ratio': seeded and float(self.counts['cache']) / seeded,
+                'eta': eta,
+                'zooms': zooms}
+
+    def report(self):
+        """ Return a one-line summary of stats(), to show progress.
+        """
+        stats = self.stats()
+
+        line = '%d of %d tiles (%.1f%%), %.1f tiles/s, %dKB/s, %.0f%% from cache' \
+             % (stats['tiles'], stats['total'], stats['total'] and 100. * stats['tiles'] / stats['total'],
+                stats['tiles per second'], stats['bytes per second'] / 1024, 100. * stats['hit ratio'])
+
+        if stats['eta'] is not None:
+            line += ', %s left' % _duration(stats['eta'])
+
+        latencies = ['%s: %.3fs' % (zoom, self.zooms[zoom]['latency']) for zoom in sorted(self.zooms)]
+        cache = sum([zoom['cache seconds'] for zoom in self.zooms.values()])
+        render = sum([zoom['render seconds'] for zoom in self.zooms.values()])
+
+        if latencies:
+            line += '; latency by zoom %s' % ', '.join(latencies)
+
+        if cache + render:
+            line += '; %.0f%% of time in the cache' % (100. * cache / (cache + render))
+
+        return line
+
+class TimedCache:
+    """ Wraps a cache to count the seconds spent in it, and the tiles read from it.
+
+        Optional methods of the cache like save_many() or close() are passed
+        through, and time in read_many() and save_many() is counted too.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.seconds = 0.
+        self.hits = 0
+
+    def lock(self, layer, coord, format):
+        return self._timed(self.cache.lock, layer, coord, format)
+
+    def unlock(self, layer, coord, format):
+        return self._timed(self.cache.unlock, layer, coord, format)
+
+    def remove(self, layer, coord, format):
+        return self._timed(self.cache.remove, layer, coord, format)
+
+    def read(self, layer, coord, format):
+        body = self._timed(self.cache.read, layer, coord, format)
+
+        if body is not None:
+            self.hits += 1
+
+        return body
+
+    def save(self, body, layer, coord, format):
+        return self._timed(self.cache.save, body, layer, coord, format)
+
+    def __getattr__(self, name):
+        if name == 'cache':
+            # not set up yet, e.g. while unpickling.
+            raise AttributeError(name)
+
+        method = getattr(self.cache, name)
+
+        if name not in ('read_many', 'save_many'):
+            return method
+
+        return lambda *args: self._timed(method, *args)
+
+    def _timed(self, method, *args):
+        start = time.time()
+
+        try:
+            return method(*args)
+        finally:
+            self.seconds += time.time() - start
+
+class EventLog:
+    """ Writes events as lines of JSON to a file, each with a type and a time.
+
+        Lines are written as they come, so another program can follow along.
+    """
+    def __init__(self, filename):
+        self.file = open(filename, 'a', 1)
+
+    def write(self, event, **fields):
+        """ Write one event, e.g. write('tile', zoom=12, column=656, row=1582).
+        """
+        fields.update(event=event, time=round(time.time(), 3))
+        self.file.write(json.dumps(fields, sort_keys=True) + '\n')
+
+    def close(self):
+        self.file.close()
+
+def _duration(seconds):
+    """ Return a number of seconds as hours, minutes and seconds, e.g. "1:02:03".
+    """
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds / 3600, seconds / 60 % 60, seconds % 60)
@@ -48,6 +48,9 @@ parser.add_option('-p', '--padding', dest='padding',
                   help='Extra margin of tiles to add around bounded area. Default value is %s (no extra tiles).' % repr(defaults['padding']),
                   type='int')
 
+parser.add_option('-g', '--geometry', dest='geometry',
+                  help='Optional GeoJSON file of polygons, lines or points in longitude and latitude. Only tiles touching them are cleaned, plus --padding, instead of every tile in a bounding box. Overrides --bbox, and needs shapely.')
+
 parser.add_option('-e', '--extension', dest='extension',
                   help='Optional file type for rendered tiles. Default value is %s.' % repr(defaults['extension']))
 
@@ -63,38 +66,18 @@ parser.add_option('-i', '--include-path', dest='include',
 parser.add_option('--tile-list', dest='tile_list',
                   help='Optional file of tile coordinates, a simple text list of Z/X/Y coordinates. Overrides --bbox and --padding.')
 
-def generateCoordinates(ul, lr, zooms, padding):
-    """ Generate a stream of (offset, count, coordinate) tuples for seeding.
+def generateCoordinates(ul, lr, zooms, padding, coverage=None):
+    """ Generate a stream of (offset, count, coordinate) tuples for cleaning.
     
         Flood-fill coordinates based on two corners, a list of zooms and padding.
+        With a TileStache.Coverage, only tiles touching its area are included.
     """
-    # start with a simple total of all the coordinates we will need.
-    count = 0
-    
-    for zoom in zooms:
-        ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
-        lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
-        
-        rows = lr_.row + 1 - ul_.row
-        cols = lr_.column + 1 - ul_.column
-        
-        count += int(rows * cols)
-
-    # now generate the actual coordinates.
-    # offset starts at zero
-    offset = 0
+    within = coverage and coverage.test or None
+    ranges = tile_ranges(ul, lr, zooms, padding, 'row', within)
+    count = count_tiles(ranges, zooms, within)
     
-    for zoom in zooms:
-        ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
-        lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
-
-        for row in range(int(ul_.row), int(lr_.row + 1)):
-            for column in range(int(ul_.column), int(lr_.column + 1)):
-                coord = Coordinate(row, column, zoom)
-                
-                yield (offset, count, coord)
-                
-                offset += 1
+    for (offset, (zoom, row, column)) in enumerate(walk_tiles('row', ranges, zooms, within=within)):
+        yield (offset, count, Coordinate(row, column, zoom))
 
 def listCoordinates(filename):
     """ Generate a stream of (offset, count, coordinate) tuples for seeding.
@@ -120,9 +103,10 @@ if __name__ == '__main__':
     from TileStache import parseConfigfile, getTile
     from TileStache.Core import KnownUnknown
     from TileStache.Caches import Disk, Multi
+    from TileStache.Curves import walk_tiles, count_tiles, tile_ranges
+    from TileStache.Coverage import tile_area
     
     from ModestMaps.Core import Coordinate
-    from ModestMaps.Geo import Location
 
     try:
         if options.config is None:
@@ -148,13 +132,6 @@ if __name__ == '__main__':
         extension = options.extension
         progressfile = options.progressfile
         
-        lat1, lon1, lat2, lon2 = options.bbox
-        south, west = min(lat1, lat2), min(lon1, lon2)
-        north, east = max(lat1, lat2), max(lon1, lon2)
-
-        northwest = Location(north, west)
-        southeast = Location(south, east)
-
         for (i, zoom) in enumerate(zooms):
             if not zoom.isdigit():
                 raise KnownUnknown('"%s" is not a valid numeric zoom level.' % zoom)
@@ -166,19 +143,19 @@ if __name__ == '__main__':
 
         padding = options.padding
         tile_list = options.tile_list
+        
+        # layers may each have their own projection.
+        areas = [tile_area(layer.projection, options.bbox, options.geometry, padding) for layer in layers]
 
     except KnownUnknown, e:
         parser.error(str(e))
 
-    for layer in layers:
+    for (layer, (ul, lr, coverage)) in zip(layers, areas):
 
         if tile_list:
             coordinates = listCoordinates(tile_list)
         else:
-            ul = layer.projection.locationCoordinate(northwest)
-            lr = layer.projection.locationCoordinate(southeast)
-    
-            coordinates = generateCoordinates(ul, lr, zooms, padding)
+            coordinates = generateCoordinates(ul, lr, zooms, padding, coverage)
         
         for (offset, count, coord) in coordinates:
             path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
@@ -13,10 +13,11 @@ from sys import stderr, path
 from optparse import OptionParser
 
 from TileStache.Core import KnownUnknown
+from TileStache.Curves import walk_tiles, tile_ranges
+from TileStache.Coverage import tile_area
 from TileStache import MBTiles
 
 from ModestMaps.Core import Coordinate
-from ModestMaps.Geo import Location
 from ModestMaps.OpenStreetMap import Provider
 
 parser = OptionParser(usage="""%prog [options] [zoom...]
@@ -29,14 +30,14 @@ Example:
 
     tilestache-list.py -b 52.55 13.28 52.46 13.51 11 12 13
 
-Protip: seed a cache in parallel on 8 CPUs with split and xargs like this:
+Protip: seed a cache in parallel on 8 CPUs with a tile list like this:
 
-    tilestache-list.py 12 13 14 15 | split -l 20 - tiles/list-
-    ls -1 tiles/list-* | xargs -n1 -P8 tilestache-seed.py -c tilestache.cfg -l osm --tile-list
+    tilestache-list.py 12 13 14 15 > tiles.txt
+    tilestache-seed.py -c tilestache.cfg -l osm --tile-list tiles.txt --jobs 8
 
 See `%prog --help` for info.""")
 
-defaults = dict(padding=0, bbox=(37.777, -122.352, 37.839, -122.226))
+defaults = dict(padding=0, order='row', interleave=False, bbox=(37.777, -122.352, 37.839, -122.226))
 
 parser.set_defaults(**defaults)
 
@@ -48,70 +49,49 @@ parser.add_option('-p', '--padding', dest='padding',
                   help='Extra margin of tiles to add around bounded area. Default value is %s (no extra tiles).' % repr(defaults['padding']),
                   type='int')
 
+parser.add_option('-g', '--geometry', dest='geometry',
+                  help='Optional GeoJSON file of polygons, lines or points in longitude and latitude. Only tiles touching them are listed, plus --padding, instead of every tile in a bounding box. Overrides --bbox, and needs shapely.')
+
+parser.add_option('--order', dest='order',
+                  help='Order of tiles within the bounding box: "row" by row, or along a "zorder" or "hilbert" curve, which keep tiles close in order close on the map. Default value is %s.' % repr(defaults['order']),
+                  type='choice', choices=('row', 'zorder', 'hilbert'))
+
+parser.add_option('--interleave-zooms', dest='interleave', action='store_true',
+                  help='List each tile before the tiles under it at higher zoom levels, instead of one zoom level after another. Needs a --order curve.')
+
 parser.add_option('--from-mbtiles', dest='mbtiles_input',
                   help='Optional input file for tiles, will be read as an MBTiles 1.1 tileset. See http://mbtiles.org for more information. Overrides --bbox and --padding.')
 
-def generateCoordinates(ul, lr, zooms, padding):
+def generateCoordinates(ul, lr, zooms, padding, order='row', interleave=False, coverage=None):
     """ Generate a stream of coordinates for seeding.
     
         Flood-fill coordinates based on two corners, a list of zooms and padding.
+        Order is "row", "zorder" or "hilbert", see TileStache.Curves, and
+        interleave puts parent tiles before their children. With a
+        TileStache.Coverage, only tiles touching its area are included.
     """
-    # start with a simple total of all the coordinates we will need.
-    count = 0
-    
-    for zoom in zooms:
-        ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
-        lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
-        
-        rows = lr_.row + 1 - ul_.row
-        cols = lr_.column + 1 - ul_.column
-        
-        count += int(rows * cols)
-
-    # now generate the actual coordinates.
-    # offset starts at zero
-    offset = 0
+    within = coverage and coverage.test or None
+    ranges = tile_ranges(ul, lr, range(max(zooms + [0]) + 1), padding, order, within)
     
-    for zoom in zooms:
-        ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
-        lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
-
-        for row in range(int(ul_.row), int(lr_.row + 1)):
-            for column in range(int(ul_.column), int(lr_.column + 1)):
-                coord = Coordinate(row, column, zoom)
-                
-                yield coord
-                offset += 1
+    for (zoom, row, column) in walk_tiles(order, ranges, zooms, interleave=interleave, within=within):
+        yield Coordinate(row, column, zoom)
 
 def tilesetCoordinates(filename):
     """ Generate a stream of (offset, count, coordinate) tuples for seeding.
     
         Read coordinates from an MBTiles tileset filename.
     """
-    coords = MBTiles.list_tiles(filename)
-    count = len(coords)
-    
-    for (offset, coord) in enumerate(coords):
+    for coord in MBTiles.iter_tiles(filename):
         yield coord
 
 if __name__ == '__main__':
     options, zooms = parser.parse_args()
 
     if bool(options.mbtiles_input):
-        coordinates = MBTiles.list_tiles(options.mbtiles_input)
+        coordinates = MBTiles.iter_tiles(options.mbtiles_input)
 
     else:
-        lat1, lon1, lat2, lon2 = options.bbox
-        south, west = min(lat1, lat2), min(lon1, lon2)
-        north, east = max(lat1, lat2), max(lon1, lon2)
-
-        northwest = Location(north, west)
-        southeast = Location(south, east)
-        
-        osm = Provider()
-
-        ul = osm.locationCoordinate(northwest)
-        lr = osm.locationCoordinate(southeast)
+        ul, lr, coverage = tile_area(Provider(), options.bbox, options.geometry, options.padding)
 
         for (i, zoom) in enumerate(zooms):
             if not zoom.isdigit():
@@ -122,7 +102,10 @@ if __name__ == '__main__':
         if options.padding < 0:
             raise KnownUnknown('A negative padding will not work.')
 
-        coordinates = generateCoordinates(ul, lr, zooms, options.padding)
+        if options.interleave and options.order == 'row':
+            raise KnownUnknown('Zooms can only be interleaved with a --order curve, "zorder" or "hilbert".')
+
+        coordinates = generateCoordinates(ul, lr, zooms, options.padding, options.order, options.interleave, coverage)
     
     for coord in coordinates:
         print '%(zoom)d/%(column)d/%(row)d' % coord.__dict__
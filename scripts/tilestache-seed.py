@@ -14,6 +14,14 @@ from os.path import realpath, dirname
 from optparse import OptionParser
 from urlparse import urlparse
 from urllib import urlopen
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
+from traceback import format_exc
+from Queue import Queue, Empty
+from collections import OrderedDict
+from itertools import groupby, islice, chain
+from time import time
+import signal
 
 try:
     from json import dump as json_dump
@@ -41,11 +49,26 @@ Protip: extract tiles from an MBTiles tileset to a directory like this:
 
     tilestache-seed.py --from-mbtiles filename.mbtiles --output-directory dirname
 
+Add --copy-raw to save the raw tiles of the tileset straight to the cache,
+skipping the provider and getTile().
+
+Protip: seed on 8 CPUs at once with --jobs 8. Ctrl-C stops handing out tiles,
+lets the tiles being rendered finish, and closes the cache.
+
+Protip: keep track of seeded tiles with --resume filename.done, and run the
+same command again to pick up after an interruption. See how far a run got
+at any time with --resume filename.done --coverage.
+
+Protip: watch a long run with --stats for tiles per second, time left and
+latency by zoom level, or follow --event-log filename.ndjson from another
+program to see when it slows down.
+
 Configuration, bbox, and layer options are required; see `%prog --help` for info.""")
 
-defaults = dict(padding=0, verbose=True, enable_retries=False, bbox=(37.777, -122.352, 37.839, -122.226))
+defaults = dict(padding=0, verbose=True, enable_retries=False, jobs=1, order='row', interleave=False, bbox=(37.777, -122.352, 37.839, -122.226))
 
-parser.set_defaults(**defaults)
+# bbox default is applied later, so --from-mbtiles can tell if one was given.
+parser.set_defaults(**dict(defaults, bbox=None))
 
 parser.add_option('-c', '--config', dest='config',
                   help='Path to configuration file, typically required.')
@@ -61,6 +84,9 @@ parser.add_option('-p', '--padding', dest='padding',
                   help='Extra margin of tiles to add around bounded area. Default value is %s (no extra tiles).' % repr(defaults['padding']),
                   type='int')
 
+parser.add_option('-g', '--geometry', dest='geometry',
+                  help='Optional GeoJSON file of polygons, lines or points in longitude and latitude. Only tiles touching them are seeded, plus --padding, instead of every tile in a bounding box. Overrides --bbox, and needs shapely.')
+
 parser.add_option('-e', '--extension', dest='extension',
                   help='Optional file type for rendered tiles. Default value is "png" for most image layers and some variety of JSON for Vector or Mapnik Grid providers.')
 
@@ -79,15 +105,21 @@ parser.add_option('-d', '--output-directory', dest='outputdirectory',
 parser.add_option('--to-mbtiles', dest='mbtiles_output',
                   help='Optional output file for tiles, will be created as an MBTiles 1.1 tileset. See http://mbtiles.org for more information.')
 
+parser.add_option('--to-pmtiles', dest='pmtiles_output',
+                  help='Optional output file for tiles, will be created as a PMTiles version 3 archive when seeding is done and left alone if seeding fails or is interrupted, with identical tiles stored once. See https://github.com/protomaps/PMTiles for more information.')
+
 parser.add_option('--to-s3', dest='s3_output',
                   help='Optional output bucket for tiles, will be populated with tiles in a standard Z/X/Y layout. Three required arguments: AWS access-key, secret, and bucket name.',
                   nargs=3)
 
 parser.add_option('--from-mbtiles', dest='mbtiles_input',
-                  help='Optional input file for tiles, will be read as an MBTiles 1.1 tileset. See http://mbtiles.org for more information. Overrides --extension, --bbox and --padding (this may change).')
+                  help='Optional input file for tiles, will be read as an MBTiles 1.1 tileset. See http://mbtiles.org for more information. Overrides --extension and --padding, and tiles are only limited by --bbox or zoom levels if given.')
+
+parser.add_option('--copy-raw', dest='copy_raw', action='store_true',
+                  help='Copy raw tiles from the --from-mbtiles tileset straight to the cache as they are, skipping the provider and getTile() instead of rendering each tile through the layer. Not with --tile-list, --jsonp-callback, --jobs, --skip-existing or --resume.')
 
 parser.add_option('--tile-list', dest='tile_list',
-                  help='Optional file of tile coordinates, a simple text list of Z/X/Y coordinates. Overrides --bbox and --padding.')
+                  help='Optional file of tile coordinates, a simple text list of Z/X/Y coordinates. Overrides --bbox and --padding. Tiles in the same metatile are seeded together.')
 
 parser.add_option('--error-list', dest='error_list',
                   help='Optional file of failed tile coordinates, a simple text list of Z/X/Y coordinates. If provided, failed tiles will be logged to this file instead of stopping tilestache-seed.')
@@ -99,67 +131,530 @@ parser.add_option('--enable-retries', dest='enable_retries',
 parser.add_option('-x', '--ignore-cached', action='store_true', dest='ignore_cached',
                   help='Re-render every tile, whether it is in the cache already or not.')
 
+parser.add_option('--skip-existing', action='store_true', dest='skip_existing',
+                  help='Leave out tiles already in the cache and not expired, checked a thousand at a time without reading them, e.g. by listing S3 keys or cache directories. Only missing or expired tiles are rendered, so seeding an area again is cheap. Not with --ignore-cached.')
+
 parser.add_option('--jsonp-callback', dest='callback',
                   help='Add a JSONP callback for tiles with a json mime-type, causing "*.js" tiles to be written to the cache wrapped in the callback function. Ignored for non-JSON tiles.')
 
-def generateCoordinates(ul, lr, zooms, padding):
+parser.add_option('--order', dest='order',
+                  help='Order of tiles within the bounding box: "row" by row, or along a "zorder" or "hilbert" curve, which keep tiles close in order close on the map for better use of database and renderer caches. Default value is %s.' % repr(defaults['order']),
+                  type='choice', choices=('row', 'zorder', 'hilbert'))
+
+parser.add_option('--interleave-zooms', dest='interleave', action='store_true',
+                  help='Seed each tile before the tiles under it at higher zoom levels, instead of one zoom level after another. Needs a --order curve, and square metatiles of 1, 2, 4, 8... tiles.')
+
+parser.add_option('--resume', dest='resume',
+                  help='Optional completion file with one bit for each tile, created if needed and written every few seconds with the tiles seeded so far. Tiles already marked in it are skipped without touching the cache, so an interrupted run can be picked up by running it again with the same options. Works with a bounding box or --tile-list, but not with --to-pmtiles or tiles read from --from-mbtiles.')
+
+parser.add_option('--coverage', dest='coverage', action='store_true',
+                  help='Report how many tiles at each zoom level are marked in the --resume completion file, and exit without seeding.')
+
+parser.add_option('--stats', dest='stats', action='store_true',
+                  help='Report throughput every ten seconds and when done, even with -q: tiles and bytes per second over the last minute, share of tiles read from the cache, time left, moving average latency by zoom level, and share of time spent in the cache.')
+
+parser.add_option('--event-log', dest='event_log',
+                  help='Optional file to append newline-delimited JSON events to as seeding goes: "start", "tile" for each tile, "skipped" for tiles left out, "stats" every ten seconds, and "end" with the final stats.')
+
+parser.add_option('-j', '--jobs', dest='jobs',
+                  help='Number of processes rendering tiles at once, each with its own copy of the configuration. Idle processes take the next tiles in line, while progress, errors and output to --to-mbtiles or --to-pmtiles are handled by the main process. Default value is %s.' % repr(defaults['jobs']),
+                  type='int')
+
+def generateCoordinates(ul, lr, zooms, padding, metatile=None, order='row', interleave=False, coverage=None):
     """ Generate a stream of (offset, count, coordinate) tuples for seeding.
     
         Flood-fill coordinates based on two corners, a list of zooms and padding.
+        With a metatile, coordinates come one metatile at a time. Order is
+        "row", "zorder" or "hilbert", see TileStache.Curves, and interleave
+        puts parent tiles before their children instead of zoom after zoom.
+        With a TileStache.Coverage, only tiles touching its area are included.
     """
-    # start with a simple total of all the coordinates we will need.
-    count = 0
+    within = coverage and coverage.test or None
+    ranges = tile_ranges(ul, lr, range(max(zooms + [0]) + 1), padding, order, within)
     
-    for zoom in zooms:
-        ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
-        lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
-        
-        rows = lr_.row + 1 - ul_.row
-        cols = lr_.column + 1 - ul_.column
-        
-        count += int(rows * cols)
+    # start with a total of all the coordinates we will need.
+    count = count_tiles(ranges, zooms, within)
 
     # now generate the actual coordinates.
-    # offset starts at zero
-    offset = 0
+    metatile = metatile or Metatile()
+    tiles = walk_tiles(order, ranges, zooms, metatile.rows, metatile.columns, interleave, within)
     
-    for zoom in zooms:
-        ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
-        lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
+    for (offset, (zoom, row, column)) in enumerate(tiles):
+        yield (offset, count, Coordinate(row, column, zoom))
 
-        for row in xrange(int(ul_.row), int(lr_.row + 1)):
-            for column in xrange(int(ul_.column), int(lr_.column + 1)):
-                coord = Coordinate(row, column, zoom)
-                
-                yield (offset, count, coord)
-                
-                offset += 1
+def coordinateRanges(coords):
+    """ Return dictionaries of tile ranges and numbers of tiles by zoom for a list of coordinates.
+    
+        Ranges are (top, left, bottom, right) tuples, with bottom and right excluded.
+    """
+    ranges, tiles = dict(), dict()
+    
+    for coord in coords:
+        zoom, row, column = coord.zoom, int(coord.row), int(coord.column)
+        top, left, bottom, right = ranges.get(zoom, (row, column, row + 1, column + 1))
+        ranges[zoom] = min(top, row), min(left, column), max(bottom, row + 1), max(right, column + 1)
+        tiles.setdefault(zoom, set()).add((row, column))
+    
+    return ranges, dict([(zoom, len(tiles[zoom])) for zoom in tiles])
 
-def listCoordinates(filename):
+def listCoordinates(filename, metatile=None):
     """ Generate a stream of (offset, count, coordinate) tuples for seeding.
     
         Read coordinates from a file with one Z/X/Y coordinate per line.
+        With a metatile, coordinates in the same metatile are kept together.
     """
     coords = (line.strip().split('/') for line in open(filename, 'r'))
     coords = (map(int, (row, column, zoom)) for (zoom, column, row) in coords)
     coords = [Coordinate(*args) for args in coords]
     
+    if metatile:
+        metatiles = OrderedDict()
+        
+        for coord in coords:
+            metatiles.setdefault(metatile.firstCoord(coord), []).append(coord)
+        
+        coords = list(chain.from_iterable(metatiles.values()))
+    
     count = len(coords)
     
     for (offset, coord) in enumerate(coords):
         yield (offset, count, coord)
 
-def tilesetCoordinates(filename):
+def tilesetCoordinates(filename, zooms=None, extent=None):
     """ Generate a stream of (offset, count, coordinate) tuples for seeding.
     
         Read coordinates from an MBTiles tileset filename.
     """
-    coords = MBTiles.list_tiles(filename)
-    count = len(coords)
+    count = MBTiles.count_tiles(filename, zooms, extent)
+    coords = MBTiles.iter_tiles(filename, zooms, extent)
     
     for (offset, coord) in enumerate(coords):
         yield (offset, count, coord)
 
+def copyTileset(filename, zooms, extent, layer, extension, options, throughput):
+    """ Copy raw tiles from an MBTiles tileset filename to the layer cache.
+    
+        Tile contents are saved as-is, skipping the provider and getTile().
+    """
+    mimetype, format = layer.getTypeByExtension(extension)
+    count = MBTiles.count_tiles(filename, zooms, extent)
+    tiles = MBTiles.iter_tiles(filename, zooms, extent, content=True)
+    
+    for (offset, (coord, content)) in enumerate(tiles):
+        content, start = str(content), time()
+        layer.config.cache.save(content, layer, coord, format)
+        
+        # copying a tile is all time in the cache.
+        seconds = time() - start
+        recordThroughput(coord, dict(source='copied', bytes=len(content), seconds=seconds, cache_seconds=seconds), throughput, options)
+        
+        path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
+
+        progress = {"tile": path,
+                    "offset": offset + 1,
+                    "total": count,
+                    "size": '%dKB' % (len(content) / 1024)}
+        
+        if options.verbose:
+            print >> stderr, '%(offset)d of %(total)d... %(tile)s (%(size)s)' % progress
+        
+        writeProgress(progress, options)
+
+def seedTile(layer, coord, extension, options, progress, verbose):
+    """ Render one tile, trying again if retries are enabled.
+    
+        Return true if it was rendered, or false if it failed and there's an
+        error list to write it to. Otherwise failures raise their exception.
+    """
+    attempts = options.enable_retries and 3 or 1
+    
+    while True:
+        if verbose:
+            print >> stderr, '%(offset)d of %(total)d...' % progress,
+
+        try:
+            mimetype, content = getTile(layer, coord, extension, options.ignore_cached)
+        
+            if mimetype and 'json' in mimetype and options.callback:
+                js_path = '%s/%d/%d/%d.js' % (layer.name(), coord.zoom, coord.column, coord.row)
+                js_body = '%s(%s);' % (options.callback, content)
+                js_size = len(js_body) / 1024
+            
+                layer.config.cache.save(js_body, layer, coord, 'JS')
+                
+                if verbose:
+                    print >> stderr, '%s (%dKB)' % (js_path, js_size),
+    
+            elif options.callback and verbose:
+                print >> stderr, '(callback ignored)',
+    
+        except:
+            #
+            # Something went wrong: try again? Log the error?
+            #
+            attempts -= 1
+
+            if verbose:
+                print >> stderr, 'Failed %s, will try %s more.' % (progress['tile'], ['no', 'once', 'twice'][attempts])
+        
+            if attempts == 0:
+                if not options.error_list:
+                    raise
+                
+                return False
+    
+        else:
+            #
+            # Successfully got the tile.
+            #
+            progress['size'] = '%dKB' % (len(content) / 1024)
+            progress['bytes'] = len(content)
+
+            if verbose:
+                print >> stderr, '%(tile)s (%(size)s)' % progress
+            
+            return True
+
+def groupTiles(coordinates, layer):
+    """ Generate lists of (offset, count, coordinate) tuples in the same metatile.
+    
+        Neighboring coordinates are grouped, each on its own if the layer
+        doesn't use metatiles.
+    """
+    if not layer.doMetatile():
+        for tile in coordinates:
+            yield [tile]
+        
+        return
+    
+    for (first, tiles) in groupby(coordinates, lambda tile: layer.metatile.firstCoord(tile[2])):
+        yield list(tiles)
+
+def seedMetatile(layer, tiles, extension, options, verbose):
+    """ Seed a list of (offset, count, coordinate) tiles in the same metatile.
+    
+        The first tile is rendered along with its whole metatile, and the
+        others are skipped if they were saved with it. Once a tile fails, the
+        rest of the metatile fails with it without another render. Generates
+        a tuple of coordinate, progress, seedTile() result, and a dictionary
+        of source, bytes, seconds and cache seconds for Throughput.add() for
+        each tile.
+    """
+    mimetype, format = layer.getTypeByExtension(extension)
+    cache = layer.config.cache
+    failed = False
+    
+    for (index, (offset, count, coord)) in enumerate(tiles):
+        progress = {"tile": tilePath(layer, coord, extension),
+                    "offset": offset + 1,
+                    "total": count}
+        
+        # JSONP callbacks are written by seedTile(), so those aren't skipped.
+        body = index and not options.callback and layer.recentTile(coord, format)
+        
+        if failed:
+            if verbose:
+                print >> stderr, '%(offset)d of %(total)d... Failed %(tile)s with its metatile' % progress
+            
+            yield coord, progress, False, dict(source='failed', bytes=0, seconds=0, cache_seconds=0)
+        
+        elif body:
+            progress['size'] = '%dKB' % (len(body) / 1024)
+            
+            if verbose:
+                print >> stderr, '%(offset)d of %(total)d... %(tile)s (%(size)s, from metatile)' % progress
+            
+            yield coord, progress, True, dict(source='metatile', bytes=len(body), seconds=0, cache_seconds=0)
+        
+        else:
+            start, cache_seconds, hits = time(), cache.seconds, cache.hits
+            rendered = seedTile(layer, coord, extension, options, progress, verbose)
+            failed = not rendered
+            
+            # a tile found in the cache, even after waiting for a lock, wasn't rendered here.
+            source = (not rendered and 'failed') or (cache.hits > hits and 'cache') or 'render'
+            
+            yield coord, progress, rendered, dict(source=source, bytes=progress.get('bytes', 0),
+                                                  seconds=time() - start, cache_seconds=cache.seconds - cache_seconds)
+
+def skipExisting(coordinates, layer, extension, cache, options, completion, throughput):
+    """ Generate (offset, count, coordinate) tuples for seeding, leaving out tiles in a cache.
+    
+        Coordinates are checked a thousand at a time with tilesExist(), and
+        tiles found are marked in the completion file and counted as skipped
+        in the throughput if there are those.
+    """
+    mimetype, format = layer.getTypeByExtension(extension)
+    coordinates = iter(coordinates)
+    
+    while True:
+        tiles = list(islice(coordinates, 1000))
+        
+        if not tiles:
+            break
+        
+        found = tilesExist(cache, layer, [coord for (offset, count, coord) in tiles], format)
+        
+        for (offset, count, coord) in [tile for (tile, exists) in zip(tiles, found) if exists]:
+            recordTile(coord, completion, cache)
+        
+        if throughput and any(found):
+            throughput.skip(sum(found))
+        
+        if options.verbose and any(found):
+            offset, count, coord = tiles[-1]
+            print >> stderr, '%d of %d... skipped %d tiles already in the cache' % (offset + 1, count, sum(found))
+        
+        for (tile, exists) in zip(tiles, found):
+            if not exists:
+                yield tile
+
+def tilePath(layer, coord, extension):
+    """ Return a path for a tile, used to show progress.
+    """
+    return '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
+
+def writeProgress(progress, options):
+    """ Write the latest progress to the progress file, if there is one.
+    """
+    if options.progressfile:
+        fp = open(options.progressfile, 'w')
+        json_dump(progress, fp)
+        fp.close()
+
+def recordTile(coord, completion, cache):
+    """ Mark a seeded tile in the --resume completion file, if there is one.
+    
+        Marked tiles are written every ten seconds, after flushing the cache
+        so tiles are never marked before they're really saved.
+    """
+    if completion is None:
+        return
+    
+    completion.mark(coord)
+    
+    if time() - completion.checkpointed > 10:
+        if hasattr(cache, 'flush'):
+            cache.flush()
+        
+        completion.checkpoint()
+
+def recordThroughput(coord, tile, throughput, options):
+    """ Count a seeded tile in the throughput, if there is one.
+    
+        Stats are reported every ten seconds, see reportThroughput().
+    """
+    if throughput is None:
+        return
+    
+    throughput.add(coord, tile['source'], tile['bytes'], tile['seconds'], tile['cache_seconds'])
+    
+    if time() - throughput.reported > 10:
+        reportThroughput(throughput, options)
+
+def reportThroughput(throughput, options, end=None):
+    """ Write a "stats" event and show stats with --stats, or an "end" event with a status at the end.
+    """
+    if throughput is None:
+        return
+    
+    if throughput.events and end:
+        throughput.events.write('end', status=end, **throughput.stats())
+    elif throughput.events:
+        throughput.events.write('stats', **throughput.stats())
+    
+    if options.stats:
+        print >> stderr, throughput.report()
+
+def writeError(coord, options):
+    """ Add a failed tile to the error list.
+    """
+    fp = open(options.error_list, 'a')
+    fp.write('%(zoom)d/%(column)d/%(row)d\n' % coord.__dict__)
+    fp.close()
+
+class CollectedTiles:
+    """ Write-only cache used by seeding processes for tiles bound for the main process.
+    
+        Single-file outputs like --to-mbtiles can't be written from many
+        processes at once, so tiles are handed back to the main process to
+        save. Tiles saved while seeding one tile are kept for reading, so
+        the other tiles of its metatile aren't rendered twice.
+    """
+    def __init__(self):
+        self.tiles = dict()
+    
+    def lock(self, layer, coord, format):
+        pass
+    
+    def unlock(self, layer, coord, format):
+        pass
+    
+    def remove(self, layer, coord, format):
+        self.tiles.pop((coord.zoom, coord.column, coord.row, format), None)
+    
+    def read(self, layer, coord, format):
+        return self.tiles.get((coord.zoom, coord.column, coord.row, format))
+    
+    def save(self, body, layer, coord, format):
+        self.tiles[(coord.zoom, coord.column, coord.row, format)] = body
+    
+    def collect(self):
+        """ Return a list of (coord, format, body) tiles saved since the last call.
+        """
+        tiles, self.tiles = self.tiles, dict()
+        return [(Coordinate(row, column, zoom), format, body) for ((zoom, column, row, format), body) in tiles.items()]
+
+# configuration and layer of a seeding process, set up by initSeedWorker().
+worker = dict()
+
+def initSeedWorker(config_dict, config_dirpath, layername, extension, options, collect):
+    """ Build a configuration for a seeding process, which keeps it for every tile.
+    
+        Ctrl-C is left to the main process, which lets tiles in progress finish.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    
+    config = buildConfiguration(config_dict, config_dirpath)
+    collector = collect and CollectedTiles() or None
+    
+    if collector and isinstance(config.cache, Test):
+        config.cache = collector
+    elif collector:
+        config.cache = Multi([config.cache, collector], backfill=0)
+    
+    config.cache = TimedCache(config.cache)
+    
+    worker.update(layer=config.layers[layername], extension=extension, options=options, collector=collector)
+    
+    if hasattr(config.cache, 'close'):
+        # pool processes run finalizers when they're told to stop.
+        Finalize(config, config.cache.close, exitpriority=10)
+
+def seedWorkerTiles(tiles):
+    """ Seed a list of (offset, count, coordinate) tiles from one metatile in a seeding process.
+    
+        Return a list of tuples with coordinate, progress, true if the tile
+        was rendered, a dictionary for Throughput.add(), and the error if it
+        failed and there's no error list, and a list of tiles for the main
+        process to save. Tiles left in the metatile after an error are
+        returned as failed too.
+        
+        With --resume, this process's cache is flushed before returning,
+        because the main process marks the tiles done without seeing it.
+    """
+    layer, options, extension = worker['layer'], worker['options'], worker['extension']
+    results = []
+    
+    try:
+        for (coord, progress, rendered, tile) in seedMetatile(layer, tiles, extension, options, False):
+            results.append((coord, progress, rendered, tile, None))
+    
+    except:
+        error, first = format_exc(), tilePath(layer, tiles[len(results)][2], extension)
+        
+        for (offset, count, coord) in tiles[len(results):]:
+            progress = {"tile": tilePath(layer, coord, extension), "total": count}
+            tile = dict(source='failed', bytes=0, seconds=0, cache_seconds=0)
+            results.append((coord, progress, False, tile, error))
+            error = 'Not seeded, because %s in the same metatile failed.' % first
+    
+    saved = worker['collector'] and worker['collector'].collect() or []
+    
+    if options.resume and hasattr(layer.config.cache, 'flush'):
+        layer.config.cache.flush()
+    
+    return results, saved
+
+def seedParallel(config_dict, config_dirpath, config, layer, coordinates, extension, options, collect, completion, throughput):
+    """ Seed tiles from a pool of processes, taking care of output from this one.
+    
+        Tiles are handed out a metatile at a time as processes become idle,
+        with a limited number waiting. Tiles for single-file outputs are saved here,
+        and progress, errors, completion and throughput are written here as tiles are done.
+    """
+    pool = Pool(options.jobs, initSeedWorker, (config_dict, config_dirpath, layer.name(), extension, options, collect))
+    results, counts, failures = Queue(), dict(waiting=0, done=0), []
+    metatiles = groupTiles(coordinates, layer)
+    
+    def finish(result):
+        """ Save tiles from a seeding process, and write progress and errors.
+        """
+        results, saved = result
+        counts['waiting'] -= 1
+        
+        for (coord, format, body) in saved:
+            config.cache.save(body, layer, coord, format)
+        
+        for (coord, progress, rendered, tile, error) in results:
+            counts['done'] += 1
+            progress['offset'] = counts['done']
+            recordThroughput(coord, tile, throughput, options)
+            
+            if error:
+                print >> stderr, 'Failed %s:\n%s' % (progress['tile'], error)
+                failures.append(progress['tile'])
+            
+            elif not rendered:
+                if options.verbose:
+                    print >> stderr, '%(offset)d of %(total)d... Failed %(tile)s' % progress
+                
+                writeError(coord, options)
+            
+            else:
+                recordTile(coord, completion, config.cache)
+                
+                if options.verbose:
+                    print >> stderr, '%(offset)d of %(total)d... %(tile)s (%(size)s)' % progress
+            
+            writeProgress(progress, options)
+    
+    try:
+        while True:
+            while counts['waiting'] < options.jobs * 4 and not failures:
+                try:
+                    tiles = metatiles.next()
+                except StopIteration:
+                    break
+                
+                pool.apply_async(seedWorkerTiles, (tiles, ), callback=results.put)
+                counts['waiting'] += 1
+            
+            if counts['waiting'] == 0:
+                break
+            
+            try:
+                # a timeout lets Ctrl-C through.
+                finish(results.get(True, 1))
+            except Empty:
+                continue
+    
+    except KeyboardInterrupt:
+        print >> stderr, 'Interrupted, finishing %d tiles already handed out...' % counts['waiting']
+        pool.close()
+        pool.join()
+        
+        while not results.empty():
+            finish(results.get())
+        
+        raise
+    
+    pool.close()
+    pool.join()
+    
+    if failures:
+        raise Exception('Failed to render %s and %d other tiles' % (failures[0], len(failures) - 1))
+
+def cacheConfig(tiers, default):
+    """ Return a cache configuration for a list of tiers, or a default if there are none.
+    """
+    if len(tiers) > 1:
+        return dict(name='multi', tiers=tiers)
+    elif len(tiers) == 1:
+        return tiers[0]
+    else:
+        return default
+
 def parseConfigfile(configpath):
     """ Parse a configuration file and return a raw dictionary and dirpath.
     
@@ -185,18 +680,37 @@ if __name__ == '__main__':
             path.insert(0, p)
 
     from TileStache import getTile, Config
-    from TileStache.Core import KnownUnknown
+    from TileStache.Core import KnownUnknown, Metatile
     from TileStache.Config import buildConfiguration
+    from TileStache.Caches import Multi, Test, tilesExist
+    from TileStache.Curves import walk_tiles, count_tiles, tile_ranges
+    from TileStache.Coverage import tile_area
+    from TileStache.Completion import Completion
+    from TileStache.Throughput import Throughput, TimedCache, EventLog
     from TileStache import MBTiles
     import TileStache
     
     from ModestMaps.Core import Coordinate
-    from ModestMaps.Geo import Location
+
+    if options.coverage:
+        if not options.resume:
+            parser.error('Missing required completion file (--resume) parameter for --coverage.')
+        
+        try:
+            completion = Completion(options.resume)
+        except (IOError, ValueError), e:
+            parser.error(str(e))
+        
+        for (zoom, done, total) in completion.coverage():
+            print '%d\t%d of %d tiles (%.1f%%)' % (zoom, done, total, total and 100. * done / total)
+        
+        completion.close()
+        exit(0)
 
     try:
         # determine if we have enough information to prep a config and layer
         
-        has_fake_destination = bool(options.outputdirectory or options.mbtiles_output)
+        has_fake_destination = bool(options.outputdirectory or options.mbtiles_output or options.pmtiles_output)
         has_fake_source = bool(options.mbtiles_input)
         
         if has_fake_destination and has_fake_source:
@@ -244,14 +758,20 @@ if __name__ == '__main__':
         
         # override parts of the config and layer if needed
         
-        tiers = []
+        tiers, file_tiers = [], []
         
         if options.mbtiles_output:
-            tiers.append({'class': 'TileStache.MBTiles:Cache',
+            file_tiers.append({'class': 'TileStache.MBTiles:Cache',
                           'kwargs': dict(filename=options.mbtiles_output,
                                          format=extension,
                                          name=options.layer)})
         
+        if options.pmtiles_output:
+            file_tiers.append({'class': 'TileStache.PMTiles:Cache',
+                          'kwargs': dict(filename=options.pmtiles_output,
+                                         format=extension,
+                                         name=options.layer)})
+        
         if options.outputdirectory:
             tiers.append(dict(name='disk', path=options.outputdirectory,
                               dirs='portable', gzip=[]))
@@ -261,30 +781,45 @@ if __name__ == '__main__':
             tiers.append(dict(name='S3', bucket=bucket,
                               access=access, secret=secret))
         
-        if len(tiers) > 1:
-            config_dict['cache'] = dict(name='multi', tiers=tiers)
-        elif len(tiers) == 1:
-            config_dict['cache'] = tiers[0]
+        if options.jobs < 1:
+            raise KnownUnknown('At least one job is needed.')
+        
+        if options.resume and options.pmtiles_output:
+            raise KnownUnknown('A --to-pmtiles archive is only written when seeding is done, so it can not be resumed.')
+        
+        if options.resume and options.mbtiles_input and not options.tile_list:
+            raise KnownUnknown('Tiles read from --from-mbtiles can not be resumed, try a --tile-list.')
+        
+        if options.copy_raw and not options.mbtiles_input:
+            raise KnownUnknown('Raw tiles can only be copied with --copy-raw from a --from-mbtiles tileset.')
+        
+        if options.copy_raw and (options.tile_list or options.callback or options.jobs > 1 or options.skip_existing or options.resume):
+            raise KnownUnknown('A --copy-raw copies a whole tileset from one process, so it can not be used with --tile-list, --jsonp-callback, --jobs, --skip-existing or --resume.')
+        
+        if options.skip_existing and options.ignore_cached:
+            raise KnownUnknown('Tiles can not be both skipped if they exist with --skip-existing and rendered anyway with --ignore-cached.')
+        
+        if options.geometry and (options.tile_list or options.mbtiles_input):
+            raise KnownUnknown('A --geometry can not be used with --tile-list or --from-mbtiles.')
+        
+        if options.jobs > 1:
+            # seeding processes share tiers, and this one writes the files.
+            worker_cache = file_tiers and dict(name='test') or config_dict.get('cache')
+            worker_dict = dict(config_dict, cache=cacheConfig(tiers, worker_cache))
+            config_dict = dict(config_dict, cache=cacheConfig(file_tiers, dict(name='test')))
+        
         else:
-            # Leave config_dict['cache'] as-is
-            pass
+            config_dict['cache'] = cacheConfig(file_tiers + tiers, config_dict.get('cache'))
         
         # create a real config object
         
         config = buildConfiguration(config_dict, config_dirpath)
+        config.cache = TimedCache(config.cache)
         layer = config.layers[options.layer or 'tiles-layer']
         
         # do the actual work
         
-        lat1, lon1, lat2, lon2 = options.bbox
-        south, west = min(lat1, lat2), min(lon1, lon2)
-        north, east = max(lat1, lat2), max(lon1, lon2)
-
-        northwest = Location(north, west)
-        southeast = Location(south, east)
-
-        ul = layer.projection.locationCoordinate(northwest)
-        lr = layer.projection.locationCoordinate(southeast)
+        ul, lr, coverage = tile_area(layer.projection, options.bbox or defaults['bbox'], options.geometry, options.padding)
 
         for (i, zoom) in enumerate(zooms):
             if not zoom.isdigit():
@@ -295,6 +830,15 @@ if __name__ == '__main__':
         if options.padding < 0:
             raise KnownUnknown('A negative padding will not work.')
 
+        if options.interleave and options.order == 'row':
+            raise KnownUnknown('Zooms can only be interleaved with a --order curve, "zorder" or "hilbert".')
+        
+        if options.interleave and layer.doMetatile():
+            rows, columns = layer.metatile.rows, layer.metatile.columns
+            
+            if rows != columns or rows & (rows - 1):
+                raise KnownUnknown('Zooms can only be interleaved with square metatiles of 1, 2, 4, 8... tiles.')
+
         padding = options.padding
         tile_list = options.tile_list
         error_list = options.error_list
@@ -302,74 +846,124 @@ if __name__ == '__main__':
     except KnownUnknown, e:
         parser.error(str(e))
 
+    # only limit tiles from a tileset to an area if one was given.
+    extent = options.bbox and (ul, lr) or None
+    copy_tileset = bool(options.copy_raw)
+
     if tile_list:
-        coordinates = listCoordinates(tile_list)
+        coordinates = listCoordinates(tile_list, layer.doMetatile() and layer.metatile)
+    elif copy_tileset:
+        coordinates = []
     elif options.mbtiles_input:
-        coordinates = tilesetCoordinates(options.mbtiles_input)
+        coordinates = tilesetCoordinates(options.mbtiles_input, zooms or None, extent)
     else:
-        coordinates = generateCoordinates(ul, lr, zooms, padding)
+        coordinates = generateCoordinates(ul, lr, zooms, padding, layer.doMetatile() and layer.metatile, options.order, options.interleave, coverage)
     
-    for (offset, count, coord) in coordinates:
-        path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
-
-        progress = {"tile": path,
-                    "offset": offset + 1,
-                    "total": count}
-
-        #
-        # Fetch a tile.
-        #
+    throughput = None
+    
+    if options.stats or options.event_log:
+        # every coordinate comes with the total, so the first one tells it.
+        coordinates = iter(coordinates)
+        first = next(coordinates, None)
+        coordinates = chain(first and [first] or [], coordinates)
+        
+        total = first and first[1] or 0
+        
+        if copy_tileset:
+            total = MBTiles.count_tiles(options.mbtiles_input, zooms or None, extent)
         
-        attempts = options.enable_retries and 3 or 1
-        rendered = False
+        events = options.event_log and EventLog(options.event_log) or None
+        throughput = Throughput(total, events)
         
-        while not rendered:
-            if options.verbose:
-                print >> stderr, '%(offset)d of %(total)d...' % progress,
+        if events:
+            events.write('start', layer=layer.name(), extension=extension, zooms=zooms, total=total, jobs=options.jobs)
     
-            try:
-                mimetype, content = getTile(layer, coord, extension, options.ignore_cached)
-                
-                if mimetype and 'json' in mimetype and options.callback:
-                    js_path = '%s/%d/%d/%d.js' % (layer.name(), coord.zoom, coord.column, coord.row)
-                    js_body = '%s(%s);' % (options.callback, content)
-                    js_size = len(js_body) / 1024
-                    
-                    layer.config.cache.save(js_body, layer, coord, 'JS')
-                    print >> stderr, '%s (%dKB)' % (js_path, js_size),
+    completion = None
+    
+    if options.resume:
+        if tile_list:
+            coordinates = list(coordinates)
+            ranges, totals = coordinateRanges([coord for (offset, count, coord) in coordinates])
+        else:
+            ranges, totals = tile_ranges(ul, lr, zooms, padding, options.order, coverage and coverage.test), None
             
-                elif options.callback:
-                    print >> stderr, '(callback ignored)',
+            if coverage:
+                totals = dict([(zoom, count_tiles(ranges, [zoom], coverage.test)) for zoom in zooms])
+        
+        try:
+            completion = Completion(options.resume, ranges, dict(layer=layer.name(), extension=extension), totals)
+        except (IOError, ValueError), e:
+            parser.error(str(e))
+        
+        if options.verbose:
+            seeded, total = 0, 0
             
-            except:
-                #
-                # Something went wrong: try again? Log the error?
-                #
-                attempts -= 1
-
-                if options.verbose:
-                    print >> stderr, 'Failed %s, will try %s more.' % (progress['tile'], ['no', 'once', 'twice'][attempts])
-                
-                if attempts == 0:
-                    if not error_list:
-                        raise
-                    
-                    fp = open(error_list, 'a')
-                    fp.write('%(zoom)d/%(column)d/%(row)d\n' % coord.__dict__)
-                    fp.close()
-                    break
+            for (zoom, done, count) in completion.coverage():
+                seeded, total = seeded + done, total + count
             
-            else:
-                #
-                # Successfully got the tile.
-                #
-                rendered = True
-                progress['size'] = '%dKB' % (len(content) / 1024)
+            print >> stderr, 'Resuming with %d of %d tiles already seeded' % (seeded, total)
         
-                if options.verbose:
-                    print >> stderr, '%(tile)s (%(size)s)' % progress
+        if throughput:
+            throughput.skip(sum([done for (zoom, done, count) in completion.coverage()]))
+        
+        # tiles already seeded are left out without a look in the cache.
+        coordinates = (tile for tile in coordinates if not completion.done(tile[2]))
+    
+    existing_cache = None
+    
+    if options.skip_existing:
+        if options.jobs > 1:
+            # seeding processes have caches of their own, so this one needs a copy.
+            existing_cache = Multi([config.cache, buildConfiguration(dict(worker_dict, layers={}), config_dirpath).cache])
+        else:
+            existing_cache = config.cache
+        
+        coordinates = skipExisting(coordinates, layer, extension, existing_cache, options, completion, throughput)
+    
+    # status for the "end" event, until seeding is done.
+    status = 'failed'
+    
+    try:
+        if copy_tileset:
+            copyTileset(options.mbtiles_input, zooms or None, extent, layer, extension, options, throughput)
+        
+        if options.jobs > 1:
+            seedParallel(worker_dict, config_dirpath, config, layer, coordinates, extension, options, bool(file_tiers), completion, throughput)
+            coordinates = []
+        
+        for tiles in groupTiles(coordinates, layer):
+            for (coord, progress, rendered, tile) in seedMetatile(layer, tiles, extension, options, options.verbose):
+                if not rendered:
+                    writeError(coord, options)
+                else:
+                    recordTile(coord, completion, config.cache)
                 
-        if options.progressfile:
-            fp = open(options.progressfile, 'w')
-            json_dump(progress, fp)
-            fp.close()
+                writeProgress(progress, options)
+                recordThroughput(coord, tile, throughput, options)
+        
+        status = 'done'
+    
+    except KeyboardInterrupt:
+        status = 'interrupted'
+        raise
+    
+    finally:
+        if status != 'done' and hasattr(config.cache, 'abort'):
+            # some caches, e.g. PMTiles, only write whole tilesets.
+            config.cache.abort()
+        
+        if hasattr(config.cache, 'close'):
+            # some caches, e.g. MBTiles, write tiles in batches.
+            config.cache.close()
+        
+        if options.jobs > 1 and existing_cache and hasattr(existing_cache.tiers[1], 'close'):
+            existing_cache.tiers[1].close()
+        
+        if completion:
+            # tiles are all saved now, so they can all be marked.
+            completion.close()
+        
+        reportThroughput(throughput, options, status)
+        
+        if throughput and throughput.events:
+            throughput.events.close()
@@ -0,0 +1,94 @@
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+import struct
+import os
+
+from ModestMaps.Core import Coordinate
+from TileStache.Caches import Bundle
+from TileStache import Caches
+from .utils import FakeLayer
+
+class BundleCacheTests(TestCase):
+    '''Tests reading and writing tiles with the Bundle cache'''
+
+    def setUp(self):
+        self.path = mkdtemp(prefix='tilestache-bundle-')
+        self.layer = FakeLayer('example')
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def files(self):
+        return [os.path.join(root, name) for (root, dirs, names) in os.walk(self.path) for name in names]
+
+    def test_save_and_read(self):
+        '''Save blocks of tiles to single files and read them back'''
+        cache = Bundle(self.path, size=4, dirs='portable')
+        tiles = [(Coordinate(row, col, 4), 'tile %d %d' % (row, col)) for row in range(8) for col in range(4)]
+
+        self.assertEqual(cache.read(self.layer, tiles[0][0], 'PNG'), None)
+
+        cache.save_many(tiles[:16], self.layer, 'PNG')
+
+        for (coord, body) in tiles[16:]:
+            cache.save(body, self.layer, coord, 'PNG')
+
+        self.assertEqual(len(self.files()), 2)
+
+        # a second cache sees the same tiles, and saves from the first.
+        other = Bundle(self.path, size=4, dirs='portable')
+
+        for (coord, body) in tiles:
+            self.assertEqual(other.read(self.layer, coord, 'PNG'), body)
+
+        cache.save('new tile', self.layer, tiles[0][0], 'PNG')
+        cache.remove(self.layer, tiles[1][0], 'PNG')
+
+        self.assertEqual(other.read(self.layer, tiles[0][0], 'PNG'), 'new tile')
+        self.assertEqual(other.read(self.layer, tiles[1][0], 'PNG'), None)
+        self.assertEqual(other.read(self.layer, tiles[2][0], 'PNG'), tiles[2][1])
+
+    def test_lifespan(self):
+        '''Expire tiles older than the layer cache lifespan'''
+        cache, coord = Bundle(self.path), Coordinate(1, 2, 3)
+        cache.save('PNG bytes', self.layer, coord, 'PNG')
+
+        self.assertEqual(cache.read(FakeLayer('example', cache_lifespan=60), coord, 'PNG'), 'PNG bytes')
+
+        # pretend the tile was saved in 1970.
+        bundle = open(cache._fullpath(self.layer, coord, 'PNG'), 'r+b')
+        bundle.seek(len(Caches._bundle_magic) + 4 + cache._entry(coord) * Caches._bundle_entry.size + 12)
+        bundle.write(struct.pack('<I', 0))
+        bundle.close()
+
+        self.assertEqual(cache.read(FakeLayer('example', cache_lifespan=60), coord, 'PNG'), None)
+        self.assertEqual(cache.read(self.layer, coord, 'PNG'), 'PNG bytes')
+
+    def test_compaction(self):
+        '''Compact a bundle once most of it is old tiles'''
+        cache = Bundle(self.path, size=2)
+        coords = [Coordinate(row, col, 1) for row in range(2) for col in range(2)]
+
+        for i in range(20):
+            cache.save_many([(coord, '%d %s' % (i, 'x' * 10000)) for coord in coords], self.layer, 'PNG')
+
+        bundle, = self.files()
+        self.assertTrue(os.stat(bundle).st_size < 100000)
+
+        for coord in coords:
+            self.assertEqual(cache.read(self.layer, coord, 'PNG'), '19 ' + 'x' * 10000)
+
+    def test_lock(self):
+        '''Lock tiles in the same bundle independently'''
+        cache = Bundle(self.path)
+        first, second = Coordinate(0, 0, 4), Coordinate(0, 1, 4)
+
+        cache.lock(self.layer, first, 'PNG')
+        cache.lock(FakeLayer('example', stale_lock_timeout=5), second, 'PNG')
+
+        self.assertNotEqual(cache._lockpath(self.layer, first, 'PNG'), cache._lockpath(self.layer, second, 'PNG'))
+
+        cache.unlock(self.layer, first, 'PNG')
+        cache.unlock(self.layer, second, 'PNG')
+        self.assertEqual(self.files(), [])
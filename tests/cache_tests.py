@@ -1,6 +1,12 @@
 from unittest import TestCase
 from . import utils
 import memcache
+import json
+import time
+
+from ModestMaps.Core import Coordinate
+from TileStache import Memcache
+from .utils import FakeLayer
 
 class CacheTests(TestCase):
     '''Tests various Cache configurations that reads from cfg file'''
@@ -67,7 +73,68 @@ class CacheTests(TestCase):
         self.assertEqual(self.mc.get('/1/memcache_osm/0/0/0.PNG'), None,
             'Memcache returned a value even though it should have been empty')
 
+    def test_memcache_compression(self):
+        '''Compress large text tiles in memcached, but not images'''
+
+        cache, layer = Memcache.Cache(revision=2), FakeLayer('compressed')
+        body = json.dumps({'features': [{'id': i, 'name': 'Feature'} for i in range(1000)]})
+
+        cache.save(body, layer, Coordinate(0, 0, 0), 'JSON')
+        cache.save(body, layer, Coordinate(0, 0, 0), 'PNG')
+
+        self.assertEqual(cache.read(layer, Coordinate(0, 0, 0), 'JSON'), body)
+        self.assertEqual(self.mc.get('/2/compressed/0/0/0.JSON'), body)
+
+        raw = memcache.Client(['127.0.0.1:11211'], decompressor=lambda value: value)
+        self.assertTrue(len(raw.get('/2/compressed/0/0/0.JSON')) < len(body) / 10)
+        self.assertEqual(raw.get('/2/compressed/0/0/0.PNG'), body)
+
+    def test_memcache_multi(self):
+        '''Save and read many tiles at once'''
+
+        cache, layer = Memcache.Cache(persistent=False), FakeLayer('multi')
+        coords = [Coordinate(row, 1, 4) for row in range(4)]
+
+        cache.save_many([(coord, 'tile %d' % coord.row) for coord in coords[1:]], layer, 'PNG')
+
+        self.assertEqual(cache.read_many(layer, coords, 'PNG'), [None, 'tile 1', 'tile 2', 'tile 3'])
+        self.assertEqual(self.mc.get('/0/multi/4/1/2.PNG'), 'tile 2')
+
+    def test_memcache_lock(self):
+        '''Keep a forced lock from being released by its previous holder'''
+
+        coord, layer = Coordinate(1, 2, 3), FakeLayer('locked', stale_lock_timeout=.3)
+        first, second = Memcache.Cache(), Memcache.Cache()
+
+        first.lock(layer, coord, 'PNG')
+        second.lock(layer, coord, 'PNG')
+
+        first.unlock(layer, coord, 'PNG')
+        self.assertNotEqual(self.mc.get('/0/locked/3/2/1.PNG-lock'), None)
+
+        second.unlock(layer, coord, 'PNG')
+        self.assertEqual(self.mc.get('/0/locked/3/2/1.PNG-lock'), 'released')
+
+        # a released lock is taken right away.
+        start = time.time()
+        first.lock(layer, coord, 'PNG')
+        self.assertTrue(time.time() - start < .2)
+        self.assertNotEqual(self.mc.get('/0/locked/3/2/1.PNG-lock'), 'released')
+
+    def test_memcache_unlock_forced(self):
+        '''Keep a lock forced between reading and releasing it'''
 
+        coord, layer = Coordinate(1, 2, 3), FakeLayer('locked')
+        key, cache = '/0/locked/3/2/1.PNG-lock', Memcache.Cache()
+        cache.lock(layer, coord, 'PNG')
 
+        gets = cache.mem.gets
 
+        def gets_then_force(key):
+            value = gets(key)
+            self.mc.set(key, 'forced')
+            return value
 
+        cache.mem.gets = gets_then_force
+        cache.unlock(layer, coord, 'PNG')
+        self.assertEqual(self.mc.get(key), 'forced')
@@ -0,0 +1,60 @@
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+import os
+
+from ModestMaps.Core import Coordinate
+from TileStache.Completion import Completion
+
+class CompletionTests(TestCase):
+    '''Tests recording seeded tiles in completion files'''
+
+    def setUp(self):
+        self.path = mkdtemp(prefix='tilestache-completion-')
+        self.filename = os.path.join(self.path, 'example.done')
+        self.ranges = {10: (100, 200, 103, 205), 11: (200, 400, 206, 410)}
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_checkpoints(self):
+        '''Mark tiles at checkpoints, and find them again after reopening'''
+        completion = Completion(self.filename, self.ranges, dict(layer='example'))
+        tiles = [Coordinate(row, column, 11) for row in range(200, 206) for column in range(400, 410, 3)]
+
+        for coord in tiles:
+            completion.mark(coord)
+
+        # tiles outside the ranges are ignored.
+        completion.mark(Coordinate(0, 0, 11))
+        completion.mark(Coordinate(100, 200, 9))
+
+        self.assertFalse(completion.done(tiles[0]))
+
+        completion.checkpoint()
+        self.assertTrue(completion.done(tiles[0]))
+        self.assertFalse(completion.done(Coordinate(200, 401, 11)))
+        self.assertEqual(completion.coverage(), [(10, 0, 15), (11, 24, 60)])
+
+        completion.mark(Coordinate(102, 204, 10))
+        completion.close()
+
+        # anyone can read a file, but only one writer can have it.
+        writer = Completion(self.filename, self.ranges, dict(layer='example'))
+        self.assertRaises(ValueError, Completion, self.filename, self.ranges, dict(layer='example'))
+
+        reader = Completion(self.filename)
+        self.assertTrue(reader.done(Coordinate(102, 204, 10)))
+        self.assertEqual(reader.coverage(), [(10, 1, 15), (11, 24, 60)])
+        self.assertEqual(reader.description, dict(layer='example'))
+
+        reader.close()
+        writer.close()
+
+    def test_other_tiles(self):
+        '''Refuse a file written for other tiles, and count totals given for partial ranges'''
+        Completion(self.filename, self.ranges, dict(layer='example'), {10: 3, 11: 8}).close()
+
+        self.assertRaises(ValueError, Completion, self.filename, self.ranges, dict(layer='other'))
+        self.assertRaises(ValueError, Completion, self.filename, {10: (100, 200, 103, 205)}, dict(layer='example'))
+        self.assertEqual(Completion(self.filename).coverage(), [(10, 0, 3), (11, 0, 8)])
@@ -0,0 +1,109 @@
+from unittest import TestCase
+from tempfile import mkstemp
+import json
+import os
+
+from TileStache.Geography import SphericalMercator
+from ModestMaps.Geo import Location
+from TileStache.Curves import walk_tiles, count_tiles, tile_ranges
+
+try:
+    from TileStache.Coverage import Coverage, read_geojson, tile_area
+    from shapely.geometry import Point, LineString, box
+except ImportError:
+    Point = None
+
+class CoverageTests(TestCase):
+    '''Tests walking tiles in an area of GeoJSON geometries'''
+
+    def setUp(self):
+        if Point is None:
+            self.skipTest('shapely is not installed')
+
+        handle, self.filename = mkstemp(prefix='tilestache-coverage-', suffix='.geojson')
+        os.close(handle)
+
+        # a square with a hole in it, and a line off to the side.
+        features = [dict(type='Feature', properties={}, geometry=geometry) for geometry in (
+            dict(type='Polygon', coordinates=[[[-122.5, 37.6], [-122.1, 37.6], [-122.1, 37.9], [-122.5, 37.9], [-122.5, 37.6]],
+                                              [[-122.4, 37.7], [-122.2, 37.7], [-122.2, 37.8], [-122.4, 37.8], [-122.4, 37.7]]]),
+            dict(type='LineString', coordinates=[[-121.9, 37.5], [-121.7, 37.4]])
+            )]
+
+        json.dump(dict(type='FeatureCollection', features=features), open(self.filename, 'w'))
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def walk(self, coverage, zooms, *args):
+        '''Return ranges of tiles by zoom around an area, and tiles walked in it.'''
+        ul, lr = coverage.corners()
+        ranges = tile_ranges(ul, lr, range(max(zooms) + 1), coverage.padding, args[0], coverage.test)
+
+        return ranges, list(walk_tiles(args[0], ranges, zooms, *args[1:], within=coverage.test))
+
+    def test_tiles(self):
+        '''Walk the tiles touching an area in any order, as if each one were checked'''
+        for padding in (0, 1):
+            coverage = Coverage(read_geojson(self.filename), SphericalMercator(), padding)
+            zooms = [11, 12, 13]
+
+            ranges, tiles = self.walk(coverage, zooms, 'row')
+            expected = [(zoom, row, column) for (zoom, (top, left, bottom, right)) in sorted(ranges.items()) if zoom in zooms
+                        for row in range(top, bottom) for column in range(left, right)
+                        if coverage.test(zoom, row, column, row + 1, column + 1)]
+
+            self.assertEqual(tiles, expected)
+            self.assertEqual(count_tiles(ranges, zooms, coverage.test), len(expected))
+            self.assertTrue(len(expected) < sum([(b - t) * (r - l) for (z, (t, l, b, r)) in ranges.items() if z in zooms]) * 2 / 3)
+
+            for args in (('zorder', 2, 2), ('hilbert', 4, 4, True)):
+                self.assertEqual(sorted(self.walk(coverage, zooms, *args)[1]), sorted(expected))
+
+    def test_inside(self):
+        '''Take ranges well inside an area whole, without checking every tile'''
+        coverage = Coverage(Point(10, 50).buffer(2, 64), SphericalMercator())
+        ranges, tiles = self.walk(coverage, [14], 'hilbert')
+        test, calls = coverage.test, []
+
+        def within(*args):
+            calls.append(args)
+            return test(*args)
+
+        self.assertEqual(count_tiles(ranges, [14], within), len(tiles))
+        self.assertTrue(len(tiles) > 20000)
+        self.assertTrue(len(calls) < len(tiles) / 10)
+
+    def test_edges(self):
+        '''Keep points and lines on the edges of tiles, but not polygons only touching them'''
+        projection = SphericalMercator()
+
+        # corners fall in the tile below and to the right, as in a bounding box.
+        point = Coverage(Point(0, 0), projection)
+        self.assertEqual(self.walk(point, [1, 2], 'row')[1], [(1, 1, 1), (2, 2, 2)])
+        self.assertTrue(point.test(2, 1, 1, 2, 2))
+
+        meridian = Coverage(LineString([(0, 10), (0, 20)]), projection)
+        self.assertEqual(self.walk(meridian, [2, 3], 'row')[1], [(2, 1, 2), (3, 3, 4)])
+        self.assertTrue(meridian.test(3, 3, 3, 4, 4))
+
+        equator = Coverage(LineString([(10, 0), (20, 0)]), projection)
+        self.assertEqual(self.walk(equator, [2, 3], 'hilbert')[1], [(2, 2, 2), (3, 4, 4)])
+        self.assertTrue(equator.test(3, 3, 4, 4, 5))
+
+        square = Coverage(box(0, 0, 10, 10), projection)
+        self.assertEqual(self.walk(square, [1, 2], 'row')[1], [(1, 0, 1), (2, 1, 2)])
+
+    def test_tile_area(self):
+        '''Take corners from a bounding box, or from an area instead'''
+        projection = SphericalMercator()
+        ul, lr, coverage = tile_area(projection, (37.6, -122.1, 37.9, -122.5))
+
+        self.assertEqual(coverage, None)
+        self.assertEqual(ul.zoomTo(12).container(), projection.locationCoordinate(Location(37.9, -122.5)).zoomTo(12).container())
+        self.assertEqual(lr.zoomTo(12).container(), projection.locationCoordinate(Location(37.6, -122.1)).zoomTo(12).container())
+
+        ul, lr, coverage = tile_area(projection, (37.6, -122.1, 37.9, -122.5), self.filename, 1)
+
+        self.assertEqual((ul, lr), coverage.corners())
+        self.assertEqual(coverage.padding, 1)
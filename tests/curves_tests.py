@@ -0,0 +1,60 @@
+from unittest import TestCase
+
+from ModestMaps.Core import Coordinate
+from TileStache.Curves import walk_cells, walk_tiles, tile_ranges
+from TileStache.PMTiles import zxy_to_tileid
+
+class CurvesTests(TestCase):
+    '''Tests walking tiles along space-filling curves'''
+
+    def test_hilbert(self):
+        '''Walk a whole zoom level in the order of PMTiles tile IDs, one step at a time'''
+        for zoom in range(6):
+            size = 2 ** zoom
+            cells = list(walk_cells('hilbert', 0, 0, size, size))
+            expected = sorted([(row, column) for row in range(size) for column in range(size)],
+                              key=lambda (row, column): zxy_to_tileid(zoom, column, row))
+
+            self.assertEqual(cells, expected)
+
+            for ((row1, column1), (row2, column2)) in zip(cells, cells[1:]):
+                self.assertEqual(abs(row1 - row2) + abs(column1 - column2), 1)
+
+    def test_ranges(self):
+        '''Cover a range of cells exactly once in any order'''
+        expected = [(row, column) for row in range(3, 17) for column in range(5, 23)]
+
+        self.assertEqual(list(walk_cells('row', 3, 5, 17, 23)), expected)
+        self.assertEqual(list(walk_cells('zorder', 0, 0, 2, 4)), [(0, 0), (0, 1), (1, 0), (1, 1), (0, 2), (0, 3), (1, 2), (1, 3)])
+
+        for order in ('zorder', 'hilbert'):
+            cells = list(walk_cells(order, 3, 5, 17, 23))
+            self.assertEqual(sorted(cells), expected)
+
+    def test_tile_ranges(self):
+        '''Pad ranges of tiles around two corners, clipped to the world along curves'''
+        ul, lr = Coordinate(1.5, 2.5, 2), Coordinate(2.5, 3.5, 2)
+
+        self.assertEqual(tile_ranges(ul, lr, [2, 3], 1), {2: (0, 1, 4, 5), 3: (2, 4, 7, 9)})
+        self.assertEqual(tile_ranges(ul, lr, [2, 3], 1, 'hilbert'), {2: (0, 1, 4, 4), 3: (2, 4, 7, 8)})
+        self.assertEqual(tile_ranges(ul, lr, [2], 1, 'row', lambda *args: True), {2: (0, 1, 4, 4)})
+
+    def test_interleaved_zooms(self):
+        '''Walk metatiles with parents before their children'''
+        ranges = dict([(zoom, (0, 0, 2 ** zoom, 2 ** zoom - 1)) for zoom in range(5)])
+        tiles = list(walk_tiles('hilbert', ranges, [1, 3, 4], 2, 2, interleave=True))
+
+        self.assertEqual(len(tiles), 1 * 2 + 8 * 7 + 16 * 15)
+        self.assertEqual(tiles[:2], [(1, 0, 0), (1, 1, 0)])
+
+        for (index, (zoom, row, column)) in enumerate(tiles):
+            # metatiles come whole, after the metatile above them.
+            first = zoom, row - row % 2, column - column % 2
+            self.assertTrue(first in tiles[:index + 1])
+            self.assertTrue(tiles.index(first) >= index - 3)
+
+            # the last column of each zoom is outside its range.
+            if zoom == 4 and column / 2 < 7:
+                self.assertTrue((3, row / 2, column / 2) in tiles[:index])
+
+        self.assertRaises(ValueError, list, walk_tiles('hilbert', ranges, [1, 3], 3, 3, interleave=True))
@@ -0,0 +1,173 @@
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from threading import Thread, active_count
+import socket
+import time
+import os
+
+from ModestMaps.Core import Coordinate
+from TileStache.Caches import Disk
+from .utils import FakeLayer
+
+class DiskCacheTests(TestCase):
+    '''Tests reading and writing tiles with the Disk cache'''
+
+    def setUp(self):
+        self.path = mkdtemp(prefix='tilestache-disk-')
+        self.layer = FakeLayer('example')
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_miss(self):
+        '''Read a tile that was never saved'''
+        cache = Disk(self.path)
+        self.assertEqual(cache.read(self.layer, Coordinate(1, 2, 3), 'PNG'), None)
+
+    def test_save_and_read(self):
+        '''Save and read back plain and compressed tiles'''
+        for dirs in ('safe', 'portable', 'quadtile'):
+            cache = Disk(self.path, dirs=dirs, noatime=True)
+            coord = Coordinate(1582, 656, 12)
+
+            cache.save('PNG bytes', self.layer, coord, 'PNG')
+            cache.save('{"json": true}', self.layer, coord, 'JSON')
+
+            self.assertEqual(cache.read(self.layer, coord, 'PNG'), 'PNG bytes')
+            self.assertEqual(cache.read(self.layer, coord, 'JSON'), '{"json": true}')
+
+            cache.remove(self.layer, coord, 'PNG')
+            self.assertEqual(cache.read(self.layer, coord, 'PNG'), None)
+
+    def test_lifespan(self):
+        '''Expire tiles older than the layer cache lifespan'''
+        cache = Disk(self.path)
+        coord = Coordinate(1, 2, 3)
+
+        cache.save('old bytes', self.layer, coord, 'PNG')
+
+        fullpath = cache._fullpath(self.layer, coord, 'PNG')
+        os.utime(fullpath, (0, 0))
+
+        self.assertEqual(cache.read(FakeLayer('example', cache_lifespan=60), coord, 'PNG'), None)
+        self.assertEqual(cache.read(self.layer, coord, 'PNG'), 'old bytes')
+
+    def test_removed_directory(self):
+        '''Save a tile after its directory was removed behind our back'''
+        cache = Disk(self.path, dirs='portable')
+        coord = Coordinate(1, 2, 3)
+
+        cache.save('first', self.layer, coord, 'PNG')
+        rmtree(os.path.join(self.path, 'example'))
+        cache.save('second', self.layer, coord, 'PNG')
+
+        self.assertEqual(cache.read(self.layer, coord, 'PNG'), 'second')
+
+    def test_lock_wakes_waiter(self):
+        '''Wake a waiting thread as soon as a lock is released'''
+        for locking in ('posix', 'directory'):
+            cache = Disk(self.path, locking=locking)
+            coord, times = Coordinate(1, 2, 3), []
+
+            def wait():
+                cache.lock(self.layer, coord, 'PNG')
+                times.append(time.time())
+                cache.unlock(self.layer, coord, 'PNG')
+
+            cache.lock(self.layer, coord, 'PNG')
+            waiter = Thread(target=wait)
+            waiter.start()
+
+            time.sleep(.3)
+            released = time.time()
+            cache.unlock(self.layer, coord, 'PNG')
+            waiter.join()
+
+            self.assertTrue(times[0] >= released)
+            self.assertFalse(os.path.exists(cache._lockpath(self.layer, coord, 'PNG')))
+
+            if locking == 'posix':
+                self.assertTrue(times[0] - released < .1)
+
+    def test_stale_lock(self):
+        '''Break locks left by dead processes or held past the timeout'''
+        cache = Disk(self.path)
+        coord = Coordinate(1, 2, 3)
+        lockpath = cache._lockpath(self.layer, coord, 'PNG')
+
+        # a lock file written by a process that no longer exists.
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        cache.lock(self.layer, coord, 'PNG')
+        fd = cache.lock_fds.values()[0]
+        os.ftruncate(fd, 0)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, '%s %d\n' % (os.uname()[1], pid))
+
+        start = time.time()
+        other = Disk(self.path)
+        other.lock(self.layer, coord, 'PNG')
+        self.assertTrue(time.time() - start < 1)
+
+        # a live holder is waited on until the stale lock timeout.
+        start = time.time()
+        Disk(self.path).lock(FakeLayer('example', stale_lock_timeout=.5), coord, 'PNG')
+        self.assertTrue(time.time() - start >= .5)
+
+    def test_directory_lock_fallback(self):
+        '''Use an existing directory lock left by the fallback implementation'''
+        coord = Coordinate(1, 2, 3)
+
+        old = Disk(self.path, locking='directory')
+        old.lock(self.layer, coord, 'PNG')
+
+        cache = Disk(self.path)
+        cache.lock(FakeLayer('example', stale_lock_timeout=.5), coord, 'PNG')
+        self.assertTrue(os.path.isdir(cache._lockpath(self.layer, coord, 'PNG')))
+
+        cache.unlock(self.layer, coord, 'PNG')
+        self.assertFalse(os.path.exists(cache._lockpath(self.layer, coord, 'PNG')))
+
+    def test_exists_many(self):
+        '''Check for many tiles at once, leaving out expired ones'''
+        for dirs in ('safe', 'portable', 'quadtile'):
+            cache = Disk(os.path.join(self.path, dirs), dirs=dirs)
+            coords = [Coordinate(row, column, 12) for row in range(1580, 1584) for column in range(654, 658)]
+
+            for coord in coords[::3]:
+                cache.save('PNG bytes', self.layer, coord, 'PNG')
+
+            os.utime(cache._fullpath(self.layer, coords[3], 'PNG'), (0, 0))
+
+            expected = [index % 3 == 0 for index in range(len(coords))]
+            self.assertEqual(cache.exists_many(self.layer, coords, 'PNG'), expected)
+            self.assertEqual(cache.exists_many(self.layer, coords, 'JPEG'), [False] * len(coords))
+
+            expected[3] = False
+            self.assertEqual(cache.exists_many(FakeLayer('example', cache_lifespan=60), coords, 'PNG'), expected)
+
+    def test_left_behind_lock(self):
+        '''Replace a lock file left by a dead process, without waiting on threads'''
+        cache, coord = Disk(self.path), Coordinate(1, 2, 3)
+        lockpath = cache._lockpath(self.layer, coord, 'PNG')
+
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        os.makedirs(os.path.dirname(lockpath))
+        open(lockpath, 'w').write('%s %d\n' % (socket.gethostname(), pid))
+
+        cache.lock(self.layer, coord, 'PNG')
+        self.assertEqual(open(lockpath).read(), '%s %d\n' % (socket.gethostname(), os.getpid()))
+
+        # a waiter that gives up on a live holder leaves nothing behind.
+        threads = active_count()
+        Disk(self.path).lock(FakeLayer('example', stale_lock_timeout=.2), coord, 'PNG')
+        self.assertEqual(active_count(), threads)
+        self.assertEqual([name for name in os.listdir(os.path.dirname(lockpath)) if name.endswith(('.tmp', '.broken'))], [])
@@ -0,0 +1,74 @@
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+import sqlite3
+import time
+import os
+
+from ModestMaps.Core import Coordinate
+from TileStache.Goodies.Caches.LimitedDisk import Cache
+from .utils import FakeLayer
+
+class LimitedDiskTests(TestCase):
+    '''Tests the size-limited LimitedDisk cache'''
+
+    def setUp(self):
+        self.path = mkdtemp(prefix='tilestache-limited-')
+        self.layer = FakeLayer('example')
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def tiles(self, cache):
+        db = sqlite3.connect(cache.dbpath)
+        return dict(db.execute('SELECT path, used FROM tiles'))
+
+    def test_save_read_remove(self):
+        '''Save, read and remove tiles with batched table updates'''
+        cache = Cache(self.path, 1024 * 1024, flush_size=3)
+        coord = Coordinate(1, 2, 3)
+
+        cache.save('PNG bytes', self.layer, coord, 'PNG')
+        self.assertEqual(self.tiles(cache), {})
+
+        self.assertEqual(cache.read(self.layer, coord, 'PNG'), 'PNG bytes')
+        self.assertEqual(cache.read(self.layer, Coordinate(0, 0, 0), 'PNG'), None)
+
+        cache.close()
+        self.assertEqual(self.tiles(cache).keys(), [cache._filepath(self.layer, coord, 'PNG')])
+
+        cache.remove(self.layer, coord, 'PNG')
+        self.assertEqual(cache.read(self.layer, coord, 'PNG'), None)
+        self.assertEqual(self.tiles(cache), {})
+        self.assertEqual(cache.total, 0)
+
+    def test_eviction(self):
+        '''Evict least recently used tiles once the cache is over its limit'''
+        cache = Cache(self.path, 1)
+        blocksize = cache._size(os.stat(self.path)) or 1
+        cache.limit = blocksize * 10
+
+        coords = [Coordinate(0, column, 4) for column in range(12)]
+
+        for coord in coords[:10]:
+            cache.save('tile', self.layer, coord, 'PNG')
+
+        # the first tile was used more recently than the next nine.
+        for (index, coord) in enumerate(coords[1:10] + coords[:1]):
+            cache.used[cache._filepath(self.layer, coord, 'PNG')] = int(time.time()) - 60 + index
+
+        for coord in coords[10:]:
+            cache.save('tile', self.layer, coord, 'PNG')
+
+        for i in range(50):
+            if not cache.evicting.is_set():
+                break
+            time.sleep(.1)
+
+        self.assertTrue(cache.total <= cache.limit * .9)
+        self.assertEqual(cache.read(self.layer, coords[0], 'PNG'), 'tile')
+        self.assertEqual(cache.read(self.layer, coords[1], 'PNG'), None)
+        self.assertEqual(cache.read(self.layer, coords[4], 'PNG'), 'tile')
+        self.assertEqual(cache.read(self.layer, coords[11], 'PNG'), 'tile')
+
+        cache.close()
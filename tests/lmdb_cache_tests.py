@@ -0,0 +1,118 @@
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from threading import Thread
+import time
+import os
+
+from ModestMaps.Core import Coordinate
+from TileStache import LMDB
+from .utils import FakeLayer
+
+try:
+    import lmdb
+except ImportError:
+    lmdb = None
+
+class LMDBCacheTests(TestCase):
+    '''Tests the LMDB cache'''
+
+    def setUp(self):
+        if lmdb is None:
+            self.skipTest('py-lmdb is not installed')
+
+        self.path = mkdtemp(prefix='tilestache-lmdb-')
+        self.layer = FakeLayer('example')
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_save_and_read(self):
+        '''Save, read back and remove tiles'''
+        cache = LMDB.Cache(os.path.join(self.path, 'cache'))
+        coords = [Coordinate(row, 1, 4) for row in range(4)]
+
+        self.assertEqual(cache.read(self.layer, coords[0], 'PNG'), None)
+
+        cache.save('one', self.layer, coords[0], 'PNG')
+        self.assertEqual(cache.read(self.layer, coords[0], 'PNG'), 'one')
+
+        cache.save_many([(coord, 'many %d' % coord.row) for coord in coords[1:]], self.layer, 'PNG')
+        self.assertEqual(cache.read_many(self.layer, coords, 'PNG'), ['one', 'many 1', 'many 2', 'many 3'])
+
+        cache.remove(self.layer, coords[0], 'PNG')
+        self.assertEqual(cache.read(self.layer, coords[0], 'PNG'), None)
+
+        cache.close()
+
+    def test_lifespan(self):
+        '''Skip tiles older than the layer cache lifespan'''
+        cache, coord = LMDB.Cache(self.path), Coordinate(1, 2, 3)
+        cache.save('PNG bytes', self.layer, coord, 'PNG')
+
+        self.assertEqual(cache.read(FakeLayer('example', cache_lifespan=3600), coord, 'PNG'), 'PNG bytes')
+
+        time.sleep(2.1)
+        self.assertEqual(cache.read(FakeLayer('example', cache_lifespan=1), coord, 'PNG'), None)
+
+    def test_eviction(self):
+        '''Remove least recently used tiles to stay within the size'''
+        cache = LMDB.Cache(self.path, size=4, flush_size=1)
+        coords = [Coordinate(0, column, 9) for column in range(200)]
+
+        for coord in coords[:100]:
+            cache.save('x' * 20000, self.layer, coord, 'PNG')
+
+        # pretend the first tile was last used long ago, so a read moves it ahead.
+        with cache.env.begin(write=True) as txn:
+            cache._touch(txn, LMDB.tile_key(self.layer, coords[0], 'PNG'), 0)
+
+        cache.read(self.layer, coords[0], 'PNG')
+
+        for coord in coords[100:]:
+            cache.save('x' * 20000, self.layer, coord, 'PNG')
+
+        self.assertTrue(cache._usage() <= cache.map_size * .9)
+        self.assertEqual(len(cache.read(self.layer, coords[0], 'PNG')), 20000)
+        self.assertEqual(cache.read(self.layer, coords[1], 'PNG'), None)
+        self.assertEqual(len(cache.read(self.layer, coords[-1], 'PNG')), 20000)
+
+    def test_lock(self):
+        '''Allow only one lock holder at a time, and let stale locks expire'''
+        coord, held = Coordinate(1, 2, 3), []
+        first, second = LMDB.Cache(self.path), LMDB.Cache(self.path)
+
+        def wait():
+            second.lock(self.layer, coord, 'PNG')
+            held.append(time.time())
+            second.unlock(self.layer, coord, 'PNG')
+
+        first.lock(self.layer, coord, 'PNG')
+        thread = Thread(target=wait)
+        thread.start()
+
+        time.sleep(.3)
+        self.assertEqual(held, [])
+
+        released = time.time()
+        first.unlock(self.layer, coord, 'PNG')
+        thread.join()
+
+        self.assertTrue(held[0] >= released)
+
+        # an expired lock is taken over, and its old holder can't release it.
+        layer = FakeLayer('example', stale_lock_timeout=.3)
+        first.lock(layer, coord, 'PNG')
+        start = time.time()
+        second.lock(layer, coord, 'PNG')
+        self.assertTrue(time.time() - start >= .25)
+
+        first.unlock(layer, coord, 'PNG')
+
+        with second.env.begin(db=second.locks) as txn:
+            self.assertTrue(txn.get('example/3/2/1.PNG') is not None)
+
+        second.unlock(layer, coord, 'PNG')
+
+        with second.env.begin(db=second.locks) as txn:
+            self.assertTrue(txn.get('example/3/2/1.PNG') is None)
@@ -0,0 +1,65 @@
+from unittest import TestCase
+from StringIO import StringIO
+from random import Random
+
+from TileStache import Mapnik
+
+def make_grid(random, size, keycount):
+    ''' Build a UTF Grid dictionary like mapnik.render_grid() returns.
+    '''
+    keys = [''] + ['key-%d' % i for i in range(1, keycount)]
+    data = dict([(key, {'name': u'Feature \u00e9 %s' % key}) for key in keys[1:]])
+
+    rows = [u''.join([Mapnik.encode_id(random.randrange(keycount)) for x in range(size)])
+            for y in range(size)]
+
+    return dict(keys=keys, data=data, grid=rows)
+
+class MapnikGridTests(TestCase):
+    '''Tests UTF Grid merging and cropping with and without numpy'''
+
+    def setUp(self):
+        self.numpy = Mapnik.numpy
+
+    def tearDown(self):
+        Mapnik.numpy = self.numpy
+
+    def render(self, grids, bbox):
+        ''' Merge, crop and save grids to a JSON string.
+        '''
+        grid = reduce(Mapnik.merge_grids, grids)
+        response = Mapnik.SaveableResponse(grid, 4).crop(bbox)
+
+        buff = StringIO()
+        response.save(buff, 'JSON')
+
+        return buff.getvalue()
+
+    def test_codec(self):
+        '''Decode and encode grid strings'''
+        if self.numpy is None:
+            return
+
+        rows = [u''.join([Mapnik.encode_id(i) for i in range(j, j + 200)]) for j in range(10)]
+        ids = Mapnik.decode_grid(rows)
+
+        self.assertEqual(ids[3, 5], Mapnik.decode_char(rows[3][5]))
+        self.assertEqual(ids.tolist(), [range(j, j + 200) for j in range(10)])
+        self.assertEqual(Mapnik.encode_grid(ids), rows)
+
+    def test_merge_and_crop(self):
+        '''Merge and crop grids identically to the plain string implementation'''
+        if self.numpy is None:
+            return
+
+        random = Random(0)
+        grids = [make_grid(random, 32, count) for count in (5, 120, 3)]
+
+        for bbox in [(0, 0, 128, 128), (4, 8, 68, 72), (64, 64, 128, 128)]:
+            Mapnik.numpy = self.numpy
+            fast = self.render(grids, bbox)
+
+            Mapnik.numpy = None
+            slow = self.render(grids, bbox)
+
+            self.assertEqual(fast, slow)
@@ -0,0 +1,104 @@
+from unittest import TestCase
+from multiprocessing import Pool
+from time import sleep, time
+
+from TileStache import Mapnik
+from TileStache.Core import KnownUnknown
+
+class FakeImage:
+    ''' Stands in for a rendered mapnik.Image.
+    '''
+    def __init__(self, width, height):
+        self.data = ''.join([chr(i % 251) for i in range(width * height * 4)])
+
+    def tostring(self):
+        return self.data
+
+def fake_render_image(mmap, width, height, bbox):
+    return FakeImage(width, height)
+
+def stalling_worker(mapfile, conn):
+    ''' Send the first piece of an image and stop.
+    '''
+    while True:
+        request = conn.recv()
+        conn.send(('image', ))
+        conn.send_bytes('\0' * Mapnik._chunk_size)
+        sleep(10)
+
+def pool_is_none():
+    return Mapnik.render_pool('style.xml', 1) is None
+
+class RenderPoolTests(TestCase):
+
+    def setUp(self):
+        self.get_mapnikMap = Mapnik.get_mapnikMap
+        self.render_image = Mapnik.render_image
+        self.render_worker = Mapnik._render_worker
+        self.pools = []
+
+        Mapnik.get_mapnikMap = lambda mapfile: mapfile
+        Mapnik.render_image = fake_render_image
+
+    def tearDown(self):
+        Mapnik.get_mapnikMap = self.get_mapnikMap
+        Mapnik.render_image = self.render_image
+        Mapnik._render_worker = self.render_worker
+
+        for pool in self.pools:
+            while not pool.workers.empty():
+                worker = pool.workers.get()
+                if worker is not None:
+                    worker[0].terminate()
+                    worker[0].join()
+
+    def pool(self, processes, timeout=None):
+        pool = Mapnik.RenderPool('style.xml', processes, timeout)
+        self.pools.append(pool)
+        return pool
+
+    def test_workers_started(self):
+        '''Workers are started with the pool'''
+        pool = self.pool(2)
+        workers = [pool.workers.get() for i in range(2)]
+
+        for worker in workers:
+            self.assertTrue(worker is not None)
+            self.assertTrue(worker[0].is_alive())
+            pool.workers.put(worker)
+
+    def test_render_image(self):
+        '''Images larger than one piece come back whole'''
+        pool = self.pool(1)
+        img = pool.renderImage(1024, 512, (0, 0, 1, 1))
+
+        self.assertEqual(img.size, (1024, 512))
+        data = hasattr(img, 'tobytes') and img.tobytes() or img.tostring()
+        self.assertEqual(data, FakeImage(1024, 512).tostring())
+
+    def test_stalled_image(self):
+        '''A worker stalling partway through an image is killed at the timeout'''
+        Mapnik._render_worker = stalling_worker
+        pool = self.pool(1, .5)
+
+        start = time()
+        self.assertRaises(KnownUnknown, pool.renderImage, 1024, 512, (0, 0, 1, 1))
+        self.assertTrue(time() - start < 5)
+
+        # the killed worker is replaced on the next request
+        Mapnik._render_worker = self.render_worker
+        img = pool.renderImage(16, 16, (0, 0, 1, 1))
+        self.assertEqual(img.size, (16, 16))
+
+    def test_daemonic_process(self):
+        '''Daemonic processes render in-process'''
+        pool = Mapnik.render_pool('style.xml', 1)
+        self.pools.append(pool)
+        self.assertTrue(isinstance(pool, Mapnik.RenderPool))
+
+        seeders = Pool(1)
+
+        try:
+            self.assertTrue(seeders.apply(pool_is_none))
+        finally:
+            seeders.terminate()
@@ -0,0 +1,184 @@
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from threading import Thread
+import runpy
+import sqlite3
+import sys
+import os
+
+from ModestMaps.Core import Coordinate
+from TileStache import MBTiles
+
+seed_script = os.path.join(os.path.dirname(__file__), '..', 'scripts', 'tilestache-seed.py')
+
+def get_tile(filename, coord):
+    ''' Return mime-type and content as a string, which sqlite returns as a buffer.
+    '''
+    mime_type, content = MBTiles.get_tile(filename, coord)
+    return mime_type, content and str(content)
+
+class MBTilesTests(TestCase):
+    '''Tests reading and writing MBTiles tilesets'''
+
+    def setUp(self):
+        self.path = mkdtemp(prefix='tilestache-mbtiles-')
+        self.filename = os.path.join(self.path, 'tiles.mbtiles')
+        MBTiles.create_tileset(self.filename, 'Tiles', 'baselayer', '0', '', 'png')
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_put_get_delete(self):
+        '''Write, read and delete tiles'''
+        coord = Coordinate(1, 2, 3)
+
+        self.assertEqual(get_tile(self.filename, coord), ('image/png', None))
+
+        MBTiles.put_tile(self.filename, coord, 'PNG bytes')
+        self.assertEqual(get_tile(self.filename, coord), ('image/png', 'PNG bytes'))
+        self.assertEqual(MBTiles.list_tiles(self.filename), [coord])
+
+        MBTiles.delete_tile(self.filename, coord)
+        self.assertEqual(get_tile(self.filename, coord), ('image/png', None))
+
+    def test_threads(self):
+        '''Read tiles from several threads, each with its own connection'''
+        coord, results = Coordinate(1, 2, 3), []
+        MBTiles.put_tile(self.filename, coord, 'PNG bytes')
+
+        def read():
+            results.append(get_tile(self.filename, coord))
+
+        threads = [Thread(target=read) for i in range(4)]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+
+        self.assertEqual(results, [('image/png', 'PNG bytes')] * 4)
+
+    def test_replaced_tileset(self):
+        '''Read from a new tileset moved into place of an old one'''
+        coord = Coordinate(1, 2, 3)
+        MBTiles.put_tile(self.filename, coord, 'old bytes')
+        self.assertEqual(get_tile(self.filename, coord), ('image/png', 'old bytes'))
+
+        newname = os.path.join(self.path, 'new.mbtiles')
+        MBTiles.create_tileset(newname, 'Tiles', 'baselayer', '0', '', 'jpg')
+        MBTiles.put_tile(newname, coord, 'new bytes')
+        os.rename(newname, self.filename)
+
+        self.assertEqual(get_tile(self.filename, coord), ('image/jpeg', 'new bytes'))
+
+    def test_deduplicated_tileset(self):
+        '''Store identical tiles once in a map and images tileset'''
+        filename = os.path.join(self.path, 'dedupe.mbtiles')
+        MBTiles.create_tileset(filename, 'Tiles', 'baselayer', '0', '', 'png', deduplicate=True)
+
+        for column in range(4):
+            MBTiles.put_tile(filename, Coordinate(0, column, 2), 'ocean')
+
+        MBTiles.put_tile(filename, Coordinate(1, 1, 2), 'land')
+        MBTiles.delete_tile(filename, Coordinate(0, 3, 2))
+
+        db = sqlite3.connect(filename)
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM images').fetchone(), (2, ))
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM map').fetchone(), (4, ))
+
+        self.assertEqual(get_tile(filename, Coordinate(0, 2, 2)), ('image/png', 'ocean'))
+        self.assertEqual(get_tile(filename, Coordinate(0, 3, 2)), ('image/png', None))
+        self.assertEqual(len(MBTiles.list_tiles(filename)), 4)
+
+        # replacing the only land tile leaves no unused image behind.
+        MBTiles.put_tile(filename, Coordinate(1, 1, 2), 'desert')
+        MBTiles.put_tile(filename, Coordinate(0, 0, 2), 'ocean')
+
+        images = sorted([str(data) for (data, ) in db.execute('SELECT tile_data FROM images')])
+        self.assertEqual(images, ['desert', 'ocean'])
+        self.assertEqual(get_tile(filename, Coordinate(1, 1, 2)), ('image/png', 'desert'))
+
+    def test_cache_batches(self):
+        '''Write tiles through the cache in batched transactions'''
+        filename = os.path.join(self.path, 'cache.mbtiles')
+        cache = MBTiles.Cache(filename, 'png', 'Tiles', batch_size=10)
+        tiles = [(Coordinate(row, col, 4), 'tile %d' % (row % 2)) for row in range(4) for col in range(4)]
+
+        cache.save_many(tiles[:8], None, 'png')
+        self.assertEqual(str(cache.read(None, tiles[0][0], 'png')), 'tile 0')
+        self.assertEqual(get_tile(filename, tiles[0][0]), ('image/png', None))
+
+        cache.save_many(tiles[8:12], None, 'png')
+        self.assertEqual(get_tile(filename, tiles[0][0]), ('image/png', 'tile 0'))
+
+        for (coord, body) in tiles[12:]:
+            cache.save(body, None, coord, 'png')
+
+        cache.close()
+
+        db = sqlite3.connect(filename)
+        self.assertEqual(db.execute('PRAGMA journal_mode').fetchone(), ('delete', ))
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM images').fetchone(), (2, ))
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM tiles').fetchone(), (16, ))
+
+    def test_iter_and_count_tiles(self):
+        '''Stream and count tiles, limited by zoom and extent'''
+        for zoom in range(4):
+            for column in range(2**zoom):
+                for row in range(2**zoom):
+                    MBTiles.put_tile(self.filename, Coordinate(row, column, zoom), 'tile')
+
+        self.assertEqual(MBTiles.count_tiles(self.filename), 85)
+        self.assertEqual(MBTiles.count_tiles(self.filename, zooms=[2, 3]), 80)
+
+        # upper-left quarter of the world.
+        extent = Coordinate(0, 0, 1), Coordinate(.999, .999, 1)
+        coords = list(MBTiles.iter_tiles(self.filename, zooms=[3], extent=extent))
+
+        self.assertEqual(MBTiles.count_tiles(self.filename, extent=extent), 1 + 1 + 4 + 16)
+        self.assertEqual(sorted(coords), sorted([Coordinate(row, col, 3) for row in range(4) for col in range(4)]))
+
+        coord, content = MBTiles.iter_tiles(self.filename, zooms=[0], content=True).next()
+        self.assertEqual((coord, str(content)), (Coordinate(0, 0, 0), 'tile'))
+
+    def test_cache_exists_many(self):
+        '''Check for many tiles at once, including some not yet committed'''
+        for deduplicate in (False, True):
+            filename = os.path.join(self.path, 'exists-%s.mbtiles' % deduplicate)
+            cache = MBTiles.Cache(filename, 'png', 'Tiles', deduplicate=deduplicate, batch_size=10)
+            coords = [Coordinate(row, col, 4) for row in range(4) for col in range(4)]
+
+            cache.save_many([(coord, 'tile') for coord in coords[:8:3]], None, 'png')
+            cache.save('tile', None, coords[9], 'png')
+
+            found = cache.exists_many(None, coords, 'png')
+            self.assertEqual([index for (index, exists) in enumerate(found) if exists], [0, 3, 6, 9])
+
+            cache.close()
+
+    def test_seed_from_tileset(self):
+        '''Render tiles from a tileset through the layer, or copy them raw with --copy-raw'''
+        coords = [Coordinate(row, col, 2) for row in range(2) for col in range(2)]
+
+        for coord in coords:
+            MBTiles.put_tile(self.filename, coord, 'PNG %d' % coord.column)
+
+        rendered, render_tile = [], MBTiles.Provider.renderTile
+
+        def renderTile(provider, width, height, srs, coord):
+            rendered.append(coord)
+            return render_tile(provider, width, height, srs, coord)
+
+        argv, MBTiles.Provider.renderTile = sys.argv, renderTile
+
+        try:
+            for (output, extra) in (('rendered', []), ('copied', ['--copy-raw'])):
+                sys.argv = ['tilestache-seed.py', '-q', '--from-mbtiles', self.filename,
+                            '--output-directory', os.path.join(self.path, output)] + extra
+                runpy.run_path(seed_script, run_name='__main__')
+        finally:
+            sys.argv, MBTiles.Provider.renderTile = argv, render_tile
+
+        self.assertEqual(sorted(rendered), sorted(coords))
+
+        for output in ('rendered', 'copied'):
+            tile = open(os.path.join(self.path, output, 'tiles-layer', '2', '1', '0.png')).read()
+            self.assertEqual(tile, 'PNG 1')
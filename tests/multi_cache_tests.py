@@ -0,0 +1,294 @@
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from threading import Event
+import struct
+import time
+import os
+
+from ModestMaps.Core import Coordinate
+from TileStache.Caches import Multi, WriteBehind, ExistenceFilter, tilesExist
+from .utils import FakeLayer
+
+class SlowCache:
+    ''' In-memory cache that takes its time to read.
+    '''
+    def __init__(self, delay=0, tiles=None, save_delay=0):
+        self.delay = delay
+        self.save_delay = save_delay
+        self.tiles = dict(tiles or {})
+
+    def read(self, layer, coord, format):
+        time.sleep(self.delay)
+        return self.tiles.get((coord, format))
+
+    def save(self, body, layer, coord, format):
+        time.sleep(self.save_delay)
+        self.tiles[(coord, format)] = body
+
+    def remove(self, layer, coord, format):
+        self.tiles.pop((coord, format), None)
+
+class BlockedSaveCache(SlowCache):
+    ''' In-memory cache whose saves of one tile body wait for an event.
+    '''
+    def __init__(self, body):
+        SlowCache.__init__(self)
+        self.body, self.saving, self.release = body, Event(), Event()
+
+    def save(self, body, layer, coord, format):
+        if body == self.body:
+            self.saving.set()
+            self.release.wait(10)
+        SlowCache.save(self, body, layer, coord, format)
+
+class FailingCache(SlowCache):
+    ''' In-memory cache that fails to save a number of times before it works.
+    '''
+    def __init__(self, failures):
+        SlowCache.__init__(self)
+        self.failures, self.attempts = failures, []
+
+    def save(self, body, layer, coord, format):
+        self.attempts.append(time.time())
+        if len(self.attempts) <= self.failures:
+            raise IOError('Failed on purpose')
+        SlowCache.save(self, body, layer, coord, format)
+
+class ListedCache(SlowCache):
+    ''' In-memory cache that counts reads and lists its tiles.
+    '''
+    def __init__(self, tiles=None):
+        SlowCache.__init__(self, tiles=tiles)
+        self.reads = 0
+
+    def read(self, layer, coord, format):
+        self.reads += 1
+        return SlowCache.read(self, layer, coord, format)
+
+    def list_tiles(self, layer):
+        return self.tiles.keys()
+
+class BlockedListCache(ListedCache):
+    ''' Listed cache whose listing of the tiles it had waits for an event.
+    '''
+    def __init__(self, tiles=None):
+        ListedCache.__init__(self, tiles=tiles)
+        self.listing, self.release = Event(), Event()
+
+    def list_tiles(self, layer):
+        tiles = ListedCache.list_tiles(self, layer)
+        self.listing.set()
+        self.release.wait(10)
+        return tiles
+
+class MultiCacheTests(TestCase):
+    '''Tests reading tiers of the Multi cache'''
+
+    def setUp(self):
+        self.layer = FakeLayer()
+        self.coord = Coordinate(1, 2, 3)
+        self.spool = mkdtemp(prefix='tilestache-spool-')
+
+    def tearDown(self):
+        rmtree(self.spool)
+
+    def test_sequential_read(self):
+        '''Read tiers in turn and backfill earlier tiers before returning'''
+        first, second = SlowCache(), SlowCache(tiles={(self.coord, 'PNG'): 'PNG bytes'})
+        cache = Multi([first, second], backfill=0)
+
+        self.assertEqual(cache.read(self.layer, self.coord, 'PNG'), 'PNG bytes')
+        self.assertEqual(first.tiles, second.tiles)
+
+        self.assertEqual(cache.read(self.layer, self.coord, 'PNG'), 'PNG bytes')
+        self.assertEqual(cache.read(self.layer, Coordinate(0, 0, 0), 'PNG'), None)
+
+        stats = cache.stats()
+        self.assertEqual([(tier['reads'], tier['hits']) for tier in stats['tiers']], [(3, 1), (2, 1)])
+        self.assertEqual(stats['tiers'][0]['hit ratio'], 1./3)
+        self.assertEqual(stats['backfilled'], 0)
+
+    def test_hedged_read(self):
+        '''Ask a later tier when an earlier one is slow, and backfill in the background'''
+        first = SlowCache(delay=.5, tiles={(self.coord, 'PNG'): 'slow bytes'})
+        second = SlowCache(tiles={(self.coord, 'PNG'): 'fast bytes'})
+        third = SlowCache()
+        cache = Multi([first, second, third], hedge=.05)
+
+        start = time.time()
+        self.assertEqual(cache.read(self.layer, self.coord, 'PNG'), 'fast bytes')
+        self.assertTrue(time.time() - start < .3)
+
+        cache.close()
+        self.assertEqual(first.tiles[(self.coord, 'PNG')], 'fast bytes')
+        self.assertEqual(third.tiles, {})
+        self.assertEqual(cache.stats()['backfilled'], 1)
+
+    def test_hedged_miss(self):
+        '''Move on from a tier that misses without waiting out the hedge delay'''
+        tiers = [SlowCache(), SlowCache(), SlowCache(tiles={(self.coord, 'PNG'): 'PNG bytes'})]
+        cache = Multi(tiers, hedge=10)
+
+        start = time.time()
+        self.assertEqual(cache.read(self.layer, self.coord, 'PNG'), 'PNG bytes')
+        self.assertEqual(cache.read(self.layer, Coordinate(0, 0, 0), 'PNG'), None)
+        self.assertTrue(time.time() - start < 1)
+
+        cache.close()
+        self.assertEqual([tier['hits'] for tier in cache.stats()['tiers']], [0, 0, 1])
+
+    def test_write_behind(self):
+        '''Save to a slow tier in the background, or synchronously when the spool is full'''
+        first, second = SlowCache(), BlockedSaveCache('first')
+        cache = Multi([first, WriteBehind(second, self.spool, threads=1, spool_size=1)])
+        coords = [Coordinate(row, 0, 4) for row in range(3)]
+
+        start = time.time()
+        cache.save('first', self.layer, coords[0], 'PNG')
+        self.assertTrue(time.time() - start < .1)
+        self.assertEqual(second.tiles, {})
+        self.assertEqual(len(os.listdir(self.spool)), 1)
+
+        # one tile is being saved, one waits in the spool, one is saved right away.
+        second.saving.wait(5)
+        cache.save('second', self.layer, coords[1], 'PNG')
+        cache.save('third', self.layer, coords[2], 'PNG')
+        self.assertTrue((coords[2], 'PNG') in second.tiles)
+        self.assertFalse((coords[1], 'PNG') in second.tiles)
+
+        second.release.set()
+        cache.close()
+        self.assertEqual(len(second.tiles), 3)
+        self.assertEqual(cache.read(self.layer, coords[1], 'PNG'), 'second')
+        self.assertEqual(os.listdir(self.spool), [])
+
+    def test_write_behind_retry(self):
+        '''Try a tile that failed to save again, waiting longer each time'''
+        second = FailingCache(2)
+        cache = WriteBehind(second, self.spool)
+        cache.retry_delay = .2
+
+        cache.save('retried', self.layer, self.coord, 'PNG')
+
+        for i in range(50):
+            if second.tiles:
+                break
+            time.sleep(.1)
+
+        cache.close()
+        self.assertEqual(second.tiles[(self.coord, 'PNG')], 'retried')
+        self.assertEqual(os.listdir(self.spool), [])
+
+        first_wait, second_wait = [b - a for (a, b) in zip(second.attempts, second.attempts[1:])]
+        self.assertTrue(.2 <= first_wait < second_wait)
+        self.assertTrue(second_wait >= .4)
+
+    def test_write_behind_recovery(self):
+        '''Save tiles left in the spool by a process that stopped'''
+        pid = os.fork()
+        if pid == 0:
+            cache = WriteBehind(SlowCache(save_delay=10), self.spool)
+            cache.save('left behind', self.layer, self.coord, 'PNG')
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.assertEqual(len(os.listdir(self.spool)), 1)
+
+        second = SlowCache()
+        cache = WriteBehind(second, self.spool)
+        cache.save('new', self.layer, Coordinate(0, 0, 0), 'PNG')
+
+        for i in range(50):
+            if len(second.tiles) == 2:
+                break
+            time.sleep(.1)
+
+        cache.close()
+        self.assertEqual(second.tiles[(self.coord, 'PNG')], 'left behind')
+        self.assertEqual(os.listdir(self.spool), [])
+
+    def test_existence_filter(self):
+        '''Answer misses from a filter built from a listing and updated on save'''
+        coords = [Coordinate(row, column, 8) for row in range(16) for column in range(16)]
+        listed = ListedCache(tiles=[((coord, 'PNG'), 'listed') for coord in coords[:10]])
+        cache = ExistenceFilter(listed, self.spool, capacity=1000)
+
+        # reads go to the cache while the filter is built.
+        self.assertEqual(cache.read(self.layer, coords[0], 'PNG'), 'listed')
+
+        for i in range(50):
+            if os.path.exists(os.path.join(self.spool, 'example.bloom')):
+                break
+            time.sleep(.1)
+
+        listed.reads = 0
+        cache.save('saved', self.layer, coords[10], 'PNG')
+
+        bodies = cache.read_many(self.layer, coords, 'PNG')
+        self.assertEqual(bodies, ['listed'] * 10 + ['saved'] + [None] * 245)
+        self.assertTrue(listed.reads < 20)
+
+        # another cache sees tiles saved by this one through the shared file.
+        other = ExistenceFilter(ListedCache(), self.spool, capacity=1000)
+        other.cache.tiles = listed.tiles
+        cache.save('again', self.layer, coords[11], 'PNG')
+        self.assertEqual(other.read(self.layer, coords[11], 'PNG'), 'again')
+        self.assertEqual(other.read(self.layer, coords[12], 'PNG'), None)
+        self.assertEqual(other.stats(), dict(reads=2, filtered=1))
+
+    def test_tiles_exist(self):
+        '''Check for many tiles in tiers and behind a filter, with or without exists_many'''
+        coords = [Coordinate(row, 0, 8) for row in range(8)]
+        first = SlowCache(tiles=[((coord, 'PNG'), 'first') for coord in coords[:2]])
+        second = ListedCache(tiles=[((coord, 'PNG'), 'second') for coord in coords[1:4]])
+
+        self.assertEqual(tilesExist(first, self.layer, coords, 'PNG'), [True] * 2 + [False] * 6)
+
+        cache = Multi([first, second])
+        self.assertEqual(cache.exists_many(self.layer, coords, 'PNG'), [True] * 4 + [False] * 4)
+        self.assertEqual(second.reads, 6)
+
+        filtered = ExistenceFilter(second, self.spool, capacity=1000)
+        self.assertEqual(filtered.read(self.layer, coords[1], 'PNG'), 'second')
+
+        for i in range(50):
+            if os.path.exists(os.path.join(self.spool, 'example.bloom')):
+                break
+            time.sleep(.1)
+
+        second.reads = 0
+        self.assertEqual(tilesExist(filtered, self.layer, coords, 'PNG'), [False] + [True] * 3 + [False] * 4)
+        self.assertTrue(second.reads < 5)
+
+    def test_existence_filter_saves_while_building(self):
+        '''Keep tiles saved by other processes while a filter is built, and count each tile once'''
+        coords = [Coordinate(row, 0, 8) for row in range(8)]
+        listed = BlockedListCache(tiles=[((coords[0], 'PNG'), 'listed')])
+        builder = ExistenceFilter(listed, self.spool, capacity=1000)
+
+        # another process, saving to the same cache while the filter is built.
+        other = ExistenceFilter(ListedCache(), self.spool, capacity=1000)
+        other.cache.tiles = listed.tiles
+
+        self.assertEqual(builder.read(self.layer, coords[0], 'PNG'), 'listed')
+        self.assertTrue(listed.listing.wait(5))
+
+        other.save('other', self.layer, coords[1], 'PNG')
+        listed.release.set()
+
+        for i in range(50):
+            if os.path.exists(os.path.join(self.spool, 'example.bloom')):
+                break
+            time.sleep(.1)
+
+        self.assertEqual(builder.read(self.layer, coords[1], 'PNG'), 'other')
+        self.assertEqual(other.read(self.layer, coords[1], 'PNG'), 'other')
+        self.assertFalse(os.path.exists(os.path.join(self.spool, 'example.bloom.saves')))
+
+        # saving the same tile again doesn't count it again.
+        for i in range(3):
+            builder.save('again', self.layer, coords[1], 'PNG')
+
+        header = open(os.path.join(self.spool, 'example.bloom')).read(48)
+        self.assertEqual(struct.unpack('<Q', header[-8:])[0], 2)
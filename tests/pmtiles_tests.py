@@ -0,0 +1,93 @@
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+import os
+
+from ModestMaps.Core import Coordinate
+from TileStache import PMTiles
+from TileStache.Caches import Multi
+from .utils import FakeLayer
+
+class PMTilesTests(TestCase):
+    '''Tests writing and reading PMTiles archives'''
+
+    def setUp(self):
+        self.path = mkdtemp(prefix='tilestache-pmtiles-')
+        self.filename = os.path.join(self.path, 'example.pmtiles')
+        self.layer = FakeLayer()
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_tile_ids(self):
+        '''Number tiles along a Hilbert curve at each zoom level'''
+        self.assertEqual([PMTiles.zxy_to_tileid(0, 0, 0), PMTiles.zxy_to_tileid(1, 0, 0),
+                          PMTiles.zxy_to_tileid(1, 0, 1), PMTiles.zxy_to_tileid(1, 1, 1),
+                          PMTiles.zxy_to_tileid(1, 1, 0)], [0, 1, 2, 3, 4])
+
+        self.assertEqual(PMTiles.zxy_to_tileid(12, 3423, 1763), 19078479)
+
+        for tileid in (0, 5, 1000, 19078479, 2 ** 40):
+            self.assertEqual(PMTiles.zxy_to_tileid(*PMTiles.tileid_to_zxy(tileid)), tileid)
+
+    def test_round_trip(self):
+        '''Store identical tiles once and read back the last save of each tile'''
+        cache = PMTiles.Cache(self.filename, 'png', 'example')
+        coords = [Coordinate(row, column, 3) for row in range(8) for column in range(8)]
+
+        for coord in coords:
+            cache.save('ocean', self.layer, coord, 'PNG')
+
+        cache.save('land', self.layer, Coordinate(2, 3, 3), 'PNG')
+        cache.save('island', self.layer, Coordinate(5, 5, 3), 'PNG')
+        cache.save('land again', self.layer, Coordinate(2, 3, 3), 'PNG')
+        cache.close()
+
+        self.assertEqual(os.listdir(self.path), ['example.pmtiles'])
+
+        archive = PMTiles.Archive(self.filename)
+        self.assertEqual(archive.get_tile(Coordinate(2, 3, 3)), 'land again')
+        self.assertEqual(archive.get_tile(Coordinate(5, 5, 3)), 'island')
+        self.assertEqual(archive.get_tile(Coordinate(7, 7, 3)), 'ocean')
+        self.assertEqual(archive.get_tile(Coordinate(0, 0, 2)), None)
+        self.assertEqual(archive.metadata()['name'], 'example')
+
+        # three distinct contents, and runs of ocean around the two other tiles.
+        size = os.path.getsize(self.filename)
+        self.assertEqual(size - archive.data_offset, len('ocean' + 'land again' + 'island'))
+        self.assertTrue(len(archive.root[0]) <= 5)
+
+    def test_abort(self):
+        '''Leave an existing archive alone when a cache is aborted'''
+        cache = PMTiles.Cache(self.filename, 'png', 'example')
+        cache.save('old', self.layer, Coordinate(0, 0, 0), 'PNG')
+        cache.close()
+
+        cache = Multi([PMTiles.Cache(self.filename, 'png', 'example')])
+        cache.save('new', self.layer, Coordinate(0, 0, 0), 'PNG')
+        cache.abort()
+        cache.close()
+
+        self.assertEqual(os.listdir(self.path), ['example.pmtiles'])
+        self.assertEqual(PMTiles.Archive(self.filename).get_tile(Coordinate(0, 0, 0)), 'old')
+
+    def test_leaf_directories(self):
+        '''Split large directories into leaves and find tiles through them'''
+        cache = PMTiles.Cache(self.filename, 'png', 'example')
+
+        # every other tile at zoom 8, with bodies of many lengths.
+        for row in range(0, 256, 2):
+            cache.save_many([(Coordinate(row, column, 8), '%d/%d' % (column, row) + 'x' * (column * row % 997))
+                             for column in range(256)], self.layer, 'PNG')
+
+        cache.close()
+
+        archive = PMTiles.Archive(self.filename)
+        self.assertTrue(0 in archive.root[3])
+        self.assertTrue(archive.root_length < 16384)
+
+        for (row, column) in [(0, 0), (254, 255), (64, 3), (98, 17)]:
+            self.assertEqual(archive.get_tile(Coordinate(row, column, 8)), '%d/%d' % (column, row) + 'x' * (column * row % 997))
+
+        self.assertEqual(archive.get_tile(Coordinate(99, 17, 8)), None)
+        self.assertEqual(archive.get_tile(Coordinate(0, 0, 7)), None)
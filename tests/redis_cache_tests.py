@@ -0,0 +1,123 @@
+from unittest import TestCase
+from threading import Thread
+import time
+
+from ModestMaps.Core import Coordinate
+from TileStache import Redis
+from .utils import FakeLayer
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+class RedisCacheTests(TestCase):
+    '''Tests the Redis cache against a local redis-server, or fakeredis in its place'''
+
+    def setUp(self):
+        if redis is None:
+            self.skipTest('redis-py is not installed')
+
+        self.layer = FakeLayer('example')
+        self.server = None
+
+        try:
+            Redis.Cache(db=15).conn.ping()
+        except redis.ConnectionError:
+            if fakeredis is None:
+                self.skipTest('no redis-server running and fakeredis is not installed')
+            self.server = fakeredis.FakeServer()
+
+        self.cache().conn.flushdb()
+
+    def cache(self):
+        ''' Return a new Redis cache, connected to the same database each time.
+        '''
+        cache = Redis.Cache(db=15, key_prefix='test')
+
+        if self.server is not None:
+            cache.pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection, server=self.server)
+            cache.conn = redis.StrictRedis(connection_pool=cache.pool)
+            cache.unlock_script = cache.conn.register_script(Redis._unlock_script)
+
+        return cache
+
+    def test_save_and_read(self):
+        '''Save and read back tiles, one at a time and pipelined'''
+        cache = self.cache()
+        coords = [Coordinate(row, 1, 4) for row in range(4)]
+
+        cache.save('one', self.layer, coords[0], 'PNG')
+        self.assertEqual(cache.read(self.layer, coords[0], 'PNG'), 'one')
+        self.assertEqual(cache.conn.ttl('test/example/4/1/0.PNG'), -1)
+
+        cache.save_many([(coord, 'many %d' % coord.row) for coord in coords[1:]], self.layer, 'PNG')
+        self.assertEqual(cache.read_many(self.layer, coords, 'PNG'), ['one', 'many 1', 'many 2', 'many 3'])
+
+        cache.remove(self.layer, coords[0], 'PNG')
+        self.assertEqual(cache.read(self.layer, coords[0], 'PNG'), None)
+
+    def test_lifespan(self):
+        '''Expire tiles after the layer cache lifespan'''
+        cache, layer = self.cache(), FakeLayer('example', cache_lifespan=60)
+
+        cache.save('one', layer, Coordinate(0, 0, 1), 'PNG')
+        cache.save_many([(Coordinate(1, 1, 1), 'two')], layer, 'PNG')
+
+        self.assertTrue(0 < cache.conn.ttl('test/example/1/0/0.PNG') <= 60)
+        self.assertTrue(0 < cache.conn.ttl('test/example/1/1/1.PNG') <= 60)
+
+    def test_lock_wakes_waiter(self):
+        '''Wake a waiting cache as soon as a lock is released'''
+        coord, times = Coordinate(1, 2, 3), []
+        holder, waiter = self.cache(), self.cache()
+
+        def wait():
+            waiter.lock(self.layer, coord, 'PNG')
+            times.append(time.time())
+            waiter.unlock(self.layer, coord, 'PNG')
+
+        holder.lock(self.layer, coord, 'PNG')
+        thread = Thread(target=wait)
+        thread.start()
+
+        time.sleep(.3)
+        released = time.time()
+        holder.unlock(self.layer, coord, 'PNG')
+        thread.join()
+
+        self.assertTrue(0 <= times[0] - released < .1)
+        self.assertFalse(holder.conn.exists('test/example/3/2/1.PNG-lock'))
+
+    def test_stale_lock(self):
+        '''Let locks expire, and keep their old holder from releasing them'''
+        coord, layer = Coordinate(1, 2, 3), FakeLayer('example', stale_lock_timeout=.3)
+        first, second = self.cache(), self.cache()
+
+        first.lock(layer, coord, 'PNG')
+
+        start = time.time()
+        second.lock(layer, coord, 'PNG')
+        self.assertTrue(time.time() - start >= .25)
+
+        # the first holder's lock expired, so it must not release the second.
+        first.unlock(layer, coord, 'PNG')
+        self.assertTrue(second.conn.exists('test/example/3/2/1.PNG-lock'))
+
+        second.unlock(layer, coord, 'PNG')
+        self.assertFalse(second.conn.exists('test/example/3/2/1.PNG-lock'))
+
+    def test_list_tiles(self):
+        '''List the tiles of a layer, skipping locks and other layers'''
+        cache = self.cache()
+        cache.save_many([(Coordinate(0, 0, 1), 'one'), (Coordinate(1, 1, 1), 'two')], self.layer, 'PNG')
+        cache.save('three', FakeLayer('other'), Coordinate(0, 0, 0), 'PNG')
+        cache.lock(self.layer, Coordinate(0, 0, 0), 'PNG')
+
+        tiles = sorted([(coord.zoom, coord.column, coord.row, format) for (coord, format) in cache.list_tiles(self.layer)])
+        self.assertEqual(tiles, [(1, 0, 0, 'PNG'), (1, 1, 1, 'PNG')])
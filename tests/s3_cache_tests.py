@@ -0,0 +1,132 @@
+from unittest import TestCase
+from threading import Thread
+from socket import error as SocketError
+from uuid import uuid4
+import time
+
+from ModestMaps.Core import Coordinate
+from TileStache import S3
+from .utils import FakeLayer
+
+try:
+    from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+except ImportError:
+    S3Connection = None
+
+class S3CacheTests(TestCase):
+    '''Tests the S3 cache against a local S3-compatible service on port 5000, e.g. "moto_server s3"'''
+
+    def setUp(self):
+        if S3Connection is None:
+            self.skipTest('boto is not installed')
+
+        self.bucket = 'tilestache-%s' % uuid4().hex[:8]
+        self.layer = FakeLayer('example')
+
+        conn = S3Connection('access', 'secret', host='127.0.0.1', port=5000,
+                            is_secure=False, calling_format=OrdinaryCallingFormat())
+
+        try:
+            conn.create_bucket(self.bucket)
+        except SocketError:
+            self.skipTest('no S3 service running on port 5000')
+
+    def cache(self, **kwargs):
+        return S3.Cache(self.bucket, 'access', 'secret', host='127.0.0.1', port=5000, is_secure=False, **kwargs)
+
+    def test_save_and_read(self):
+        '''Save, read back and remove tiles'''
+        cache, coord = self.cache(path='cache'), Coordinate(1, 2, 3)
+
+        self.assertEqual(cache.read(self.layer, coord, 'PNG'), None)
+
+        cache.save('PNG bytes', self.layer, coord, 'PNG')
+        self.assertEqual(cache.read(self.layer, coord, 'PNG'), 'PNG bytes')
+        self.assertEqual(cache._bucket().get_key('cache/example/3/2/1.png').content_type, 'image/png')
+
+        cache.remove(self.layer, coord, 'PNG')
+        self.assertEqual(cache.read(self.layer, coord, 'PNG'), None)
+
+    def test_lifespan(self):
+        '''Skip tiles older than the layer cache lifespan'''
+        cache, coord = self.cache(), Coordinate(1, 2, 3)
+        cache.save('PNG bytes', self.layer, coord, 'PNG')
+
+        self.assertEqual(cache.read(FakeLayer('example', cache_lifespan=3600), coord, 'PNG'), 'PNG bytes')
+
+        time.sleep(1.1)
+        self.assertEqual(cache.read(FakeLayer('example', cache_lifespan=1), coord, 'PNG'), None)
+
+    def test_save_many(self):
+        '''Upload the tiles of a metatile in parallel'''
+        cache = self.cache(threads=4)
+        tiles = [(Coordinate(row, col, 4), 'tile %d %d' % (row, col)) for row in range(4) for col in range(4)]
+
+        cache.save_many(tiles, self.layer, 'PNG')
+
+        for (coord, body) in tiles:
+            self.assertEqual(cache.read(self.layer, coord, 'PNG'), body)
+
+    def test_lock(self):
+        '''Allow only one lock holder at a time'''
+        coord, held = Coordinate(1, 2, 3), []
+        first, second = self.cache(use_locks=True), self.cache(use_locks=True)
+
+        def wait():
+            second.lock(self.layer, coord, 'PNG')
+            held.append(time.time())
+            second.unlock(self.layer, coord, 'PNG')
+
+        first.lock(self.layer, coord, 'PNG')
+        thread = Thread(target=wait)
+        thread.start()
+
+        time.sleep(.3)
+        self.assertEqual(held, [])
+
+        released = time.time()
+        first.unlock(self.layer, coord, 'PNG')
+        thread.join()
+
+        self.assertTrue(held[0] >= released)
+
+    def test_stale_lock(self):
+        '''Break a stale lock, and keep it from being released by its previous holder'''
+        coord, layer = Coordinate(1, 2, 3), FakeLayer('example', stale_lock_timeout=.3)
+        first, second = self.cache(use_locks=True), self.cache(use_locks=True)
+        bucket, key_name = second._bucket(), S3.tile_key(layer, coord, 'PNG') + '-lock'
+
+        first.lock(layer, coord, 'PNG')
+        second.lock(layer, coord, 'PNG')
+
+        first.unlock(layer, coord, 'PNG')
+        self.assertNotEqual(bucket.get_key(key_name), None)
+
+        second.unlock(layer, coord, 'PNG')
+        self.assertEqual(bucket.get_key(key_name), None)
+
+    def test_list_tiles(self):
+        '''List the tiles of a layer, skipping locks and other layers'''
+        cache = self.cache(use_locks=True)
+        cache.save_many([(Coordinate(0, 0, 1), 'one'), (Coordinate(1, 1, 1), 'two')], self.layer, 'PNG')
+        cache.save('three', FakeLayer('other'), Coordinate(0, 0, 0), 'PNG')
+        cache.lock(self.layer, Coordinate(0, 0, 0), 'PNG')
+
+        tiles = sorted([(coord.zoom, coord.column, coord.row, format) for (coord, format) in cache.list_tiles(self.layer)])
+        self.assertEqual(tiles, [(1, 0, 0, 'png'), (1, 1, 1, 'png')])
+
+    def test_exists_many(self):
+        '''Check for many tiles at once by listing keys, with and without a path'''
+        for path in ('cache', ''):
+            cache = self.cache(path=path)
+            coords = [Coordinate(row, column, 5) for row in range(8, 12) for column in range(2)]
+
+            for coord in coords[::3] + [Coordinate(13, 0, 5), Coordinate(7, 1, 5)]:
+                cache.save('PNG bytes', self.layer, coord, 'PNG')
+
+            expected = [index % 3 == 0 for index in range(len(coords))]
+            self.assertEqual(cache.exists_many(self.layer, coords, 'PNG'), expected)
+            self.assertEqual(cache.exists_many(self.layer, coords, 'JPEG'), [False] * len(coords))
+
+        time.sleep(1.1)
+        self.assertEqual(cache.exists_many(FakeLayer('example', cache_lifespan=1), coords, 'PNG'), [False] * len(coords))
@@ -0,0 +1,165 @@
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from StringIO import StringIO
+import runpy
+import json
+import sys
+import os
+
+from PIL import Image
+from ModestMaps.Core import Coordinate
+from TileStache import MBTiles
+
+seed_script = os.path.join(os.path.dirname(__file__), '..', 'scripts', 'tilestache-seed.py')
+
+# -b for the whole world short of the poles, two tiles across at zoom 1.
+world = ['-b', '-80', '-170', '80', '170']
+
+class Provider:
+    ''' Renders blank images, and writes the zoom of each render to a log file.
+
+        Renders at the zoom level given as fail raise an exception instead.
+    '''
+    def __init__(self, layer, log, fail=None):
+        self.log = log
+        self.fail = fail
+
+    def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
+        open(self.log, 'a').write('%d\n' % zoom)
+
+        if zoom == self.fail:
+            raise Exception('Failed on purpose')
+
+        return Image.new('RGB', (width, height), (0, 0, 0))
+
+class SeedTests(TestCase):
+    '''Tests seeding tiles with the tilestache-seed.py script'''
+
+    def setUp(self):
+        self.path = mkdtemp(prefix='tilestache-seed-')
+        self.log = os.path.join(self.path, 'renders.log')
+        self.cache = os.path.join(self.path, 'cache')
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def seed(self, fail=None, *args):
+        ''' Run the seed script with a 2x2 metatile layer, keeping what it wrote to stderr.
+        '''
+        config = {'cache': {'name': 'Disk', 'path': self.cache, 'dirs': 'portable'},
+                  'layers': {'tiles': {'provider': {'class': '%s:Provider' % __name__,
+                                                    'kwargs': dict(log=self.log, fail=fail)},
+                                       'metatile': {'rows': 2, 'columns': 2}}}}
+
+        filename = os.path.join(self.path, 'config.json')
+        json.dump(config, open(filename, 'w'))
+
+        argv, stderr = sys.argv, sys.stderr
+        sys.argv = ['tilestache-seed.py', '-q', '-c', filename, '-l', 'tiles'] + list(args)
+        sys.stderr = StringIO()
+
+        try:
+            runpy.run_path(seed_script, run_name='__main__')
+        finally:
+            self.stderr = sys.stderr.getvalue()
+            sys.argv, sys.stderr = argv, stderr
+
+    def renders(self):
+        ''' Return a list of zoom levels rendered, one for each metatile.
+        '''
+        if not os.path.exists(self.log):
+            return []
+
+        return sorted([int(line) for line in open(self.log)])
+
+    def cached(self):
+        ''' Return a sorted list of (zoom, column, row) tiles in the Disk cache.
+        '''
+        tiles = []
+
+        for (dirpath, dirnames, filenames) in os.walk(self.cache):
+            for filename in filenames:
+                zoom, column = dirpath.split(os.sep)[-2:]
+                tiles.append((int(zoom), int(column), int(filename.split('.')[0])))
+
+        return sorted(tiles)
+
+    def test_jobs(self):
+        '''Seed tiles with more than one process, each metatile rendered once'''
+        progressfile = os.path.join(self.path, 'progress.json')
+        self.seed(None, '--jobs', '2', '-f', progressfile, *(world + ['1', '2']))
+
+        expected = [(zoom, column, row) for zoom in (1, 2) for column in range(2**zoom) for row in range(2**zoom)]
+        self.assertEqual(self.cached(), expected)
+        self.assertEqual(self.renders(), [1, 2, 2, 2, 2])
+
+        progress = json.load(open(progressfile))
+        self.assertEqual((progress['offset'], progress['total']), (20, 20))
+
+    def test_jobs_to_mbtiles(self):
+        '''Save tiles from more than one process to a tileset in the main process'''
+        tileset = os.path.join(self.path, 'tiles.mbtiles')
+        self.seed(None, '--jobs', '2', '--to-mbtiles', tileset, *(world + ['1', '2']))
+
+        expected = [Coordinate(row, column, zoom) for zoom in (1, 2) for column in range(2**zoom) for row in range(2**zoom)]
+        self.assertEqual(sorted(MBTiles.list_tiles(tileset)), sorted(expected))
+        self.assertEqual(self.renders(), [1, 2, 2, 2, 2])
+
+        # seeding processes don't touch the configured cache.
+        self.assertEqual(self.cached(), [])
+
+    def test_jobs_error_list(self):
+        '''Write a whole failed metatile to the error list, and seed the rest'''
+        error_list = os.path.join(self.path, 'errors.txt')
+        self.seed(1, '--jobs', '2', '--error-list', error_list, *(world + ['1', '2']))
+
+        errors = sorted(open(error_list).read().split())
+        self.assertEqual(errors, ['1/0/0', '1/0/1', '1/1/0', '1/1/1'])
+
+        expected = [(2, column, row) for column in range(4) for row in range(4)]
+        self.assertEqual(self.cached(), expected)
+        self.assertEqual(self.renders(), [1, 2, 2, 2, 2])
+
+    def test_jobs_failure(self):
+        '''Stop handing out tiles after a failure, and fail the rest of its metatile'''
+        argv = ['--jobs', '2'] + world + ['1', '2', '3', '4']
+        self.assertRaises(Exception, self.seed, 1, *argv)
+
+        # no more than the four waiting tiles for each process were handed out.
+        self.assertTrue(len(self.renders()) <= 8)
+        self.assertEqual(self.renders().count(1), 1)
+        self.assertTrue((1, 0, 0) not in self.cached())
+
+        self.assertTrue('Failed on purpose' in self.stderr)
+        self.assertEqual(self.stderr.count('because tiles/1/0/0.png in the same metatile failed'), 3)
+
+    def test_skip_existing(self):
+        '''Render only tiles missing from the cache with --skip-existing'''
+        progressfile = os.path.join(self.path, 'progress.json')
+        self.seed(None, '-f', progressfile, *(world + ['1', '2']))
+        self.assertEqual(json.load(open(progressfile))['tile'], 'tiles/2/3/3.png')
+
+        for jobs in ('1', '2'):
+            os.remove(os.path.join(self.cache, 'tiles', '2', '0', '1.png'))
+            self.seed(None, '--skip-existing', '--jobs', jobs, '-f', progressfile, *(world + ['1', '2']))
+
+            # only the missing tile was seeded.
+            self.assertEqual(json.load(open(progressfile))['tile'], 'tiles/2/0/1.png')
+            self.assertEqual(len(self.cached()), 20)
+
+        self.assertEqual(self.renders(), [1, 2, 2, 2, 2, 2, 2])
+
+    def test_resume(self):
+        '''Skip tiles marked in the --resume completion file without looking in the cache'''
+        done = os.path.join(self.path, 'tiles.done')
+        error_list = os.path.join(self.path, 'errors.txt')
+        self.seed(1, '--jobs', '2', '--resume', done, '--error-list', error_list, *(world + ['1', '2']))
+        self.assertEqual(len(self.cached()), 16)
+
+        rmtree(self.cache)
+        self.seed(None, '--jobs', '2', '--resume', done, *(world + ['1', '2']))
+
+        # only the failed tiles were seeded again.
+        self.assertEqual(self.renders(), [1, 1, 2, 2, 2, 2])
+        self.assertEqual(self.cached(), [(1, column, row) for column in range(2) for row in range(2)])
@@ -0,0 +1,87 @@
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+import json
+import os
+
+from ModestMaps.Core import Coordinate
+from TileStache.Throughput import Throughput, TimedCache, EventLog
+
+class FakeCache:
+    ''' In-memory cache with an optional method.
+    '''
+    def __init__(self):
+        self.tiles = dict()
+
+    def read(self, layer, coord, format):
+        return self.tiles.get((coord, format))
+
+    def save(self, body, layer, coord, format):
+        self.tiles[(coord, format)] = body
+
+    def close(self):
+        self.tiles = None
+
+class ThroughputTests(TestCase):
+    '''Tests counting seeded tiles and logging events'''
+
+    def setUp(self):
+        self.path = mkdtemp(prefix='tilestache-throughput-')
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_stats(self):
+        '''Count tiles by source, with rates, latency by zoom, and time left'''
+        throughput = Throughput(100, alpha=.5)
+        throughput.skip(10)
+
+        for (row, source) in enumerate(['render', 'cache', 'metatile', 'failed']):
+            throughput.add(Coordinate(row, 0, 12), source, 1024, .4 - row * .1, .1)
+
+        stats = throughput.stats()
+        self.assertEqual((stats['tiles'], stats['total'], stats['bytes']), (14, 100, 4096))
+        self.assertEqual(stats['counts']['skipped'], 10)
+        self.assertEqual(stats['hit ratio'], 1./3)
+        self.assertEqual(stats['tiles per second'], 4)
+        self.assertEqual(stats['eta'], 86 / 4.)
+
+        # each tile counts for half of the moving average.
+        zoom = stats['zooms']['12']
+        self.assertAlmostEqual(zoom['latency'], .4 / 8 + .3 / 8 + .2 / 4 + .1 / 2)
+        self.assertAlmostEqual(zoom['cache seconds'], .4)
+        self.assertAlmostEqual(zoom['render seconds'], .6)
+
+        self.assertTrue(throughput.report().startswith('14 of 100 tiles (14.0%), 4.0 tiles/s, 4KB/s, 33% from cache'))
+
+    def test_event_log(self):
+        '''Write a line of JSON for each tile and each skip'''
+        filename = os.path.join(self.path, 'seed.ndjson')
+        throughput = Throughput(10, EventLog(filename))
+
+        throughput.add(Coordinate(1582, 656, 12), 'render', 2048, .25, .05)
+        throughput.skip(3)
+        throughput.events.write('stats', **throughput.stats())
+        throughput.events.close()
+
+        events = [json.loads(line) for line in open(filename)]
+        self.assertEqual([event['event'] for event in events], ['tile', 'skipped', 'stats'])
+        self.assertEqual((events[0]['zoom'], events[0]['column'], events[0]['row']), (12, 656, 1582))
+        self.assertEqual((events[0]['source'], events[0]['bytes']), ('render', 2048))
+        self.assertEqual(events[1]['tiles'], 3)
+        self.assertEqual(events[2]['tiles'], 4)
+
+    def test_timed_cache(self):
+        '''Count time and hits in a cache, passing through its optional methods'''
+        cache, coord = TimedCache(FakeCache()), Coordinate(1, 2, 3)
+
+        self.assertEqual(cache.read(None, coord, 'PNG'), None)
+        cache.save('PNG bytes', None, coord, 'PNG')
+        self.assertEqual(cache.read(None, coord, 'PNG'), 'PNG bytes')
+
+        self.assertEqual(cache.hits, 1)
+        self.assertTrue(cache.seconds > 0)
+
+        self.assertFalse(hasattr(cache, 'save_many'))
+        cache.close()
+        self.assertEqual(cache.cache.tiles, None)
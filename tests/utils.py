@@ -111,4 +111,24 @@ def find_open_port():
     s.bind(("",0))
     port = s.getsockname()[1]
     s.close()
-    return port
\ No newline at end of file
+    return port
+class FakeConfig:
+    '''
+    Just enough of a Configuration to find layers by name.
+    '''
+    def __init__(self):
+        self.layers = {}
+
+class FakeLayer:
+    '''
+    Just enough of a Layer for a cache to work with.
+    '''
+    def __init__(self, name='example', cache_lifespan=None, stale_lock_timeout=15):
+        self._name = name
+        self.cache_lifespan = cache_lifespan
+        self.stale_lock_timeout = stale_lock_timeout
+        self.config = FakeConfig()
+        self.config.layers[name] = self
+
+    def name(self):
+        return self._name